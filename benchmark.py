@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+from __future__ import print_function  # for python 2
+
+import itertools
+import json
+import logging
+import os
+import platform
+import pty
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Process
+from threading import Thread, Event
+from time import sleep, time
+
+from observer import Observer
+
+from fakeserial import TrafficGenerator
+from filewriter import FileWriter
+from rawcapture import RawCaptureWriter
+from serialreader import SerialReader
+
+# Lines carry the seconds since the start of the traffic when sent, e.g. '[    1.234567] ...',
+# which is what the latency to disk is measured from.
+SENT_TIME_PATTERN = re.compile(br'\[\s*(\d+\.\d+)\]')
+
+
+class NullObserver(Observer):
+    """
+    An observer doing nothing, used for measuring the cost of updating many observers.
+    """
+    def __init__(self):
+        super(NullObserver, self).__init__(self.__class__.__name__)
+
+    def update(self, data):
+        pass
+
+
+class BenchFileWriter(Observer):
+    """
+    Writes log lines to a file writer, like the file writer observer of the CLI.
+    """
+    def __init__(self, file_writer):
+        super(BenchFileWriter, self).__init__(self.__class__.__name__)
+        self._file_writer = file_writer
+
+    def update(self, data):
+        self._file_writer.put(data[0])
+
+
+class FileTailer(Thread):
+    """
+    This thread follows a log file as it is written and measures the latency of each log line
+    from when it was sent until it was read back from the file.
+    """
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, log_file_path):
+        super(FileTailer, self).__init__(name = self.__class__.__name__)
+        self.setDaemon(True)
+        self._log_file_path = log_file_path
+        self._stop_event = Event()
+        self.start_time = None  # when the traffic started, set by the source
+        self.latencies = []
+        self.line_count = 0
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _read_lines(self, log_file, partial):
+        data = log_file.read()
+        if not data:
+            return partial, False
+        now = time()
+        lines = (partial + data).split(b'\n')
+        for line in lines[:-1]:
+            self.line_count += 1
+            match = SENT_TIME_PATTERN.search(line)
+            if match and self.start_time is not None:
+                self.latencies.append(now - self.start_time - float(match.group(1)))
+        return lines[-1], True
+
+    def run(self):
+        while not os.path.exists(self._log_file_path) and not self._stop_event.is_set():
+            sleep(self.POLL_INTERVAL)
+        with open(self._log_file_path, 'rb') as log_file:
+            partial = b''
+            while not self._stop_event.is_set():
+                partial, more = self._read_lines(log_file, partial)
+                if not more:
+                    sleep(self.POLL_INTERVAL)
+            partial, _ = self._read_lines(log_file, partial)
+
+
+def pty_writer(master_fd, start_time, line_size, line_count, rate):
+    """
+    Writes numbered lines to the master side of a pty, paced at a baud rate or as fast as the pty
+    takes them if rate is 0. Runs in a process of its own.
+    """
+    bytes_per_second = rate / 10.0
+    written = 0
+    for i in range(line_count):
+        now = time()
+        text = '[{:>12.6f}] bench line {}: '.format(now - start_time, i)
+        line = (text + 'x' * max(0, line_size - len(text))).encode('ascii') + b'\r\n'
+        if rate:
+            due = start_time + written / bytes_per_second
+            if due > now:
+                sleep(due - now)
+        view = memoryview(line)
+        while view:
+            view = view[os.write(master_fd, view):]
+        written += len(line)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(percent / 100.0 * (len(sorted_values) - 1)))]
+
+
+def run_benchmark(source, line_size, rate, observers, timestamp, read_mode, line_count, max_duration):
+    """
+    Runs the serial reader, observers and file writer on one traffic configuration.
+    :param source: 'fake' for fakeserial traffic or 'pty' for pyserial on a pty fed by a process.
+    :param line_size: The length of each line in bytes.
+    :param rate: The baud rate of the traffic or 0 for as fast as possible.
+    :param observers: The number of observers in addition to the file writer.
+    :param timestamp: Timestamp each line.
+    :param read_mode: The read mode of the serial reader. RAW_MODE writes a raw capture instead of
+                      the log file.
+    :param line_count: The number of lines sent.
+    :param max_duration: The max number of seconds to wait for all lines to be written.
+    :return: A dict with the results.
+    """
+    work_dir = tempfile.mkdtemp(prefix='serialbench-')
+    log_file_path = os.path.join(work_dir, 'serial.txt')
+    errors = []
+    tailer = FileTailer(log_file_path)
+    writer_process = None
+
+    if source == 'fake':
+        from fakeserial import Serial
+        generator = TrafficGenerator(baudrate=rate or None,
+                                     seed=0,
+                                     line_lengths=('fixed', line_size),
+                                     line_count=line_count)
+        Serial.prepare(generator)
+        serial_port = Serial(port='bench', timeout=0.1)
+    else:
+        from serial import Serial
+        master_fd, slave_fd = pty.openpty()
+        serial_port = Serial(os.ttyname(slave_fd), timeout=0.1)
+        tailer.start_time = time()
+        writer_process = Process(target=pty_writer,
+                                 args=(master_fd, tailer.start_time, line_size, line_count, rate))
+
+    if read_mode == SerialReader.RAW_MODE:
+        file_writer = RawCaptureWriter(log_file_path, errors.append)
+    else:
+        file_writer = FileWriter(log_file_path, errors.append)
+    reader = SerialReader(serial=serial_port, callback=errors.append, do_timestamp=timestamp,
+                          read_mode=read_mode,
+                          raw_capture=file_writer if read_mode == SerialReader.RAW_MODE else None)
+    reader.attach(BenchFileWriter(file_writer))
+    for _ in range(observers):
+        reader.attach(NullObserver())
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    file_writer.start()
+    tailer.start()
+    start_time = time()
+    reader.start()
+    if writer_process is not None:
+        writer_process.start()
+
+    deadline = start_time + max_duration
+    while tailer.line_count < line_count and time() < deadline and not errors:
+        if source == 'fake' and tailer.start_time is None:
+            tailer.start_time = generator.start_time
+        sleep(0.01)
+    duration = time() - start_time
+
+    reader.stop()
+    file_writer.stop()
+    tailer.stop()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    if writer_process is not None:
+        writer_process.terminate()
+        writer_process.join()
+        os.close(master_fd)
+    serial_port.close()
+    log_bytes = os.path.getsize(log_file_path) if os.path.exists(log_file_path) else 0
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    megabytes = log_bytes / 1e6
+    cpu_seconds = ((usage_after.ru_utime + usage_after.ru_stime) -
+                   (usage_before.ru_utime + usage_before.ru_stime))
+    latencies = sorted(tailer.latencies)
+    return {'source': source,
+            'line_size': line_size,
+            'rate': rate,
+            'observers': observers,
+            'timestamp': timestamp,
+            'read_mode': read_mode,
+            'lines_sent': line_count,
+            'lines_written': tailer.line_count,
+            'bytes_written': log_bytes,
+            'duration_s': duration,
+            'lines_per_s': tailer.line_count / duration,
+            'mb_per_s': megabytes / duration,
+            'latency_p50_ms': _ms(percentile(latencies, 50)),
+            'latency_p90_ms': _ms(percentile(latencies, 90)),
+            'latency_p99_ms': _ms(percentile(latencies, 99)),
+            'latency_max_ms': _ms(latencies[-1] if latencies else None),
+            'cpu_s_per_mb': cpu_seconds / megabytes if megabytes else None,
+            'peak_rss_kb': usage_after.ru_maxrss if sys.platform != 'darwin' else usage_after.ru_maxrss // 1024,
+            'errors': errors}
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+def environment():
+    """
+    :return: A dict describing the code version and host, for comparing results across versions.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'time': time()}
+
+
+if __name__ == "__main__":
+    import argparse
+    from os.path import basename
+
+    # CLI
+    program_name = basename(__file__)
+    parser = argparse.ArgumentParser(description=('Serial Logger Benchmark CLI\n\n'
+                                                  'Measures throughput, latency to disk, CPU per MB and '
+                                                  'peak RSS of the serial reader,\n'
+                                                  'observers and file writer over a sweep of traffic '
+                                                  'configurations. Traffic comes\n'
+                                                  'from a fake serial port or from a pty read with '
+                                                  'pyserial. Each configuration runs in\n'
+                                                  'a process of its own and results are written as '
+                                                  'JSON lines.\n'),
+                                     prog = program_name,
+                                     epilog = ('\n  %(prog)s\n'
+                                               '  %(prog)s -s pty -r 921600 0 -z 40 400 -o results.jsonl\n'),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--sources', nargs='+', choices=('fake', 'pty'), default=['fake', 'pty'],
+                        help='traffic sources')
+    parser.add_argument('-z', '--line-sizes', nargs='+', type=int, default=[80], help='line sizes in bytes')
+    parser.add_argument('-r', '--rates', nargs='+', type=int, default=[921600, 0],
+                        help='baud rates, 0 for as fast as possible')
+    parser.add_argument('-b', '--observers', nargs='+', type=int, default=[1], help='observer counts')
+    parser.add_argument('-t', '--timestamps', nargs='+', choices=('on', 'off'), default=['off', 'on'],
+                        help='timestamp on or off')
+    parser.add_argument('-m', '--read-modes', nargs='+', choices=SerialReader.READ_MODES,
+                        default=[SerialReader.CHUNK_MODE], help='read modes')
+    parser.add_argument('-n', '--lines', type=int, default=100000, help='lines sent per run')
+    parser.add_argument('-x', '--max-duration', type=float, default=30.0, help='max seconds per run')
+    parser.add_argument('-o', '--output', type=str, help='write results to file instead of stdout')
+    parser.add_argument('--run', type=str, help=argparse.SUPPRESS)  # runs one configuration
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.run:
+        print(json.dumps(run_benchmark(**json.loads(args.run))))
+        sys.exit(0)
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        env = environment()
+        for (source, line_size, rate, observers, timestamp, read_mode) in itertools.product(
+                args.sources, args.line_sizes, args.rates, args.observers, args.timestamps, args.read_modes):
+            config = {'source': source,
+                      'line_size': line_size,
+                      'rate': rate,
+                      'observers': observers,
+                      'timestamp': timestamp == 'on',
+                      'read_mode': read_mode,
+                      'line_count': args.lines,
+                      'max_duration': args.max_duration}
+            # a process per run keeps the peak RSS and CPU usage of the runs apart
+            result = json.loads(subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                                         '--run', json.dumps(config)]).decode('utf8'))
+            result.update(env)
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import logging
+import sys
+from collections import deque
+from threading import Thread, Event
+from time import time
+
+
+class ConsoleWriter(Thread):
+    """
+    This thread writes log lines to the console once per frame interval with a single write call.
+    Putting a log line is only an append to a backlog, so a slow terminal never stalls the caller.
+    When the terminal falls behind, the number of lines written per frame shrinks and the lines
+    not written are summarized by a line like '...1234 lines suppressed...'. Lines not fitting
+    in a full backlog are suppressed too. Log lines are bytes, and each frame is decoded at once
+    when written, so only the lines written are decoded. Thread quits if stop() is called.
+    """
+    FRAME_INTERVAL = 1 / 30.0
+    MAX_LINES_PER_FRAME = 2000
+    MIN_LINES_PER_FRAME = 10
+    MAX_BACKLOG = 100000
+    SUPPRESSED = '...{} lines suppressed...'
+
+    def __init__(self,
+                 stream=None,
+                 frame_interval=FRAME_INTERVAL,
+                 max_lines_per_frame=MAX_LINES_PER_FRAME,
+                 max_backlog=MAX_BACKLOG):
+        """
+        :param stream: The stream to write to, sys.stdout if None.
+        :param frame_interval: The number of seconds between writes.
+        :param max_lines_per_frame: The max number of lines written per frame.
+        :param max_backlog: The max number of lines waiting to be written.
+        """
+        super(ConsoleWriter, self).__init__(name = self.__class__.__name__)
+        self.setDaemon(True)
+        self._stream = stream if stream is not None else sys.stdout
+        self._frame_interval = frame_interval
+        self._max_lines_per_frame = max_lines_per_frame
+        self._lines_per_frame = max_lines_per_frame
+        self._max_backlog = max_backlog
+        self._backlog = deque()
+        self._stop_event = Event()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.overflowed = 0  # lines not fitting in the backlog
+        self.suppressed = 0  # all lines not written, including the overflowed ones
+        self._reported_overflowed = 0
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._frame_interval,
+                                             self._max_lines_per_frame,
+                                             self._max_backlog)
+
+    def put(self, line):
+        """
+        Puts a log line to be written to the console.
+        :param line: A log line as bytes without end line characters.
+        """
+        if len(self._backlog) < self._max_backlog:
+            self._backlog.append(line)  # deque appends are thread-safe
+        else:
+            self.overflowed += 1
+
+    def stop(self):
+        """
+        Stop writing to the console after writing the last frame and commit suicide.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _write_frame(self):
+        backlog = self._backlog
+        lines = [backlog.popleft() for _ in range(len(backlog))]
+        overflowed = self.overflowed - self._reported_overflowed
+        self._reported_overflowed += overflowed
+        if not lines and not overflowed:
+            return
+
+        suppressed = overflowed + max(0, len(lines) - self._lines_per_frame)
+        if suppressed:  # keep the latest lines, since these tell where the device is now
+            self.suppressed += suppressed
+            lines = [self.SUPPRESSED.format(suppressed).encode('ascii')] + lines[-self._lines_per_frame:]
+
+        started_at = time()
+        self._stream.write((b'\r\n'.join(lines) + b'\r\n').decode('utf8', 'replace'))
+        self._stream.flush()
+        write_time = time() - started_at
+
+        # shrink the frame if the terminal can not keep up and grow it back when it does
+        if write_time > self._frame_interval:
+            self._lines_per_frame = max(self.MIN_LINES_PER_FRAME, self._lines_per_frame // 2)
+        elif write_time < self._frame_interval / 2:
+            self._lines_per_frame = min(self._max_lines_per_frame, self._lines_per_frame * 2)
+
+    def run(self):
+        try:
+            while not self._stop_event.wait(self._frame_interval):
+                self._write_frame()
+            self._write_frame()
+        except Exception as e:  # this may occur if the console is gone
+            self.logger.error('Error: {}'.format(e))
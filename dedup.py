@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import re
+from collections import deque
+
+
+class RepeatRun(object):
+    """
+    The repeats counted of a line passed on by a LineCollapser, since the line or the last summary.
+    """
+    __slots__ = ('line', 'run_time', 'repeats', 'last_line', 'last_time')
+
+    def __init__(self, line, run_time):
+        self.line = line  # the line repeated
+        self.run_time = run_time  # the arrival time of the line repeated or of the last summary
+        self.repeats = 0
+        self.last_line = None
+        self.last_time = None
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__, self.line, self.run_time, self.repeats)
+
+
+class LineCollapser(object):
+    """
+    Collapses runs of repeated log lines, like a heartbeat or a retry error printed thousands of
+    times per second, into a line like '...previous line repeated 1234 times over 567 ms...'. The
+    first line of a run is passed on at once and the repeats are counted. The keys of the last
+    window lines passed on are kept with a count each, so lines taking turns, like two heartbeats
+    interleaved, are collapsed too. The summaries are passed on in the order of their last repeats,
+    with the arrival time of the last repeat, when a line not in the window arrives, or every
+    max_interval seconds while the runs go on, so lines stay in order with correct timestamps. A
+    summary of a line other than the last line passed on ends with the line.
+    Lines are compared by the hash of their key and then by the key itself. With mask_numbers,
+    numbers are masked in the key, so lines differing only in counters or addresses are repeats
+    too, and the last repeat is added to the summary. A line matching a rule is never collapsed.
+    Lines and summaries are bytes, so lines are compared without being decoded.
+    """
+    MAX_INTERVAL = 1.0
+    WINDOW = 4
+    REPEATED = '...previous line repeated {} times over {:.0f} ms...'
+    REPEATED_LAST = '...previous line repeated {} times over {:.0f} ms, last: '
+    REPEATED_EARLIER = '...earlier line repeated {} times over {:.0f} ms, last: '
+    NUMBERS = re.compile(br'0[xX][0-9a-fA-F]+|\d+')
+
+    def __init__(self, mask_numbers=False, max_interval=MAX_INTERVAL, window=WINDOW):
+        """
+        :param mask_numbers: Take lines differing only in numbers for repeats.
+        :param max_interval: The max number of seconds repeats are counted before a summary.
+        :param window: The number of lines passed on last whose repeats are counted.
+        """
+        self._mask_numbers = mask_numbers
+        self._max_interval = max_interval
+        self._window = window
+        self._runs = {}  # the RepeatRun of each key in the window
+        self._keys = deque()  # the keys in the window, the last line passed on last
+        self._run_time = None  # the arrival time of the last line passed on or of the last summary
+        self._repeats = 0
+        self.collapsed_lines = 0
+        self.summaries = 0
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                   self._mask_numbers,
+                                                   self._max_interval,
+                                                   self._window,
+                                                   self._repeats)
+
+    def _summarize_run(self, run, previous):
+        """
+        :return: The summary of the repeats counted of a run, or the repeat itself if only one.
+        """
+        if run.repeats == 1:
+            line = (run.last_line, run.last_time, ())
+        else:
+            milliseconds = (run.last_time - run.run_time) * 1e3
+            if not previous:
+                summary, last = self.REPEATED_EARLIER, run.last_line
+            elif run.last_line != run.line:
+                summary, last = self.REPEATED_LAST, run.last_line
+            else:
+                summary, last = self.REPEATED, b''
+            line = (summary.format(run.repeats, milliseconds).encode('ascii') + last, run.last_time, ())
+            self.collapsed_lines += run.repeats
+            self.summaries += 1
+        run.repeats = 0
+        run.run_time = run.last_time
+        return line
+
+    def _summarize(self):
+        """
+        :return: A list with the summaries of the repeats counted, in the order of their last
+                 repeats, see _summarize_run().
+        """
+        if not self._repeats:
+            return []
+        previous = self._runs[self._keys[-1]]
+        runs = sorted([run for run in self._runs.values() if run.repeats], key=lambda run: run.last_time)
+        lines = [self._summarize_run(run, run is previous) for run in runs]
+        self._repeats = 0
+        self._run_time = runs[-1].last_time
+        return lines
+
+    def feed(self, line, arrival_time, rule_names=()):
+        """
+        :param line: A log line as bytes without timestamp.
+        :param arrival_time: The monotonic time when the line arrived.
+        :param rule_names: The names of the rules matching the line.
+        :return: A list of (line, arrival_time, rule_names) to pass on, in order.
+        """
+        if rule_names:
+            lines = self.flush()
+            lines.append((line, arrival_time, rule_names))
+            return lines
+        key = self.NUMBERS.sub(b'#', line) if self._mask_numbers else line
+        run = self._runs.get(key)  # compared by hash and then by key
+        if run is not None:
+            run.repeats += 1
+            run.last_line = line
+            run.last_time = arrival_time
+            self._repeats += 1
+            if arrival_time - self._run_time >= self._max_interval:
+                return self._summarize()
+            return []
+        lines = self._summarize()
+        if len(self._keys) >= self._window:
+            del self._runs[self._keys.popleft()]
+        self._keys.append(key)
+        self._runs[key] = RepeatRun(line, arrival_time)
+        self._run_time = arrival_time
+        lines.append((line, arrival_time, ()))
+        return lines
+
+    def expire(self, now):
+        """
+        :param now: The current monotonic time.
+        :return: A list with the summaries of the repeats counted if max_interval has passed since
+                 the last line passed on or the last summary, see feed().
+        """
+        if self._repeats and now - self._run_time >= self._max_interval:
+            return self._summarize()
+        return []
+
+    def flush(self):
+        """
+        Ends the runs, e.g. when stopped.
+        :return: A list with the summaries of the repeats counted, see feed().
+        """
+        lines = self._summarize()
+        self._runs.clear()
+        self._keys.clear()
+        return lines
+
+    def stats(self):
+        """
+        :return: A dict with the number of lines collapsed into summaries and of summaries.
+        """
+        return {'collapsed_lines': self.collapsed_lines, 'repeat_summaries': self.summaries}
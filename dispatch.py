@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import logging
+from collections import deque
+from threading import Thread, Event, current_thread
+from time import time
+
+from observer import Observer
+
+
+class MailboxObserver(Observer):
+    """
+    Wraps an observer to deliver its updates on a thread of its own. An update only appends the
+    data to a bounded mailbox and never waits for the observer, so a slow observer cannot stall
+    the observable. Data not fitting in a full mailbox is dropped and counted.
+    The delivery latency and the backlog of the mailbox are measured and returned by stats().
+    """
+    MAILBOX_SIZE = 100000
+    WAIT_TMO = 0.5
+
+    def __init__(self, observer, mailbox_size=MAILBOX_SIZE):
+        """
+        :param observer: The observer to deliver updates to.
+        :param mailbox_size: The max number of updates waiting for delivery.
+        """
+        super(MailboxObserver, self).__init__(observer.name)
+        self._observer = observer
+        self._mailbox_size = mailbox_size
+        self._mailbox = deque()
+        self._mail_arrived = Event()
+        self._stop_event = Event()
+        self._worker = Thread(target=self._deliver, name='{}({})'.format(self.__class__.__name__, self.name))
+        self._worker.setDaemon(True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.dropped = 0
+        self.delivered = 0
+        self.errors = 0
+        self.backlog_high_water_mark = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._observer, self._mailbox_size)
+
+    @property
+    def observer(self):
+        """The wrapped observer."""
+        return self._observer
+
+    def start(self):
+        self._worker.start()
+
+    def stop(self):
+        """
+        Stop delivering when the mailbox is empty and let the worker thread terminate.
+        """
+        self._stop_event.set()
+        self._mail_arrived.set()
+        if self._worker.is_alive() and self._worker is not current_thread():
+            self._worker.join()
+
+    def update(self, data):
+        mailbox = self._mailbox
+        backlog = len(mailbox)
+        if backlog >= self._mailbox_size:
+            self.dropped += 1
+            return
+        mailbox.append((time(), data))  # deque appends are thread-safe
+        if backlog >= self.backlog_high_water_mark:
+            self.backlog_high_water_mark = backlog + 1
+        self._mail_arrived.set()
+
+    def stats(self):
+        """
+        :return: A dict with the backlog, its high water mark, the number of delivered, dropped
+                 and failed updates and the mean and max delivery latency in seconds.
+        """
+        delivered = self.delivered
+        return {'backlog': len(self._mailbox),
+                'backlog_high_water_mark': self.backlog_high_water_mark,
+                'delivered': delivered,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'latency_mean': self._latency_sum / delivered if delivered else 0.0,
+                'latency_max': self._latency_max}
+
+    def _deliver(self):
+        mailbox = self._mailbox
+        while True:
+            self._mail_arrived.clear()  # cleared before checking, so no arrival is missed
+            if not mailbox:
+                if self._stop_event.is_set():
+                    break
+                self._mail_arrived.wait(self.WAIT_TMO)
+                continue
+
+            while mailbox:
+                queued_at, data = mailbox.popleft()
+                latency = time() - queued_at
+                self._latency_sum += latency
+                if latency > self._latency_max:
+                    self._latency_max = latency
+                try:
+                    self._observer.update(data)
+                except Exception as e:  # an observer failing must not stop the delivery to it
+                    self.errors += 1
+                    self.logger.error('Error: {}: {}'.format(self.name, e))
+                self.delivered += 1
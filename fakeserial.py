@@ -1,19 +1,495 @@
 #!/usr/bin/env python
-from __future__ import print_function  # Remove when stepping up to python 3
 
+import io
 import logging
-from cStringIO import StringIO, InputType as StringIType
+import mmap
+import os
+import random
+from binascii import unhexlify
+from collections import deque
+from time import sleep, time
 
-from serial.serialutil import SerialBase, SerialException, portNotOpenError
+from serial.serialutil import SerialBase, SerialException
+try:
+    from serial.serialutil import PortNotOpenError  # pyserial 3.5+
+except ImportError:
+    class PortNotOpenError(SerialException):
+        def __init__(self):
+            super(PortNotOpenError, self).__init__('Attempting to use a port that is not open')
+
+from logquery import open_log_file
+from logrotation import SegmentArchiver
+from rawcapture import frames_path, read_frames
+from timestamp import split_stamp
+
+
+class TrafficGenerator(object):
+    """
+    Generates synthetic serial traffic for load testing, paced as if received at a baud rate.
+    Lines have lengths drawn from a distribution and a ratio of them are binary garbage. Traffic
+    may come in bursts, and faults like stalls, dropped bytes, timeouts in the middle of a line and
+    exceptions are injected by probability per line. The traffic is reproducible from the seed.
+
+    Line length distributions are given as tuples:
+    ('fixed', length), ('uniform', min, max), ('gauss', mean, sigma) or ('expo', mean).
+    """
+    BITS_PER_BYTE = 10  # start bit, 8 data bits and a stop bit
+    LOOKAHEAD = 0.05
+
+    def __init__(self,
+                 baudrate=115200,
+                 seed=None,
+                 line_lengths=('uniform', 20, 120),
+                 garbage_ratio=0.0,
+                 burst_on=None,
+                 burst_off=0.0,
+                 line_count=None,
+                 stall_probability=0.0,
+                 stall_duration=1.0,
+                 drop_probability=0.0,
+                 timeout_probability=0.0,
+                 timeout_duration=2.0,
+                 exception_probability=0.0):
+        """
+        :param baudrate: The baud rate pacing the traffic or None to generate it as fast as read.
+        :param seed: The seed of the random generator making the traffic reproducible.
+        :param line_lengths: The distribution of line lengths, see above.
+        :param garbage_ratio: The ratio of lines being binary garbage, 0.0 - 1.0.
+        :param burst_on: The number of seconds of traffic in a burst or None for no bursts.
+        :param burst_off: The number of seconds of silence between bursts.
+        :param line_count: The number of lines generated or None for no end.
+        :param stall_probability: The probability of a stall before a line.
+        :param stall_duration: The number of seconds of a stall.
+        :param drop_probability: The probability of bytes dropped from a line, as by an overrun.
+        :param timeout_probability: The probability of a pause in the middle of a line.
+        :param timeout_duration: The number of seconds of a pause in the middle of a line, which
+                                 should be longer than the port read timeout.
+        :param exception_probability: The probability of a SerialException raised before a line.
+        """
+        self._baudrate = baudrate
+        self._seed = seed
+        self._random = random.Random(seed)
+        self._line_lengths = line_lengths
+        self._garbage_ratio = garbage_ratio
+        self._burst_on = burst_on
+        self._burst_off = burst_off
+        self._line_count = line_count
+        self._stall_probability = stall_probability
+        self._stall_duration = stall_duration
+        self._drop_probability = drop_probability
+        self._timeout_probability = timeout_probability
+        self._timeout_duration = timeout_duration
+        self._exception_probability = exception_probability
+
+        self._segments = deque()  # (start time, end time, data or exception) in transmission order
+        self._offset = 0  # bytes of the first segment already read
+        self._stream_time = None  # when the generated traffic has been transmitted
+        self._start_time = None
+        self._lines_generated = 0
+        self.bytes_generated = 0
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                   self._baudrate,
+                                                   self._seed,
+                                                   self._line_lengths,
+                                                   self._garbage_ratio)
+
+    @property
+    def start_time(self):
+        """The time when the traffic started or None if not started. Line texts tell the seconds
+        since then when the line started to be transmitted."""
+        return self._start_time
+
+    def _line_length(self):
+        kind = self._line_lengths[0]
+        if kind == 'fixed':
+            length = self._line_lengths[1]
+        elif kind == 'uniform':
+            length = self._random.randint(self._line_lengths[1], self._line_lengths[2])
+        elif kind == 'gauss':
+            length = int(self._random.gauss(self._line_lengths[1], self._line_lengths[2]))
+        elif kind == 'expo':
+            length = int(self._random.expovariate(1.0 / self._line_lengths[1]))
+        else:
+            raise ValueError('unknown line length distribution {!r}'.format(kind))
+        return max(1, length)
+
+    def _make_line(self):
+        length = self._line_length()
+        if self._random.random() < self._garbage_ratio:
+            data = unhexlify('{:0{}x}'.format(self._random.getrandbits(8 * length), 2 * length))
+            return data.replace(b'\n', b'\x0b') + b'\n'
+        text = '[{:>12.6f}] generated line {}: '.format(self._stream_time - self._start_time,
+                                                      self._lines_generated)
+        return (text + 'x' * max(0, length - len(text))).encode('ascii') + b'\r\n'
+
+    def _transmit(self, data):
+        start_time = self._stream_time
+        if self._baudrate:
+            if self._burst_on is not None:  # skip silence between bursts
+                period = self._burst_on + self._burst_off
+                phase = (start_time - self._start_time) % period
+                if phase >= self._burst_on:
+                    start_time += period - phase
+            self._stream_time = start_time + len(data) * self.BITS_PER_BYTE / float(self._baudrate)
+        self._segments.append((start_time, self._stream_time, data))
+        self.bytes_generated += len(data)
+
+    def _pause(self, duration):
+        if self._baudrate:
+            self._stream_time += duration
+
+    def _generate(self, now, min_bytes):
+        """
+        Generates lines until covering the time now plus a look ahead, or min_bytes if unpaced.
+        """
+        if self._start_time is None:
+            self._start_time = self._stream_time = now
+        if not self._baudrate:  # unpaced lines are sent when generated for a read
+            self._stream_time = now
+        generated = 0
+        while ((self._line_count is None or self._lines_generated < self._line_count) and
+               (self._stream_time < now + self.LOOKAHEAD if self._baudrate else generated < min_bytes)):
+            rand = self._random.random
+            if rand() < self._exception_probability:
+                self._segments.append((self._stream_time, self._stream_time,
+                                       SerialException('injected fault')))
+            if rand() < self._stall_probability:
+                self._pause(self._stall_duration)
+            line = self._make_line()
+            if rand() < self._drop_probability:
+                start = self._random.randrange(len(line))
+                line = line[:start] + line[start + self._random.randint(1, 16):]
+            if rand() < self._timeout_probability and len(line) > 1:
+                middle = len(line) // 2
+                self._transmit(line[:middle])
+                self._pause(self._timeout_duration)
+                line = line[middle:]
+            self._transmit(line)
+            self._lines_generated += 1
+            generated += len(line)
+
+    def _available(self, now):
+        """
+        :return: The number of bytes transmitted by now, up to the next injected exception.
+        """
+        available = -self._offset
+        for start_time, end_time, data in self._segments:
+            if isinstance(data, Exception):
+                return max(available, 0) or (1 if start_time <= now else 0)
+            if end_time <= now:
+                available += len(data)
+            else:
+                if now > start_time:
+                    available += int(len(data) * (now - start_time) / (end_time - start_time))
+                break
+        return max(available, 0)
+
+    def _take(self, size):
+        chunks = []
+        while size and self._segments:
+            start_time, end_time, data = self._segments[0]
+            if isinstance(data, Exception):
+                if chunks:
+                    break
+                self._segments.popleft()
+                raise data
+            chunk = data[self._offset:self._offset + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._offset += len(chunk)
+            if self._offset == len(data):
+                self._segments.popleft()
+                self._offset = 0
+        return b''.join(chunks)
+
+    def in_waiting(self):
+        """
+        :return: The number of bytes received and not yet read.
+        """
+        now = time()
+        self._generate(now, 1)
+        return self._available(now) if self._baudrate else sum(len(data) for _, _, data in self._segments
+                                                               if not isinstance(data, Exception))
+
+    def read(self, size, timeout):
+        """
+        Reads up to size bytes, waiting for them until timeout.
+        :param size: The max number of bytes.
+        :param timeout: The max number of seconds to wait, or None to wait for all bytes.
+        :raises SerialException if a fault is injected.
+        """
+        deadline = None if timeout is None else time() + timeout
+        chunks = []
+        while size:
+            now = time()
+            self._generate(now, size)
+            available = self._available(now) if self._baudrate else size
+            chunk = self._take(min(size, available))
+            if chunk:
+                chunks.append(chunk)
+                size -= len(chunk)
+            elif not self._segments and self._line_count is not None and \
+                    self._lines_generated >= self._line_count:
+                break  # all lines generated are read
+            if not size or (deadline is not None and now >= deadline):
+                break
+            # sleep until the next byte is transmitted, but not beyond the timeout
+            wait = self.BITS_PER_BYTE / float(self._baudrate) if self._baudrate else 0
+            sleep(min(max(wait, 0.001), deadline - now) if deadline is not None else max(wait, 0.001))
+        return b''.join(chunks)
+
+    def readline(self, timeout):
+        """
+        Reads a line, waiting for it until timeout.
+        :param timeout: The max number of seconds to wait, or None to wait for a line.
+        :raises SerialException if a fault is injected.
+        """
+        deadline = None if timeout is None else time() + timeout
+        chunks = []
+        while True:
+            chunk = self.read(1, None if deadline is None else max(0, deadline - time()))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if chunk == b'\n':
+                break
+            waiting = self.in_waiting()
+            if waiting:  # read what is waiting up to the end of the line at once
+                start_time, end_time, data = self._segments[0]
+                if not isinstance(data, Exception):
+                    end = data.find(b'\n', self._offset)
+                    size = (end + 1 if end >= 0 else len(data)) - self._offset
+                    chunk = self._take(min(waiting, size))
+                    chunks.append(chunk)
+                    if chunk.endswith(b'\n'):
+                        break
+        return b''.join(chunks)
+
+
+class ReplaySource(object):
+    """
+    Replays a recorded session as serial traffic, so real captures are fed through the reader and
+    its observers again. The recording is a raw capture with its frames file, which is replayed
+    byte exact chunk by chunk, or a log file, optionally compressed like a rotated segment, which
+    is replayed line by line. The timestamps of a log file are stripped by default, so the lines
+    are timestamped again as they are replayed. Recordings are streamed, memory mapping plain log
+    files and reading compressed ones in chunks, and at most MAX_BUFFERED bytes are held, so any
+    size of recording is replayed in flat memory.
+
+    The data is received with the timing of the recording divided by the speed, i.e. 1.0 is real
+    time and 10.0 is ten times faster, or as fast as read if the speed is None. Lines without a
+    timestamp are received with the line before them. How many bytes and lines per second the
+    reader sustained and how far it fell behind the recording are returned by stats().
+    """
+    LOOKAHEAD = 0.05
+    MAX_BUFFERED = 64 * 1024
+
+    def __init__(self, recording_path, speed=1.0, strip_stamps=True, encoding='utf8'):
+        """
+        :param recording_path: The file path of a raw capture or a log file.
+        :param speed: The speed relative to the recording or None for as fast as read.
+        :param strip_stamps: Strip the timestamps of the lines of a log file.
+        :param encoding: The encoding of a log file.
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive or None')
+        self._recording_path = recording_path
+        self._speed = speed
+        self._strip_stamps = strip_stamps
+        self._encoding = encoding
+        self._records = self._read_records()
+        self._segments = deque()  # (due time, data) in recording order
+        self._buffered = 0
+        self._offset = 0  # bytes of the first segment already read
+        self._exhausted = False
+        self._first_time = None  # the recorded time of the first timed record
+        self._start_time = None
+        self._last_due = None
+        self._last_taken_at = None
+        self._max_lag = 0.0
+        self.bytes_replayed = 0
+        self.lines_replayed = 0
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._recording_path,
+                                             self._speed,
+                                             self._strip_stamps)
+
+    @property
+    def finished(self):
+        """True when all of the recording has been read."""
+        return self._exhausted and not self._segments
+
+    def _read_records(self):
+        """
+        :return: An iterator of (recorded time or None, data) of the chunks or lines recorded.
+        """
+        path = self._recording_path
+        if os.path.exists(frames_path(path)):
+            for record in read_frames(path):
+                yield record
+        elif path.endswith(tuple(SegmentArchiver.COMPRESSIONS.values())):
+            log_file = open_log_file(path)  # decompressed in chunks
+            try:
+                for line in log_file:
+                    yield self._parse(line)
+            finally:
+                log_file.close()
+        else:
+            with io.open(path, 'rb') as log_file:
+                if not os.fstat(log_file.fileno()).st_size:
+                    return
+                mapped = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    start, size = 0, len(mapped)
+                    while start < size:
+                        end = mapped.find(b'\n', start)
+                        end = size if end < 0 else end + 1
+                        yield self._parse(mapped[start:end])
+                        start = end
+                finally:
+                    mapped.close()
+
+    def _parse(self, line):
+        stamp_time, text = split_stamp(line.decode(self._encoding, 'replace'))
+        if stamp_time is None or not self._strip_stamps:
+            return stamp_time, line
+        return stamp_time, text.encode(self._encoding)
+
+    def _load(self, now):
+        """
+        Loads records until covering the time now plus a look ahead, or MAX_BUFFERED bytes.
+        """
+        if self._start_time is None:
+            self._start_time = self._last_due = now
+        while (not self._exhausted and self._buffered < self.MAX_BUFFERED and
+               (not self._segments or self._segments[-1][0] <= now + self.LOOKAHEAD)):
+            try:
+                recorded_time, data = next(self._records)
+            except StopIteration:
+                self._exhausted = True
+                break
+            if recorded_time is not None and self._first_time is None:
+                self._first_time = recorded_time
+            due = self._last_due
+            if self._speed is not None and recorded_time is not None:  # never before the line before
+                due = max(due, self._start_time + (recorded_time - self._first_time) / self._speed)
+            self._last_due = due
+            self._segments.append((due, data))
+            self._buffered += len(data)
+
+    def _available(self, now):
+        """
+        :return: The number of bytes received by now.
+        """
+        available = -self._offset
+        for due, data in self._segments:
+            if due > now:
+                break
+            available += len(data)
+        return max(available, 0)
+
+    def _take(self, size, now, line):
+        chunks = []
+        while size and self._segments and self._segments[0][0] <= now:
+            due, data = self._segments[0]
+            end = self._offset + size
+            if line:  # up to the end of the line
+                newline = data.find(b'\n', self._offset, end)
+                if newline >= 0:
+                    end = newline + 1
+            chunk = data[self._offset:end]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._offset += len(chunk)
+            self._max_lag = max(self._max_lag, now - due)
+            if self._offset == len(data):
+                self._segments.popleft()
+                self._buffered -= len(data)
+                self._offset = 0
+            if line and chunk.endswith(b'\n'):
+                break
+        data = b''.join(chunks)
+        if data:
+            self.bytes_replayed += len(data)
+            self.lines_replayed += data.count(b'\n')
+            self._last_taken_at = now
+        return data
+
+    def _receive(self, size, timeout, line):
+        deadline = None if timeout is None else time() + timeout
+        chunks = []
+        while size:
+            now = time()
+            self._load(now)
+            chunk = self._take(size, now, line)
+            if chunk:
+                chunks.append(chunk)
+                size -= len(chunk)
+                if line and chunk.endswith(b'\n'):
+                    break
+            elif self.finished:
+                break  # all of the recording is read
+            if not size or (deadline is not None and now >= deadline):
+                break
+            # sleep until the next record is due, but not beyond the timeout
+            wait = self._segments[0][0] - now if self._segments else 0
+            sleep(min(max(wait, 0.001), deadline - now) if deadline is not None else max(wait, 0.001))
+        return b''.join(chunks)
+
+    def in_waiting(self):
+        """
+        :return: The number of bytes received and not yet read.
+        """
+        now = time()
+        self._load(now)
+        return self._available(now)
+
+    def read(self, size, timeout):
+        """
+        Reads up to size bytes, waiting for them until timeout.
+        :param size: The max number of bytes.
+        :param timeout: The max number of seconds to wait, or None to wait for all bytes.
+        """
+        return self._receive(size, timeout, False)
+
+    def readline(self, timeout):
+        """
+        Reads a line, waiting for it until timeout.
+        :param timeout: The max number of seconds to wait, or None to wait for a line.
+        """
+        return self._receive(self.MAX_BUFFERED, timeout, True)
+
+    def stats(self):
+        """
+        :return: A dict with the number of bytes and lines replayed, the seconds from the start
+                 of the replay until the last bytes were read, the bytes and lines per second
+                 sustained meanwhile, the max seconds a read fell behind the recording and whether
+                 all of the recording has been read.
+        """
+        seconds = self._last_taken_at - self._start_time if self._last_taken_at is not None else 0.0
+        return {'bytes_replayed': self.bytes_replayed,
+                'lines_replayed': self.lines_replayed,
+                'seconds': seconds,
+                'bytes_per_second': self.bytes_replayed / seconds if seconds else 0.0,
+                'lines_per_second': self.lines_replayed / seconds if seconds else 0.0,
+                'max_lag_seconds': self._max_lag,
+                'finished': self.finished}
 
 
 class Serial(SerialBase):
     """
        Fake Serial port implementation useful for development in cases you want to run tests
        without hardware, but also for the purposes of fault injection in automatic tests.
+       The fake data is either a fixed io.BytesIO text, traffic from a TrafficGenerator or a
+       recorded session replayed by a ReplaySource. Data is read as bytes, as from a real port.
     """
 
     _fake_serial_data = None
+    is_open = False  # set by SerialBase of pyserial 3, but not of pyserial 2
     logger = None
 
     @classmethod
@@ -21,10 +497,10 @@ class Serial(SerialBase):
         """
         Only for injecting fake I/O text data for testing purposes.
         :param fake_serial_stream: Fake serial logging data for testing purposes.
-        :type cStringIO.cStringIO
+        :type io.BytesIO, TrafficGenerator or ReplaySource
         """
-        if not isinstance(fake_serial_stream, StringIType):
-            raise TypeError('fake_serial_stream needs to be of type cStringIO!')
+        if not isinstance(fake_serial_stream, (io.BytesIO, TrafficGenerator, ReplaySource)):
+            raise TypeError('fake_serial_stream needs to be of type io.BytesIO, TrafficGenerator or ReplaySource!')
         Serial._fake_serial_data = fake_serial_stream
         cls.logger = logging.getLogger(cls.__class__.__name__)
 
@@ -32,23 +508,25 @@ class Serial(SerialBase):
         """Read size bytes from the serial port. If a timeout is set it may
         return less characters as requested. With no timeout it will block
         until the requested number of bytes is read."""
-        if not self.isOpen:
-            raise portNotOpenError
-        data = Serial._fake_serial_data.read(size)
-        return bytes(data)
+        if not self.is_open:
+            raise PortNotOpenError()
+        if isinstance(Serial._fake_serial_data, (TrafficGenerator, ReplaySource)):
+            return Serial._fake_serial_data.read(size, self.timeout)
+        return Serial._fake_serial_data.read(size)
 
     def readline(self):
-        if not self.isOpen:
-            raise portNotOpenError
-        data = Serial._fake_serial_data.readline()  # timeout can be ignored with StringIO text
-        return str(bytes(data))
+        if not self.is_open:
+            raise PortNotOpenError()
+        if isinstance(Serial._fake_serial_data, (TrafficGenerator, ReplaySource)):
+            return Serial._fake_serial_data.readline(self.timeout)
+        return Serial._fake_serial_data.readline()  # timeout can be ignored with BytesIO text
 
     def write(self, data):
         """Output the given string over the serial port. Can block if the
         connection is blocked. May raise SerialException if the connection is
         closed."""
-        if not self.isOpen:
-            raise portNotOpenError
+        if not self.is_open:
+            raise PortNotOpenError()
         # nothing done
         return len(data)
 
@@ -77,77 +555,81 @@ class Serial(SerialBase):
 
     #  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
 
+    @property
+    def in_waiting(self):
+        """Return the number of characters currently in the input buffer."""
+        if not self.is_open: raise PortNotOpenError()
+        if isinstance(Serial._fake_serial_data, (TrafficGenerator, ReplaySource)):
+            return Serial._fake_serial_data.in_waiting()
+        return len(Serial._fake_serial_data.getvalue()) - Serial._fake_serial_data.tell()
+
     def inWaiting(self):
         """Return the number of characters currently in the input buffer."""
-        if not self.isOpen: raise portNotOpenError
-        if self.logger:
-            # set this one to debug as the function could be called often...
-            self.logger.debug('WARNING: inWaiting returns dummy value')
-        return 0 # hmmm, see comment in read()
+        return self.in_waiting
 
     def flushInput(self):
         """Clear input buffer, discarding all that is in the buffer."""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('ignored flushInput')
 
     def flushOutput(self):
         """Clear output buffer, aborting the current output and
         discarding all that is in the buffer."""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('ignored flushOutput')
 
     def sendBreak(self, duration=0.25):
         """Send break condition. Timed, returns to idle state after given
         duration."""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('ignored sendBreak({!r})'.format(duration))
 
     def setBreak(self, level=True):
         """Set break: Controls TXD. When active, to transmitting is
         possible."""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('ignored setBreak({!r})'.format(level))
 
     def setRTS(self, level=True):
         """Set terminal status line: Request To Send"""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('ignored setRTS({!r})'.format(level))
 
     def setDTR(self, level=True):
         """Set terminal status line: Data Terminal Ready"""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('ignored setDTR({!r})'.format(level))
 
     def getCTS(self):
         """Read terminal status line: Clear To Send"""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('returning dummy for getCTS()')
         return True
 
     def getDSR(self):
         """Read terminal status line: Data Set Ready"""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('returning dummy for getDSR()')
         return True
 
     def getRI(self):
         """Read terminal status line: Ring Indicator"""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('returning dummy for getRI()')
         return False
 
     def getCD(self):
         """Read terminal status line: Carrier Detect"""
-        if not self.isOpen: raise portNotOpenError
+        if not self.is_open: raise PortNotOpenError()
         if self.logger:
             self.logger.info('returning dummy for getCD()')
         return True
@@ -161,7 +643,7 @@ class Serial(SerialBase):
 # library, derive from io.RawIOBase
 
 # A fake log for testing purposes
-FAKE_LOG = StringIO(r"""
+FAKE_LOG = io.BytesIO(br"""
 [DEVAPC] sec_post_init
 [DEVAPC] platform_sec_post_init - SMC call to ATF from LK
 DRAM Rank :2
@@ -1,93 +1,500 @@
 #!/usr/bin/env python
 
+import io
 import logging
+import os
 
 from threading import Thread, Event
-from Queue import Queue, Empty as QueueEmpty
-import codecs
+from time import time
+
+from linequeue import LineQueue, LostLines
+from logindex import IndexWriter, LogIndex, index_path
+from logrotation import SegmentArchiver
+from metrics import Histogram
+from timestamp import monotonic
+
+
+class FlushPolicy(object):
+    """
+    Decides when buffered log lines are written and flushed to disk. Buffered data is flushed as
+    soon as any of the limits is reached, and a limit set to None is not checked. This bounds what
+    may be lost on a power cut to max_bytes, max_lines or max_latency seconds of log lines if fsync
+    is set. Without fsync, the flushed data may still be held in the OS page cache. With only
+    fsync_on_rotate set, each closed segment is committed to the disk before it is archived.
+    """
+    MAX_BYTES = 64 * 1024
+    MAX_LINES = 1000
+    MAX_LATENCY = 0.5
+
+    def __init__(self, max_bytes=MAX_BYTES, max_lines=MAX_LINES, max_latency=MAX_LATENCY, fsync=False,
+                 fsync_on_rotate=False):
+        """
+        :param max_bytes: Flush when this number of bytes is buffered.
+        :param max_lines: Flush when this number of lines is buffered.
+        :param max_latency: Flush when the oldest buffered line is this number of seconds old.
+        :param fsync: Call fsync after each flush to commit the data to the disk.
+        :param fsync_on_rotate: Call fsync before the log file is closed for rotation.
+        """
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.max_latency = max_latency
+        self.fsync = fsync
+        self.fsync_on_rotate = fsync_on_rotate
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                         self.max_bytes,
+                                                         self.max_lines,
+                                                         self.max_latency,
+                                                         self.fsync,
+                                                         self.fsync_on_rotate)
+
+    def is_due(self, buffered_bytes, buffered_lines, buffered_since, now):
+        """
+        :param buffered_bytes: The number of bytes buffered.
+        :param buffered_lines: The number of lines buffered.
+        :param buffered_since: The time when the oldest buffered line was added.
+        :param now: The current time.
+        :return: True if the buffered data should be flushed.
+        """
+        return ((self.max_bytes is not None and buffered_bytes >= self.max_bytes) or
+                (self.max_lines is not None and buffered_lines >= self.max_lines) or
+                (self.max_latency is not None and now - buffered_since >= self.max_latency))
+
+
+class LogFile(object):
+    """
+    A log file that joins batches of log lines, which are bytes, at once and buffers them until
+    its flush policy decides to write them to disk with a single write call.
+    With a rotation policy, the log file is renamed to a segment handed to the archiver when the
+    policy says so, and a new log file is opened. An existing log file is then not truncated when
+    opened, but rotated first.
+    With an index policy, a sidecar index mapping line numbers and capture times to byte offsets
+    is written next to the log file and renamed with it when rotated, see IndexWriter. Line numbers
+    then continue from the log file of a previous run.
+    How long writes take and how long lines wait in the buffer are measured, see stats().
+    """
+
+    def __init__(self, log_file_path, flush_policy=None, rotation_policy=None, archiver=None,
+                 index_policy=None):
+        """
+        :param log_file_path: The file path to write log lines to.
+        :param flush_policy: A FlushPolicy deciding when to flush. A default policy if None.
+        :param rotation_policy: A RotationPolicy deciding when to rotate or None to never rotate.
+        :param archiver: A SegmentArchiver naming and archiving segments. Required for rotation.
+        :param index_policy: An IndexPolicy deciding which lines to index or None for no index.
+        """
+        if rotation_policy is not None and archiver is None:
+            raise ValueError('rotation_policy requires an archiver')
+        self._log_file_path = log_file_path
+        self._flush_policy = flush_policy if flush_policy is not None else FlushPolicy()
+        self._rotation_policy = rotation_policy
+        self._archiver = archiver
+        self._index_policy = index_policy
+        self._index = None
+        self._line_number = 0  # of the next line written
+        self._last_indexed_line = None
+        self._last_indexed_time = None
+        self._last_capture_time = None
+        self._file = None
+        self._file_bytes = 0
+        self._opened_at = None
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_lines = 0
+        self._buffered_since = None
+
+        self.lines_written = 0
+        self.bytes_written = 0
+        self.rotations = 0
+        self._write_latency = Histogram()
+        self._flush_delay = Histogram()
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                   self._log_file_path,
+                                                   self._flush_policy,
+                                                   self._rotation_policy,
+                                                   self._index_policy)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        if self._rotation_policy is not None and os.path.exists(self._log_file_path):
+            if self._index_policy is not None:  # continue the line numbers of a previous run
+                self._line_number = self._count_lines()
+            if os.path.getsize(self._log_file_path):
+                self._archive()  # keep the log file of a previous run
+        self._file = io.open(self._log_file_path, 'wb', buffering=0)
+        self._file_bytes = 0
+        self._opened_at = time()
+        if self._index_policy is not None:
+            self._index = IndexWriter(index_path(self._log_file_path))
+            self._index.open()
+            self._last_indexed_line = None
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._write_buffer()
+                self._close_index()
+            finally:
+                self._file.close()
+                self._file = None
+
+    def write_lines(self, lines, capture_times=None):
+        """
+        Joins the log lines into one buffer and flushes if the flush policy says so.
+        :param lines: A list of log lines as bytes without end line characters.
+        :param capture_times: A list of the capture times of the lines in seconds since the epoch,
+                              used for the index. The current time if None.
+        """
+        if self._index is None:
+            data = [b'\n'.join(lines) + b'\n']
+        else:
+            data = self._join_indexed(lines, capture_times)
+        now = time()
+        if self._buffered_since is None:
+            self._buffered_since = now
+        self._buffer.extend(data)
+        self._buffered_bytes += sum(len(piece) for piece in data)
+        self._buffered_lines += len(lines)
+        self.flush_if_due(now)
+
+    def _join_indexed(self, lines, capture_times):
+        """
+        Joins the log lines in pieces split at the lines to be indexed, so the offsets of these
+        are known, and adds the index records.
+        :return: A list of the pieces.
+        """
+        if capture_times is None:
+            capture_times = [time()] * len(lines)
+        line_count = len(lines)
+        offset = self._file_bytes + self._buffered_bytes
+        pieces = []
+        start = search_start = 0
+        while True:
+            if self._last_indexed_line is None:  # the first line of a log file is always indexed
+                due = 0
+            else:
+                due = self._index_policy.next_due(capture_times, search_start,
+                                                  self._last_indexed_line - self._line_number,
+                                                  self._last_indexed_time)
+            if due > start:
+                piece = b'\n'.join(lines[start:due]) + b'\n'
+                pieces.append(piece)
+                offset += len(piece)
+                start = due
+            if due >= line_count:
+                break
+            self._index.add(self._line_number + due, capture_times[due], offset)
+            self._last_indexed_line = self._line_number + due
+            self._last_indexed_time = capture_times[due]
+            search_start = due + 1
+        self._line_number += line_count
+        self._last_capture_time = capture_times[-1]
+        return pieces
+
+    def _count_lines(self):
+        """
+        :return: The number of lines of the log file of a previous run, counted from its index.
+        """
+        if not os.path.exists(index_path(self._log_file_path)):
+            return 0
+        with LogIndex(index_path(self._log_file_path)) as log_index:
+            if not len(log_index):
+                return 0
+            line_number, _, offset = log_index[-1]
+        with io.open(self._log_file_path, 'rb') as log_file:  # lines after the last record
+            log_file.seek(offset)
+            return line_number + sum(chunk.count(b'\n') for chunk in iter(lambda: log_file.read(65536), b''))
+
+    def _close_index(self):
+        if self._index is not None:
+            self._index.close(self._line_number,
+                              self._last_capture_time if self._last_capture_time is not None else time(),
+                              self._file_bytes)
+            self._index = None
+
+    def stats(self):
+        """
+        :return: A dict with the number of lines and bytes written, the number of rotations, the
+                 lines and bytes buffered, a histogram of the seconds each write and fsync took and
+                 a histogram of the seconds the oldest buffered line waited until written.
+        """
+        return {'lines_written': self.lines_written,
+                'bytes_written': self.bytes_written,
+                'rotations': self.rotations,
+                'buffered_lines': self._buffered_lines,
+                'buffered_bytes': self._buffered_bytes,
+                'write_latency_seconds': self._write_latency,
+                'flush_delay_seconds': self._flush_delay}
+
+    def flush_if_due(self, now=None):
+        """
+        Flushes the buffered data if the flush policy says so, and rotates if the rotation policy
+        says so.
+        :param now: The current time or None to read the clock.
+        """
+        now = time() if now is None else now
+        if self._buffered_since is not None and self._flush_policy.is_due(self._buffered_bytes,
+                                                                          self._buffered_lines,
+                                                                          self._buffered_since,
+                                                                          now):
+            self.flush()
+        elif self._is_rotation_due(now):
+            self.rotate()
+
+    def time_to_flush(self, default):
+        """
+        :param default: The time returned if nothing needs to be flushed in time.
+        :return: The number of seconds until the buffered data is due by its max latency or the
+                 log file is due to be rotated by its interval.
+        """
+        deadlines = []
+        if self._buffered_since is not None and self._flush_policy.max_latency is not None:
+            deadlines.append(self._buffered_since + self._flush_policy.max_latency)
+        if self._file_bytes and self._rotation_policy is not None and self._rotation_policy.interval is not None:
+            deadlines.append(self._opened_at + self._rotation_policy.interval)
+        if not deadlines:
+            return default
+        return max(0, min(default, min(deadlines) - time()))
+
+    def flush(self):
+        """
+        Writes all buffered data to the file at once and calls fsync if the policy says so.
+        Rotates afterwards if the rotation policy says so.
+        """
+        self._write_buffer()
+        if self._is_rotation_due(time()):
+            self.rotate()
+
+    def rotate(self):
+        """
+        Closes the log file, renames it to a segment to be archived and opens a new log file.
+        """
+        self._write_buffer()
+        if self._flush_policy.fsync_on_rotate and not self._flush_policy.fsync:
+            os.fsync(self._file.fileno())
+        self._close_index()
+        self._file.close()
+        self._file = None
+        self._archive()
+        self.rotations += 1
+        self.open()
+
+    def _is_rotation_due(self, now):
+        return (self._rotation_policy is not None and self._file_bytes and
+                self._rotation_policy.is_due(self._file_bytes, self._opened_at, now))
+
+    def _archive(self):
+        segment_path = self._archiver.segment_path()
+        os.rename(self._log_file_path, segment_path)  # atomic on POSIX
+        if os.path.exists(index_path(self._log_file_path)):
+            os.rename(index_path(self._log_file_path), index_path(segment_path))
+        self._archiver.add(segment_path)
+
+    def _write_buffer(self):
+        if self._buffer:
+            started_at = monotonic()
+            data = b''.join(self._buffer)
+            view = memoryview(data)
+            while view:  # an unbuffered write may be partial
+                view = view[self._file.write(view):]
+            if self._flush_policy.fsync:
+                os.fsync(self._file.fileno())
+            self._write_latency.observe(monotonic() - started_at)
+            self._flush_delay.observe(max(0.0, time() - self._buffered_since))
+            self._file_bytes += len(data)
+            self.bytes_written += len(data)
+            self.lines_written += self._buffered_lines
+            self._buffer = []
+            self._buffered_bytes = 0
+            self._buffered_lines = 0
+            self._buffered_since = None
+            if self._index is not None:  # written after the lines, so it never points past these
+                self._index.write(self._flush_policy.fsync)
 
 
 class FileWriter(Thread):
     """
     This thread reads log lines from a queue and writes these to a file passed as log_file_path.
-    The log line queue is filled with new log lines by calling put().
+    The log line queue is filled with new log lines by calling put(), as bytes, which are written
+    as they are, or as text, which is encoded.
     Thread quits if stop() is called. If an exception is raised when writing to file, this thread
     will callback to its owner to stop operation.
     Setting the read_queue_timer for reading the queue determine the responsiveness to stop call
     and is optional.
+    All pending log lines are taken from the queue at once and written as one buffer. The flush
+    policy decides when these buffers are written to disk. Lines still queued when stopped are
+    written before the file is closed.
+    The queue may be bounded by queue_capacity, in which case the overflow policy decides what
+    happens when it is full, see LineQueue. A marker line is written where log lines were dropped.
+    With a rotation policy, closed segments are compressed and retained by an archiver thread
+    started and stopped with this thread.
+    With an index policy, log lines are queued with their capture times, which are recorded in the
+    sidecar index of the log file.
+    The queue depth, drops and write latencies are returned by stats().
     """
     READ_NEW_LOGLINE_TMO = 0.5
+    LOST_LINES_MARKER = u'*** {} log lines ({} bytes) lost ***'
 
     def __init__(self,
                  log_file_path,
                  callback,
                  read_queue_timeout=READ_NEW_LOGLINE_TMO,
-                 encoding='utf8'):
+                 encoding='utf8',
+                 flush_policy=None,
+                 queue_capacity=None,
+                 overflow_policy=LineQueue.BLOCK,
+                 rotation_policy=None,
+                 archiver=None,
+                 index_policy=None):
         """
         :param log_file_path: The file path to write log lines to.
         :param callback: A callback method for calling back to application when error occurs.
         :param read_queue_timeout: The read timeout to avoid blocking.
-        :param encoding: The encoding format when writing to file.
+        :param encoding: The encoding of log lines put as text.
+        :param flush_policy: A FlushPolicy deciding when to flush to disk. A default policy if None.
+        :param queue_capacity: The max number of queued log lines or None for no limit.
+        :param overflow_policy: What to do with log lines put to a full queue, see LineQueue.
+        :param rotation_policy: A RotationPolicy deciding when to rotate or None to never rotate.
+        :param archiver: A SegmentArchiver for compression and retention of rotated segments. One
+                         without compression and retention limits is used if None.
+        :param index_policy: An IndexPolicy deciding which lines to index or None for no index.
         """
         super(FileWriter, self).__init__(name = self.__class__.__name__)
         self._read_queue_timeout = read_queue_timeout
         self._log_file_path = log_file_path
         self._encoding = encoding
+        self._flush_policy = flush_policy if flush_policy is not None else FlushPolicy()
+        self._rotation_policy = rotation_policy
+        if rotation_policy is not None and archiver is None:
+            archiver = SegmentArchiver(log_file_path)
+        self._archiver = archiver
+        self._index_policy = index_policy
+        self._log_file = None
 
         self.setDaemon(True)
-        self._log_line_queue = Queue()
-        self._stop = Event()
+        self._log_line_queue = LineQueue(queue_capacity, overflow_policy)
+        self._stop_event = Event()
         self.logger = logging.getLogger(self.__class__.__name__)
         self._callback = callback
-        codecs.register_error('backslashreplace', self.backslash_replace)
 
     def __repr__(self):
-        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
-                                                   self.getName(),
-                                                   self._read_queue_timeout,
-                                                   self._log_file_path,
-                                                   self._encoding)
+        return '{}({!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                               self.getName(),
+                                                               self._read_queue_timeout,
+                                                               self._log_file_path,
+                                                               self._encoding,
+                                                               self._flush_policy,
+                                                               self._rotation_policy)
+
+    def put(self, log_line, capture_time=None):
+        """
+        Puts a log line to the queue to be written to the specified file for logging.
+        :param log_line: A log line as bytes, or as text, which is encoded, to be written to file.
+        :param capture_time: The time when the line was captured in seconds since the epoch, used
+                             for the index. The current time if None.
+        """
+        if not isinstance(log_line, bytes):
+            log_line = log_line.encode(self._encoding, 'backslashreplace')
+        if self._index_policy is not None:  # LineQueue calls are thread-safe
+            self._log_line_queue.put((log_line, capture_time if capture_time is not None else time()))
+        else:
+            self._log_line_queue.put(log_line)
+
+    @property
+    def dropped_lines(self):
+        """The number of log lines dropped since the queue was full or the writer stopped."""
+        return self._log_line_queue.dropped_lines
 
-    def put(self, text_line):
+    @property
+    def dropped_bytes(self):
+        """The number of bytes of the dropped log lines."""
+        return self._log_line_queue.dropped_bytes
+
+    def stats(self):
         """
-        Puts a text line to the text queue to be written to the specified file for logging.
-        :param text_line: A text line to be written to file.
+        :return: A dict with the queue depth and its high water mark, the number of dropped lines
+                 and bytes and the stats of the log file, see LogFile.stats().
         """
-        self._log_line_queue.put(text_line)  # Queue calls are thread-safe
+        stats = {'queue_depth': len(self._log_line_queue),
+                 'queue_high_water_mark': self._log_line_queue.high_water_mark,
+                 'dropped_lines': self.dropped_lines,
+                 'dropped_bytes': self.dropped_bytes}
+        if self._log_file is not None:
+            stats.update(self._log_file.stats())
+        return stats
 
     def stop(self):
         """
         Stop writing to a log file from the internal queue and commit suicide.
         """
-        self._stop.set()
+        self._stop_event.set()
+        self._log_line_queue.close()  # releases a producer blocked on a full queue
         self.logger.debug('writer stopped')
         if self.is_alive():
             self.join()
         self.logger.debug('writer has terminated')
 
-    @staticmethod
-    def backslash_replace(error):
+    def _get_lines(self, timeout):
         """
-        An error handler to be called if escape characters are read from the log line queue input.
+        Waits for a log line and takes all log lines pending in the queue at once. Markers of
+        dropped log lines are turned into marker lines.
+        :param timeout: The max number of seconds to wait for a log line.
+        :return: A list of log lines which is empty if timed out and a list of their capture times
+                 which is None if not indexing.
         """
-        return u"".join([u"\\x{:x}".format(ord(error.object[i]))
-                         for i in range(error.start, error.end)]), error.end
+        # timeout avoids blocking in order to be responsive to stop calls
+        lines = self._log_line_queue.get_batch(timeout=timeout)
+        capture_times = [] if self._index_policy is not None else None
+        for i, line in enumerate(lines):
+            if isinstance(line, LostLines):
+                self.logger.warning('{} log lines lost'.format(line.line_count))
+                marker = self.LOST_LINES_MARKER.format(line.line_count, line.byte_count)
+                lines[i] = marker.encode(self._encoding)
+                if capture_times is not None:  # the marker takes the time of the line before it
+                    capture_times.append(capture_times[-1] if capture_times else time())
+            elif capture_times is not None:
+                lines[i], capture_time = line
+                capture_times.append(capture_time)
+        return lines, capture_times
 
     def run(self):
+        if self._archiver is not None:
+            self._archiver.start()
         try:
-            with codecs.open(self._log_file_path, 'wb', self._encoding) as log_file:
+            self._log_file = LogFile(self._log_file_path,
+                                     self._flush_policy,
+                                     self._rotation_policy,
+                                     self._archiver,
+                                     self._index_policy)
+            with self._log_file as log_file:
                 self.logger.info('start writing to file.')
 
-                while not self._stop.is_set():
-                    try:  # timeout avoids blocking in order to be responsive to stop calls
-                        log_line = self._log_line_queue.get(timeout=self._read_queue_timeout)
-                    except QueueEmpty:
-                        continue
+                while not self._stop_event.is_set():
+                    lines, capture_times = self._get_lines(log_file.time_to_flush(self._read_queue_timeout))
+                    if lines:
+                        log_file.write_lines(lines, capture_times)
                     else:
-                        self._log_line_queue.task_done()
-                        log_file.write(log_line + '\n')
-        except Exception as e:  # this may occur if codecs fails somehow
+                        log_file.flush_if_due()
+
+                while True:  # write what is left before closing, spilled lines too
+                    lines, capture_times = self._get_lines(0)
+                    if not lines:
+                        break
+                    log_file.write_lines(lines, capture_times)
+        except Exception as e:  # this may occur if writing fails somehow
             self.logger.error('Error: {}'.format(e))
             self._callback('{} has stopped running. error: {}'.format(self.getName(), str(e)))  # call back error
+        finally:
+            if self._archiver is not None:
+                self._archiver.stop()
 
         self.logger.info('stopped writing to file.')
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+import logging
+import os
+from collections import deque
+from os.path import splitext
+from threading import Thread, Event, Lock
+
+from observer import Observer
+
+from timestamp import monotonic
+
+
+class SnapshotWriter(Thread):
+    """
+    This thread writes a snapshot of a flight recorder and the log lines following it to a file,
+    so the reader never waits for the disk. The snapshot is written first, and snapshot_written is
+    set once it is, since it may be views of memory the flight recorder must not overwrite before.
+    The chunks put are written once per write interval. Thread quits after writing the chunks put
+    if finish() or stop() is called. If an exception is raised when writing to file, this thread
+    will callback to its owner.
+    """
+    WRITE_INTERVAL = 0.1
+
+    def __init__(self, snapshot_file_path, callback, snapshot, write_interval=WRITE_INTERVAL):
+        """
+        :param snapshot_file_path: The file path to write the snapshot to.
+        :param callback: A callback method for calling back to owner when error occurs.
+        :param snapshot: A list of bytes or memoryviews to write first.
+        :param write_interval: The number of seconds between writes.
+        """
+        super(SnapshotWriter, self).__init__(name = self.__class__.__name__)
+        self.setDaemon(True)
+        self._snapshot_file_path = snapshot_file_path
+        self._callback = callback
+        self._snapshot = snapshot
+        self._write_interval = write_interval
+        self._chunks = deque()
+        self._stop_event = Event()
+        self.snapshot_written = Event()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__,
+                                       self._snapshot_file_path,
+                                       self._write_interval)
+
+    def put(self, data):
+        """
+        :param data: Bytes to be written.
+        """
+        self._chunks.append(data)  # deque appends are thread-safe
+
+    def finish(self):
+        """
+        Stop writing after the chunks put are written, without waiting for it.
+        """
+        self._stop_event.set()
+
+    def stop(self):
+        """
+        Stop writing after the chunks put are written and commit suicide.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    @staticmethod
+    def _write_all(fd, chunks):
+        for chunk in chunks:
+            view = memoryview(chunk)
+            while view:  # a write may be partial
+                view = view[os.write(fd, view):]
+
+    def _write_chunks(self, fd):
+        chunks = self._chunks
+        taken = [chunks.popleft() for _ in range(len(chunks))]
+        if taken:
+            self._write_all(fd, [b''.join(taken)])
+
+    def run(self):
+        try:
+            fd = os.open(self._snapshot_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                self._write_all(fd, self._snapshot)
+                self._snapshot = None  # releases the views
+                self.snapshot_written.set()
+                while not self._stop_event.wait(self._write_interval):
+                    self._write_chunks(fd)
+                self._write_chunks(fd)
+            finally:
+                os.close(fd)
+        except Exception as e:  # this may occur if writing fails somehow
+            self.logger.error('Error: {}'.format(e))
+            self._callback('{} has stopped running. error: {}'.format(self.getName(), e))
+        finally:
+            self._snapshot = None
+            self.snapshot_written.set()  # never keeps the flight recorder waiting
+
+
+class FlightRecorder(Observer):
+    """
+    Intercepts log lines and keeps the latest capacity bytes of them in memory, so a long
+    unattended run costs no disk I/O until something goes wrong. The log lines are copied into a
+    ring buffer preallocated as one bytearray, where a write offset tells where the next line
+    goes and the oldest line is overwritten first, instead of keeping a Python object per line.
+    When triggered, by trigger(), e.g. from a signal handler, or by a line matching a trigger rule,
+    a snapshot of the ring is written to a file of its own, numbered after the snapshot file path,
+    e.g. snapshot-1.txt, by a SnapshotWriter. The snapshot is handed over as at most two
+    memoryviews of the ring, without copying it, and the log lines arriving until it is written
+    are held back from the ring, at most capacity bytes of them, the oldest being dropped and
+    counted like lines overwritten in the ring. The log lines arriving within post_trigger seconds
+    of the trigger are added to the snapshot, and a trigger within that window extends it.
+    """
+    CAPACITY = 16 * 1024 * 1024
+
+    def __init__(self, snapshot_file_path, callback, capacity=CAPACITY, post_trigger=0.0,
+                 trigger_rules=()):
+        """
+        :param snapshot_file_path: The file path the snapshots are numbered after.
+        :param callback: A callback method for calling back to application when error occurs.
+        :param capacity: The number of bytes of log lines kept.
+        :param post_trigger: The number of seconds of log lines added after a trigger.
+        :param trigger_rules: The names of the rules triggering a snapshot.
+        """
+        super(FlightRecorder, self).__init__(self.__class__.__name__)
+        self._snapshot_file_path = snapshot_file_path
+        self._callback = callback
+        self._capacity = capacity
+        self._post_trigger = post_trigger
+        self._trigger_rules = frozenset(trigger_rules)
+        self._ring = bytearray(capacity)
+        self._position = 0  # where the next line is written
+        self._wrapped = False
+        self._lock = Lock()  # triggers come from other threads
+        self._writer = None  # the writer adding the post trigger log lines
+        self._post_until = None
+        self._writers = []  # all writers not yet stopped
+        self._viewers = []  # the writers viewing the ring
+        self._held = deque()  # the log lines held back from the ring while viewed
+        self._held_bytes = 0
+        self.bytes_recorded = 0
+        self.held_lines_dropped = 0
+        self.snapshot_count = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                   self._snapshot_file_path,
+                                                   self._capacity,
+                                                   self._post_trigger,
+                                                   sorted(self._trigger_rules))
+
+    def snapshot_file_path(self, snapshot_number):
+        root, extension = splitext(self._snapshot_file_path)
+        return '{}-{}{}'.format(root, snapshot_number, extension)
+
+    def _record(self, data):
+        ring, capacity = self._ring, self._capacity
+        if len(data) >= capacity:  # only the end of a line longer than the ring
+            data = data[-capacity:]
+        size = len(data)
+        position = self._position
+        end = position + size
+        if end <= capacity:
+            ring[position:end] = data
+        else:  # wrap around
+            first = capacity - position
+            ring[position:] = data[:first]
+            ring[:size - first] = data[first:]
+            self._wrapped = True
+        self._position = end % capacity
+        if end == capacity:
+            self._wrapped = True
+        self.bytes_recorded += size
+
+    def _hold(self, data):
+        """
+        Holds back a log line, dropping the oldest lines held beyond capacity bytes, as
+        the ring would have overwritten them.
+        """
+        held = self._held
+        held.append(data)
+        self._held_bytes += len(data)
+        while self._held_bytes > self._capacity and len(held) > 1:
+            self._held_bytes -= len(held.popleft())
+            self.held_lines_dropped += 1
+
+    def _record_line(self, data):
+        """
+        Records a log line, or holds it back while the ring is viewed by a writer.
+        """
+        if self._viewers:
+            self._viewers = [writer for writer in self._viewers if not writer.snapshot_written.is_set()]
+            if self._viewers:
+                self._hold(data)
+                return
+            held, self._held, self._held_bytes = self._held, deque(), 0
+            for line in held:
+                self._record(line)
+        self._record(data)
+
+    def _views(self):
+        """
+        :return: A list of at most two memoryviews of the log lines kept, oldest first, starting at
+                 a whole line.
+        """
+        ring, position = memoryview(self._ring), self._position
+        if not self._wrapped:
+            return [ring[:position]]
+        start = self._ring.find(b'\n', position) + 1  # the oldest line is partly overwritten
+        if start:
+            return [ring[start:], ring[:position]]
+        return [ring[self._ring.find(b'\n', 0, position) + 1:position]]
+
+    def snapshot(self):
+        """
+        :return: The log lines kept as bytes, oldest first, starting at a whole line.
+        """
+        with self._lock:
+            return b''.join([view.tobytes() for view in self._views()] + list(self._held))
+
+    def trigger(self, reason='trigger'):
+        """
+        Writes a snapshot to a new file, or extends the post trigger window of a snapshot being
+        written. May be called from any thread.
+        :param reason: What triggered the snapshot, for logging.
+        """
+        now = monotonic()
+        with self._lock:
+            if self._writer is not None:
+                self._post_until = now + self._post_trigger
+                return
+            self.snapshot_count += 1
+            snapshot_file_path = self.snapshot_file_path(self.snapshot_count)
+            self.logger.info('{}: snapshot to {}'.format(reason, snapshot_file_path))
+            writer = SnapshotWriter(snapshot_file_path, self._callback,
+                                    self._views() + list(self._held))
+            self._writers = [running for running in self._writers if running.is_alive()]
+            self._writers.append(writer)
+            self._viewers.append(writer)
+            if self._post_trigger:
+                self._writer = writer
+                self._post_until = now + self._post_trigger
+        writer.start()
+        if not self._post_trigger:
+            writer.finish()
+
+    def _end_post_trigger(self):
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.finish()
+
+    def stop(self):
+        """
+        Stop the snapshots in progress after writing them. Called by the owner when stopping.
+        """
+        with self._lock:
+            writers, self._writers = self._writers, []
+            self._writer = None
+        for writer in writers:
+            writer.stop()
+
+    def stats(self):
+        """
+        :return: A dict with the number of bytes recorded, of snapshots and of held lines dropped.
+        """
+        return {'bytes_recorded': self.bytes_recorded,
+                'snapshots': self.snapshot_count,
+                'held_lines_dropped': self.held_lines_dropped}
+
+    def update(self, data):
+        log_line, arrival_time, rule_names = data  # data is a tuple
+        log_line += b'\n'
+        with self._lock:
+            self._record_line(log_line)
+            writer = self._writer
+        if writer is not None:
+            if arrival_time <= self._post_until:
+                writer.put(log_line)
+            else:
+                self._end_post_trigger()
+        if not self._trigger_rules.isdisjoint(rule_names):
+            self.trigger(u', '.join(sorted(self._trigger_rules.intersection(rule_names))))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+import struct
+
+from observer import Observable, Observer
+
+from serialreader import LineSplitter
+
+
+class Framer(Observable):
+    """
+    Finds binary frames of one protocol in a byte stream interleaved with text lines and updates
+    its registered observers with the payload of each frame as (payload, arrival_time). A frame
+    begins with the START marker. Subclasses parse and decode the frame following a marker with
+    slicing and bytes methods, without a loop per byte. A frame which fails to decode is dropped
+    and counted, and a frame not completed within max_length bytes is taken for text, so a
+    marker occurring in text or garbage only costs a resync from the byte after it.
+    """
+    START = b''
+    MAX_LENGTH = 64 * 1024
+    SHARED_DELIMITER = False  # whether the marker closing a frame may open the next one
+
+    def __init__(self, name, max_length=MAX_LENGTH):
+        """
+        :param name: The name of the frame type, e.g. 'slip'.
+        :param max_length: The max number of bytes of a frame including its framing.
+        """
+        Observable.__init__(self)
+        self.name = name
+        self.max_length = max_length
+        self.frames = 0
+        self.corrupt_frames = 0
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.name, self.max_length)
+
+    def parse(self, buf, start):
+        """
+        :param buf: A bytearray holding a START marker at start.
+        :param start: The position of the marker.
+        :return: (payload, end) of the frame ending before end, where payload is None if the
+                 frame is corrupt and b'' if it is empty, or (None, None) if not yet complete.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        :return: A dict with the number of frames found and dropped as corrupt.
+        """
+        return {'frames': self.frames, 'corrupt_frames': self.corrupt_frames}
+
+
+class SlipFramer(Framer):
+    """
+    Finds SLIP frames (RFC 1055), which are delimited by an END byte on both sides. END and ESC
+    bytes of the payload are escaped. The END byte closing a frame may open the next one. Frames
+    are short, so a stray END byte in text holds back little text.
+    """
+    END = b'\xc0'
+    ESC = b'\xdb'
+    ESC_END = b'\xdb\xdc'
+    ESC_ESC = b'\xdb\xdd'
+    START = END
+    MAX_LENGTH = 1024
+    SHARED_DELIMITER = True
+
+    def __init__(self, name='slip', max_length=MAX_LENGTH):
+        super(SlipFramer, self).__init__(name, max_length)
+
+    def parse(self, buf, start):
+        end = buf.find(self.END, start + 1)
+        if end < 0:
+            return None, None
+        if end == start + 1:  # back to back END bytes, the second one starts the frame
+            return b'', end
+        data = bytes(buf[start + 1:end])
+        if self.ESC in data:
+            escapes = data.count(self.ESC)
+            if escapes != data.count(self.ESC_END) + data.count(self.ESC_ESC):  # an invalid escape
+                return None, end
+            data = data.replace(self.ESC_END, self.END).replace(self.ESC_ESC, self.ESC)
+        return data, end  # the END byte may start the next frame
+
+
+class CobsFramer(Framer):
+    """
+    Finds COBS frames, consistent overhead byte stuffing, which are delimited by a zero byte on
+    both sides. A COBS payload has no zero bytes, and is decoded a block at a time. The zero byte
+    closing a frame may open the next one, as with a SlipFramer.
+    """
+    ZERO = b'\x00'
+    START = ZERO
+    MAX_LENGTH = 1024
+    SHARED_DELIMITER = True
+
+    def __init__(self, name='cobs', max_length=MAX_LENGTH):
+        super(CobsFramer, self).__init__(name, max_length)
+
+    def parse(self, buf, start):
+        end = buf.find(self.ZERO, start + 1)
+        if end < 0:
+            return None, None
+        if end == start + 1:  # back to back zero bytes, the second one starts the frame
+            return b'', end
+        encoded = bytes(buf[start + 1:end])
+        blocks = []
+        i, size = 0, len(encoded)
+        while i < size:
+            code = bytearray(encoded[i:i + 1])[0]
+            if i + code > size:  # a block running past the end of the frame
+                return None, end
+            blocks.append(encoded[i + 1:i + code])
+            i += code
+            if code < 0xff and i < size:
+                blocks.append(self.ZERO)
+        return b''.join(blocks), end  # the zero byte may start the next frame
+
+
+class LengthPrefixedFramer(Framer):
+    """
+    Finds frames of a magic marker followed by the length of the payload and the payload. A length
+    beyond max_length is taken for a marker occurring in other data.
+    """
+    MAGIC = b'\xa5\x5a'
+    LENGTH_FORMAT = '<H'
+
+    def __init__(self, name='length', magic=MAGIC, length_format=LENGTH_FORMAT,
+                 max_length=Framer.MAX_LENGTH):
+        """
+        :param name: The name of the frame type.
+        :param magic: The bytes starting a frame.
+        :param length_format: The struct format of the length following the magic.
+        :param max_length: The max number of bytes of a frame including its framing.
+        """
+        super(LengthPrefixedFramer, self).__init__(name, max_length)
+        self.START = magic
+        self._length = struct.Struct(length_format)
+        self._header_size = len(magic) + self._length.size
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                   self.name,
+                                                   self.START,
+                                                   self._length.format,
+                                                   self.max_length)
+
+    def parse(self, buf, start):
+        if len(buf) - start < self._header_size:
+            return None, None
+        length, = self._length.unpack_from(buf, start + len(self.START))
+        end = start + self._header_size + length
+        if end - start > self.max_length:
+            return None, start + 1  # resync from the byte after the marker
+        if len(buf) < end:
+            return None, None
+        return bytes(buf[start + self._header_size:end]), end
+
+
+FRAMERS = {'slip': SlipFramer, 'cobs': CobsFramer, 'length': LengthPrefixedFramer}
+
+
+class FrameSplitter(object):
+    """
+    Splits a stream of received chunks of bytes into binary frames and text lines. The stream is
+    searched for the START markers of the framers with find(), and each frame found is decoded and
+    updated to the observers of its framer. The bytes between frames are split into lines by a
+    LineSplitter, through a memoryview so they are not copied on the way, and a line interrupted
+    by a frame is continued after it. Bytes of a frame not yet complete are carried over to the
+    next chunk. A delimiter closing a frame opens the next one, unless the bytes following it hold
+    an end line before the next delimiter, so text following a frame is not taken for a frame.
+    """
+
+    def __init__(self, framers, max_line_length=LineSplitter.MAX_LINE_LENGTH):
+        """
+        :param framers: A list of Framers.
+        :param max_line_length: The max number of bytes buffered while waiting for an end line.
+        """
+        self.framers = framers
+        self._text = LineSplitter(max_line_length)
+        self._buffer = bytearray()
+        self._closing = -1  # the position of the delimiter closing the last frame in the buffer
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.framers, len(self._buffer))
+
+    def _next_start(self, buf, position):
+        """
+        :return: (position, framer) of the first START marker from the position or (-1, None).
+        """
+        first, first_framer = -1, None
+        for framer in self.framers:
+            start = buf.find(framer.START, position, first + len(framer.START) if first >= 0 else len(buf))
+            if start >= 0 and (first < 0 or start < first):
+                first, first_framer = start, framer
+        return first, first_framer
+
+    def feed(self, data, arrival_time):
+        """
+        Adds a chunk of bytes, updates the framers with the frames completed by it and returns the
+        lines completed by it.
+        :param data: A chunk of bytes read from the serial port.
+        :param arrival_time: The monotonic time when the chunk arrived.
+        :return: A list of lines as bytes without the end line character.
+        """
+        buf = self._buffer
+        buf.extend(data)
+        view = memoryview(buf)
+        lines = []
+        position, size = 0, len(buf)
+        try:
+            while position < size:
+                start, framer = self._next_start(buf, position)
+                if start < 0:
+                    lines.extend(self._text.feed(view[position:]))
+                    position = size
+                    break
+                if start > position:
+                    lines.extend(self._text.feed(view[position:start]))
+                if start == self._closing and self._text_follows(buf, start, framer):
+                    self._closing = -1  # not an opener, so the delimiter is dropped
+                    position = start + len(framer.START)
+                    continue
+                payload, end = framer.parse(buf, start)
+                if end is None:  # not complete yet
+                    if size - start <= framer.max_length:
+                        position = start
+                        break
+                    framer.corrupt_frames += 1  # never completed, so the marker is taken for text
+                    lines.extend(self._text.feed(view[start:start + 1]))
+                    position = start + 1
+                elif payload is None:
+                    framer.corrupt_frames += 1
+                    if end == start + 1:  # the marker is taken for text
+                        lines.extend(self._text.feed(view[start:end]))
+                    elif framer.SHARED_DELIMITER:
+                        self._closing = end
+                    position = end
+                else:
+                    if payload:
+                        framer.frames += 1
+                        framer.notify(payload, arrival_time)
+                    if framer.SHARED_DELIMITER:
+                        self._closing = end
+                    position = end
+        finally:
+            del view  # the buffer can not be resized while viewed
+        if position:
+            del buf[:position]  # carry over the partial frame only
+            self._closing -= position
+        return lines
+
+    @staticmethod
+    def _text_follows(buf, start, framer):
+        """
+        :return: True if the bytes following the delimiter at start hold an end line before the
+                 next delimiter, or before the end of the buffer if there is none yet.
+        """
+        following = buf.find(framer.START, start + 1)
+        return buf.find(b'\n', start + 1, following if following >= 0 else len(buf)) >= 0
+
+    def flush(self):
+        """
+        Returns any buffered partial frame, taken for text, and partial line and empties the buffers.
+        The delimiter closing the last frame is dropped.
+        :return: A list with the partial line, or an empty list if nothing is buffered.
+        """
+        if self._closing == 0:
+            del self._buffer[:1]
+        self._closing = -1
+        lines = self._text.feed(self._buffer)
+        del self._buffer[:]
+        return lines + self._text.flush()
+
+
+class FrameCapture(Observer):
+    """
+    Intercepts the frames of a framer and puts these to a RawCaptureWriter, so each frame is
+    written with its arrival time as a frame of the capture, see rawcapture.py --frames.
+    """
+
+    def __init__(self, raw_capture):
+        """
+        :param raw_capture: The RawCaptureWriter writing the frames.
+        """
+        super(FrameCapture, self).__init__(self.__class__.__name__)
+        self._raw_capture = raw_capture
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._raw_capture)
+
+    def update(self, data):
+        self._raw_capture.put(data[0], data[1])  # data is a tuple
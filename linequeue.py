@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import struct
+import tempfile
+from collections import deque
+from threading import Condition, Lock
+from time import time
+
+
+class LostLines(object):
+    """
+    A marker put in the line queue where log lines were dropped. Consecutive drops are merged into
+    one marker, so the markers never outnumber the queued log lines.
+    """
+    __slots__ = ('line_count', 'byte_count')
+
+    def __init__(self, line_count=0, byte_count=0):
+        self.line_count = line_count
+        self.byte_count = byte_count
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.line_count, self.byte_count)
+
+    def add(self, line_count, byte_count):
+        self.line_count += line_count
+        self.byte_count += byte_count
+
+
+class LineQueue(object):
+    """
+    A thread-safe FIFO queue of log lines as bytes with a bounded capacity. What happens when a
+    line is put to a full queue is decided by the overflow policy:
+    BLOCK waits until there is room, DROP_OLDEST drops the oldest queued line, DROP_NEWEST drops the
+    line put and SPILL appends the line to a temporary file that is read back in order when the
+    queue has been drained. A line may be put with its capture time as a (line, capture_time)
+    tuple. Where lines were dropped, a LostLines marker is queued in their place
+    and the total number of dropped lines and bytes are counted.
+    """
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    SPILL = 'spill'
+    OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SPILL)
+
+    # spilled records are a header telling the kind and size of the data following it
+    _SPILL_HEADER = struct.Struct('>BI')
+    _LINE, _TIMED_LINE, _LOST_LINES = range(3)
+    _TIME = struct.Struct('>d')
+    _LOST = struct.Struct('>QQ')
+
+    def __init__(self, capacity=None, overflow_policy=BLOCK, spill_max_bytes=None):
+        """
+        :param capacity: The max number of queued log lines or None for an unbounded queue.
+        :param overflow_policy: One of OVERFLOW_POLICIES.
+        :param spill_max_bytes: The max size of the spill file or None for no limit. Lines not
+                                fitting are dropped as with DROP_NEWEST.
+        """
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError('overflow_policy must be one of {}'.format(self.OVERFLOW_POLICIES))
+        self._capacity = capacity
+        self._overflow_policy = overflow_policy
+        self._spill_max_bytes = spill_max_bytes
+
+        self._items = deque()
+        self._line_count = 0  # queued log lines in memory, not counting the markers
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._closed = False
+
+        self._tail_loss = None  # lines dropped after everything queued so far
+        self._spill_file = None
+        self._spill_read_pos = 0
+        self._spill_write_pos = 0
+        self._spill_line_count = 0
+
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self.high_water_mark = 0  # the max number of log lines queued, spilled or not
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._capacity,
+                                             self._overflow_policy,
+                                             self._spill_max_bytes)
+
+    def __len__(self):
+        with self._lock:
+            return self._line_count + self._spill_line_count
+
+    @staticmethod
+    def _size_of(line):
+        if isinstance(line, tuple):  # a line with its capture time
+            line = line[0]
+        return len(line)
+
+    def _is_full(self):
+        return self._capacity is not None and self._line_count >= self._capacity
+
+    def _drop(self, line_count, byte_count):
+        self.dropped_lines += line_count
+        self.dropped_bytes += byte_count
+
+    def _drop_newest(self, line):
+        size = self._size_of(line)
+        self._drop(1, size)
+        if self._tail_loss is None:
+            self._tail_loss = LostLines()
+        self._tail_loss.add(1, size)
+
+    def _drop_oldest(self):
+        items = self._items
+        lost = LostLines()
+        while items and isinstance(items[0], LostLines):
+            head = items.popleft()
+            lost.add(head.line_count, head.byte_count)
+        if items:
+            size = self._size_of(items.popleft())
+            self._line_count -= 1
+            self._drop(1, size)
+            lost.add(1, size)
+        items.appendleft(lost)
+
+    def _append(self, line):
+        if self._tail_loss is not None:
+            self._items.append(self._tail_loss)
+            self._tail_loss = None
+        self._items.append(line)
+        self._line_count += 1
+        if self._line_count + self._spill_line_count > self.high_water_mark:
+            self.high_water_mark = self._line_count + self._spill_line_count
+        self._not_empty.notify()
+
+    def _spill(self, line):
+        if isinstance(line, tuple):  # a line with its capture time
+            log_line, capture_time = line
+            kind, data = self._TIMED_LINE, self._TIME.pack(capture_time) + log_line
+        else:
+            kind, data = self._LINE, line
+        record_size = self._SPILL_HEADER.size + len(data)
+        if (self._spill_max_bytes is not None and
+                self._spill_write_pos - self._spill_read_pos + record_size > self._spill_max_bytes):
+            self._drop_newest(line)
+            return
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix='linequeue-')
+        if self._tail_loss is not None:
+            self._write_spill(self._LOST_LINES, self._LOST.pack(self._tail_loss.line_count,
+                                                                self._tail_loss.byte_count))
+            self._tail_loss = None
+        self._write_spill(kind, data)
+        self._spill_line_count += 1
+        if self._line_count + self._spill_line_count > self.high_water_mark:
+            self.high_water_mark = self._line_count + self._spill_line_count
+
+    def _write_spill(self, kind, data):
+        self._spill_file.seek(self._spill_write_pos)
+        self._spill_file.write(self._SPILL_HEADER.pack(kind, len(data)) + data)
+        self._spill_write_pos += self._SPILL_HEADER.size + len(data)
+
+    def _read_spill(self, max_lines):
+        """
+        Reads back spilled lines in order into memory.
+        """
+        spill_file = self._spill_file
+        spill_file.seek(self._spill_read_pos)
+        header_size = self._SPILL_HEADER.size
+        while self._spill_read_pos < self._spill_write_pos and self._line_count < max_lines:
+            kind, size = self._SPILL_HEADER.unpack(spill_file.read(header_size))
+            data = spill_file.read(size)
+            self._spill_read_pos += header_size + size
+            if kind == self._LOST_LINES:
+                self._items.append(LostLines(*self._LOST.unpack(data)))
+                continue
+            if kind == self._TIMED_LINE:
+                time_size = self._TIME.size
+                self._items.append((data[time_size:], self._TIME.unpack(data[:time_size])[0]))
+            else:
+                self._items.append(data)
+            self._line_count += 1
+            self._spill_line_count -= 1
+
+        if self._spill_read_pos == self._spill_write_pos:  # all read back, so start over
+            spill_file.seek(0)
+            spill_file.truncate()
+            self._spill_read_pos = self._spill_write_pos = 0
+
+    def put(self, line):
+        """
+        Puts a log line to the queue following the overflow policy if the queue is full.
+        Lines put after close() are dropped.
+        :param line: A log line as bytes or a (line, capture_time) tuple.
+        """
+        with self._lock:
+            if self._closed:
+                self._drop_newest(line)
+                return
+            if self._spill_write_pos:  # keep lines in order while anything is spilled
+                self._spill(line)
+                self._not_empty.notify()
+                return
+            if self._is_full():
+                if self._overflow_policy == self.BLOCK:
+                    while self._is_full() and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        self._drop_newest(line)
+                        return
+                elif self._overflow_policy == self.DROP_OLDEST:
+                    self._drop_oldest()
+                elif self._overflow_policy == self.DROP_NEWEST:
+                    self._drop_newest(line)
+                    return
+                else:
+                    self._spill(line)
+                    self._not_empty.notify()
+                    return
+            self._append(line)
+
+    def get_batch(self, timeout=None):
+        """
+        Waits for log lines and takes all queued log lines at once. The batch may contain
+        LostLines markers where log lines were dropped.
+        :param timeout: The max number of seconds to wait or None to wait forever.
+        :return: A list of log lines and markers, empty if timed out.
+        """
+        with self._lock:
+            if timeout is not None:
+                deadline = time() + timeout
+            while not self._items and not self._spill_write_pos and self._tail_loss is None:
+                if timeout is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return []
+                    self._not_empty.wait(remaining)
+
+            if not self._items and self._spill_write_pos:
+                self._read_spill(self._capacity or 1)
+                if self._closed and not self._spill_write_pos:  # drained after close()
+                    self._spill_file.close()
+                    self._spill_file = None
+            items = list(self._items)
+            self._items.clear()
+            self._line_count = 0
+            if self._tail_loss is not None and not self._spill_write_pos:
+                items.append(self._tail_loss)
+                self._tail_loss = None
+            self._not_full.notify_all()
+            return items
+
+    def close(self):
+        """
+        Wakes up blocked producers. Lines put from now on are dropped and counted.
+        """
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            if self._spill_file is not None and not self._spill_write_pos:
+                self._spill_file.close()
+                self._spill_file = None
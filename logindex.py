@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+import bisect
+import io
+import os
+import struct
+
+INDEX_SUFFIX = '.idx'
+
+
+def index_path(log_file_path):
+    """
+    :param log_file_path: The file path of an uncompressed log file or segment.
+    :return: The file path of its sidecar index.
+    """
+    return log_file_path + INDEX_SUFFIX
+
+
+class IndexPolicy(object):
+    """
+    Decides which log lines are recorded in the sidecar index of a log file. A line is recorded
+    when every_lines lines have been written since the last recorded line or when it was captured
+    every_seconds seconds after it, and a limit set to None is not checked. The first line of each
+    log file is always recorded.
+    """
+    EVERY_LINES = 1000
+    EVERY_SECONDS = 1.0
+
+    def __init__(self, every_lines=EVERY_LINES, every_seconds=EVERY_SECONDS):
+        """
+        :param every_lines: Record a line when this number of lines has been written since the last.
+        :param every_seconds: Record a line captured this number of seconds after the last.
+        """
+        self.every_lines = every_lines
+        self.every_seconds = every_seconds
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.every_lines, self.every_seconds)
+
+    def next_due(self, capture_times, start, last_line, last_time):
+        """
+        Finds the next line to record without looking at each line, since the capture times of a
+        batch are in order.
+        :param capture_times: The capture times of a batch of lines.
+        :param start: The position in the batch to search from.
+        :param last_line: The position of the last recorded line relative to the batch, which is
+                          negative if recorded in an earlier batch.
+        :param last_time: The capture time of the last recorded line.
+        :return: The position of the next line to record or len(capture_times) if none.
+        """
+        due = len(capture_times)
+        if self.every_lines is not None:
+            due = min(due, max(start, last_line + self.every_lines))
+        if self.every_seconds is not None:
+            due = min(due, bisect.bisect_left(capture_times, last_time + self.every_seconds, start, due))
+        return due
+
+
+class IndexWriter(object):
+    """
+    Writes the sidecar index of a log file. Each record is a fixed size tuple of the line number
+    counted over all segments of the log file, the capture time of the line in seconds since the
+    epoch and the byte offset where the line starts in the log file. Records are added when the
+    lines are buffered and written when the lines are, so the index never points past the data.
+    The last record written when closed tells the number of lines and the size of the log file.
+    """
+    RECORD = struct.Struct('<QdQ')
+
+    def __init__(self, index_file_path):
+        """
+        :param index_file_path: The file path to write the index to.
+        """
+        self._index_file_path = index_file_path
+        self._file = None
+        self._pending = []
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._index_file_path)
+
+    def open(self):
+        self._file = io.open(self._index_file_path, 'wb')
+        self._pending = []
+
+    def close(self, line_number, capture_time, file_size):
+        """
+        Writes the pending records and the end record and closes the index.
+        :param line_number: The number of the line following the last line of the log file.
+        :param capture_time: The capture time of the last line.
+        :param file_size: The size of the log file.
+        """
+        if self._file is not None:
+            try:
+                self.add(line_number, capture_time, file_size)
+                self.write()
+            finally:
+                self._file.close()
+                self._file = None
+
+    def add(self, line_number, capture_time, offset):
+        self._pending.append(self.RECORD.pack(line_number, capture_time, offset))
+
+    def write(self, fsync=False):
+        """
+        Writes the records added since last written.
+        :param fsync: Call fsync to commit the records to the disk.
+        """
+        if self._pending:
+            self._file.write(b''.join(self._pending))
+            self._file.flush()
+            self._pending = []
+            if fsync:
+                os.fsync(self._file.fileno())
+
+
+class LogIndex(object):
+    """
+    Reads the sidecar index of a log file. Records are read by seeking to them, so searching an
+    index is a binary search that never loads the whole index. A record partially written when
+    the logger was interrupted is ignored.
+    """
+    RECORD = IndexWriter.RECORD
+
+    def __init__(self, index_file_path):
+        """
+        :param index_file_path: The file path of the index.
+        """
+        self._index_file_path = index_file_path
+        self._file = io.open(index_file_path, 'rb')
+        self._count = os.path.getsize(index_file_path) // self.RECORD.size
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._index_file_path)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        """
+        :return: The record i as a tuple (line_number, capture_time, offset).
+        """
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('index record out of range')
+        self._file.seek(i * self.RECORD.size)
+        return self.RECORD.unpack(self._file.read(self.RECORD.size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _bisect(self, value, field):
+        """
+        :return: The position of the first record with field greater than value.
+        """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle][field] > value:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def find_line(self, line_number):
+        """
+        :return: The last record at or before the line number, or None if none.
+        """
+        i = self._bisect(line_number, 0)
+        return self[i - 1] if i else None
+
+    def find_time(self, capture_time):
+        """
+        :return: The last record captured at or before the time, or None if none.
+        """
+        i = self._bisect(capture_time, 1)
+        return self[i - 1] if i else None
+
+    def first_after(self, capture_time):
+        """
+        :return: The first record captured after the time, or None if none.
+        """
+        i = self._bisect(capture_time, 1)
+        return self[i] if i < self._count else None
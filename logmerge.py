@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+import heapq
+import itertools
+import logging
+import sys
+
+from observer import Observer
+
+from filewriter import LogFile
+from logquery import LogQuery
+from metrics import Histogram
+from timestamp import monotonic, parse_stamp, wall_time
+
+
+class LineMerger(object):
+    """
+    Orders the log lines of many ports by arrival time. Lines are kept in a heap and released when
+    they are older than the reordering window, so a line arriving up to window seconds late, e.g.
+    read by a worker process on another core, is still put in its place. The heap holds at most
+    max_lines lines, and the oldest lines are released early when it is full, so memory stays flat
+    however fast the ports are. A line released after a newer one is counted as late.
+    """
+    WINDOW = 0.1
+    MAX_LINES = 100000
+
+    def __init__(self, window=WINDOW, max_lines=MAX_LINES):
+        """
+        :param window: The number of seconds a line is held back waiting for older lines.
+        :param max_lines: The max number of lines held back.
+        """
+        self._window = window
+        self._max_lines = max_lines
+        self._heap = []
+        self._sequence = itertools.count()  # keeps lines of the same arrival time in order
+        self._released = []
+        self._last_released = None
+        self.late_lines = 0
+        self.forced_lines = 0
+        self.max_held = 0
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._window,
+                                             self._max_lines,
+                                             len(self._heap))
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, line, arrival_time):
+        """
+        :param line: A log line.
+        :param arrival_time: The monotonic time when the line arrived.
+        """
+        heapq.heappush(self._heap, (arrival_time, next(self._sequence), line))
+        if len(self._heap) > self._max_lines:
+            self._release(heapq.heappop(self._heap))
+            self.forced_lines += 1
+        self.max_held = max(self.max_held, len(self._heap))
+
+    def _release(self, entry):
+        if self._last_released is not None and entry[0] < self._last_released:
+            self.late_lines += 1
+        else:
+            self._last_released = entry[0]
+        self._released.append(entry)
+
+    def pop_ready(self, now=None):
+        """
+        :param now: The current monotonic time or None to read the clock.
+        :return: A list of (arrival_time, line) in order of the lines older than the window and
+                 the lines released early since last called.
+        """
+        heap = self._heap
+        oldest_kept = (monotonic() if now is None else now) - self._window
+        while heap and heap[0][0] <= oldest_kept:
+            self._release(heapq.heappop(heap))
+        return self._take_released()
+
+    def pop_all(self):
+        """
+        :return: A list of (arrival_time, line) of all lines held back, in order.
+        """
+        while self._heap:
+            self._release(heapq.heappop(self._heap))
+        return self._take_released()
+
+    def _take_released(self):
+        released, self._released = self._released, []
+        return [(arrival_time, line) for arrival_time, _, line in released]
+
+    def time_to_ready(self, default, now=None):
+        """
+        :param default: The time returned if no line is held back.
+        :return: The number of seconds until the oldest line held back is released.
+        """
+        if not self._heap:
+            return default
+        now = monotonic() if now is None else now
+        return max(0, min(default, self._heap[0][0] + self._window - now))
+
+
+class MergeTap(Observer):
+    """
+    Intercepts the log lines of a port and pushes these, tagged with the port name, to the line
+    merger of a MergedLogSink.
+    """
+
+    def __init__(self, merger, tag):
+        """
+        :param merger: The LineMerger of the sink.
+        :param tag: The tag put before each log line, e.g. the port name.
+        """
+        super(MergeTap, self).__init__(self.__class__.__name__)
+        self._merger = merger
+        self._prefix = u'[{}] '.format(tag).encode('utf8')
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._prefix)
+
+    def update(self, data):
+        self._merger.push(self._prefix + data[0], data[1])  # data is a tuple
+
+
+class MergedLogSink(object):
+    """
+    Writes the log lines of many ports to one log file in order of arrival, on the event loop of a
+    MultiPortLogger. Each port is attached through a tap of its own, see tap(), which tags its
+    lines with the port name. The lines are ordered by a LineMerger, so they are written up to its
+    window later than the lines of the per port log files. The ports need to share a ClockBase for
+    their timestamps to be on the same time line as the order of the lines.
+    """
+
+    def __init__(self, log_file_path, window=LineMerger.WINDOW, max_lines=LineMerger.MAX_LINES,
+                 flush_policy=None, rotation_policy=None, archiver=None, index_policy=None):
+        """
+        :param log_file_path: The file path to write the merged log lines to.
+        :param window: The number of seconds a line is held back waiting for older lines.
+        :param max_lines: The max number of lines held back.
+        :param flush_policy: A FlushPolicy deciding when to flush. A default policy if None.
+        :param rotation_policy: A RotationPolicy deciding when to rotate or None to never rotate.
+        :param archiver: A SegmentArchiver for rotated segments. Required for rotation.
+        :param index_policy: An IndexPolicy deciding which lines to index or None for no index.
+        """
+        self._merger = LineMerger(window, max_lines)
+        self._log_file = LogFile(log_file_path,
+                                 flush_policy=flush_policy,
+                                 rotation_policy=rotation_policy,
+                                 archiver=archiver,
+                                 index_policy=index_policy)
+        self._archiver = archiver
+        self._indexed = index_policy is not None
+        self._hold_time = Histogram()
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._merger, self._log_file)
+
+    def tap(self, tag):
+        """
+        :param tag: The tag put before each log line of the port, e.g. the port name.
+        :return: An observer to attach to the channel of the port.
+        """
+        return MergeTap(self._merger, tag)
+
+    def open(self):
+        if self._archiver is not None:
+            self._archiver.start()
+        self._log_file.open()
+
+    def close(self):
+        try:
+            self._write(self._merger.pop_all())
+            self._log_file.close()
+        finally:
+            if self._archiver is not None:
+                self._archiver.stop()
+
+    def write_pending(self):
+        """
+        Writes the log lines released by the merger and flushes if due.
+        """
+        if not self._write(self._merger.pop_ready()):
+            self._log_file.flush_if_due()
+
+    def _write(self, released):
+        if not released:
+            return False
+        now = monotonic()
+        self._hold_time.observe(now - released[0][0])
+        capture_times = None
+        if self._indexed:
+            capture_times = [wall_time(arrival_time) for arrival_time, _ in released]
+        self._log_file.write_lines([line for _, line in released], capture_times)
+        return True
+
+    def time_to_flush(self, default):
+        return self._merger.time_to_ready(self._log_file.time_to_flush(default))
+
+    def stats(self):
+        """
+        :return: The stats of the log file, see LogFile.stats(), with the number of lines held
+                 back, its high water mark, the lines released early or out of order and a
+                 histogram of the seconds the oldest line of each write was held back.
+        """
+        stats = self._log_file.stats()
+        stats.update({'held_lines': len(self._merger),
+                      'held_lines_max': self._merger.max_held,
+                      'forced_lines': self._merger.forced_lines,
+                      'late_lines': self._merger.late_lines,
+                      'hold_seconds': self._hold_time})
+        return stats
+
+
+def _stamped_lines(log_file_path, index, tag, encoding):
+    """
+    :return: An iterator of (time, index, line number, tagged line) of the lines of a log file and
+             its rotated segments. A line without a timestamp, e.g. a continuation line, gets the
+             time of the line before it.
+    """
+    prefix = '[{}] '.format(tag).encode(encoding)
+    stamp_time = float('-inf')
+    lines = LogQuery(log_file_path).lines_from_line(0)
+    for line_number, line in enumerate(lines):
+        parsed = parse_stamp(line.decode(encoding, 'replace'))
+        if parsed is not None:
+            stamp_time = parsed
+        yield stamp_time, index, line_number, prefix + line
+
+
+def merge_files(log_file_paths, tags=None, encoding='utf8'):
+    """
+    Merges log files written with timestamps, e.g. the per port log files of one run, by the times
+    of their timestamps. Each log file is read in order with its rotated segments, one line at a
+    time, so memory stays flat however large the log files are. Relative timestamps only line up
+    if the log files were written with a shared clock base, as when logging many ports at once.
+    :param log_file_paths: The file paths of the log files.
+    :param tags: The tags put before the lines of each log file or None for the file paths.
+    :param encoding: The encoding of the log files.
+    :return: An iterator of the tagged log lines as bytes.
+    """
+    tags = tags if tags is not None else log_file_paths
+    streams = [_stamped_lines(path, index, tag, encoding)
+               for index, (path, tag) in enumerate(zip(log_file_paths, tags))]
+    for _, _, _, line in heapq.merge(*streams):
+        yield line
+
+
+if __name__ == "__main__":
+    import argparse
+    import io
+    from os.path import basename
+
+    # CLI
+    program_name = basename(__file__)
+    parser = argparse.ArgumentParser(description=('Serial Log Merge CLI\n\n'
+                                                  'You merge log files written with timestamps, '
+                                                  'e.g. one per port, into one log\n'
+                                                  'ordered by time with each line tagged with its '
+                                                  'log file. Rotated segments are\n'
+                                                  'merged too.\n'),
+                                     prog = program_name,
+                                     epilog = ('\n  %(prog)s serial-ttyUSB0.txt serial-ttyUSB1.txt\n'
+                                               '  %(prog)s serial-ttyUSB0.txt serial-ttyUSB1.txt '
+                                               '--tags dut host -o merged.txt\n'),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logfiles', type=str, nargs='+', metavar='LOGFILE', help='set log files to merge')
+    parser.add_argument('--tags', type=str, nargs='+', metavar='TAG',
+                        help='set tags of the log files, the file names by default')
+    parser.add_argument('-o', '--output', type=str, help='set merged log file, stdout by default')
+    args = parser.parse_args()
+
+    if args.tags and len(args.tags) != len(args.logfiles):
+        parser.error('--tags needs a tag per log file')
+
+    logging.basicConfig(level=logging.ERROR)  # log files without an index are fine here
+
+    lines = merge_files(args.logfiles, args.tags or [basename(path) for path in args.logfiles])
+    output = io.open(args.output, 'wb') if args.output else getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        output.writelines(lines)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        output.flush()
+        if args.output:
+            output.close()
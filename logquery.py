@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+import bz2
+import gzip
+import io
+import itertools
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+try:
+    import lzma  # Python 3.3+ only
+except ImportError:
+    lzma = None
+
+from logindex import LogIndex, index_path
+from logrotation import SegmentArchiver
+
+
+class LogQuery(object):
+    """
+    Finds log lines in a log file and its rotated segments by their sidecar indexes. The index is
+    searched with a binary search, so only the lines asked for are read, also from compressed
+    segments, which are decompressed on the fly. Times are found at the granularity of the index,
+    so the lines between two times may begin and end with lines indexed just before and after.
+    Log files without an index are skipped.
+    """
+    POLL_INTERVAL = 0.1
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, log_file_path):
+        """
+        :param log_file_path: The file path of the log file, as given to the logger.
+        """
+        self._log_file_path = log_file_path
+        self._archiver = SegmentArchiver(log_file_path)  # only used for finding segments
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._log_file_path)
+
+    def files(self):
+        """
+        :return: A list of (log file path, index file path) of all segments, oldest first, and the
+                 log file itself.
+        """
+        files = [(path, self._archiver.index_path(path)) for path in self._archiver.segments()]
+        if os.path.exists(self._log_file_path):
+            files.append((self._log_file_path, index_path(self._log_file_path)))
+        return files
+
+    def lines_between(self, start_time, end_time):
+        """
+        :param start_time: The capture time to start at in seconds since the epoch.
+        :param end_time: The capture time to end at in seconds since the epoch.
+        :return: An iterator of the log lines as bytes.
+        """
+        for path, index_file_path in self.files():
+            log_index = self._open_index(index_file_path)
+            if log_index is None:
+                continue
+            with log_index:
+                is_active = path == self._log_file_path  # lines after the last record are still written
+                if log_index[0][1] > end_time or (not is_active and log_index[-1][1] < start_time):
+                    continue
+                start = log_index.find_time(start_time)
+                end = log_index.first_after(end_time)
+            for line in self._read(path, start[2] if start else 0, end[2] if end else None):
+                yield line
+
+    def lines_from_line(self, line_number, follow=False):
+        """
+        :param line_number: The number of the first line, counted from 0 over all segments.
+        :param follow: Keep following the log file for new lines when all lines are read.
+        :return: An iterator of the log lines as bytes.
+        """
+        files = self.files()
+        for i in reversed(range(len(files))):
+            log_index = self._open_index(files[i][1])
+            if log_index is None:
+                continue
+            with log_index:
+                record = log_index.find_line(line_number)
+            if record is not None:  # the last log file starting at or before the line
+                lines = self._lines_onward(files, i, record[2], follow)
+                return itertools.islice(lines, line_number - record[0], None)
+        return self._lines_onward(files, 0, 0, follow)
+
+    def lines_from_time(self, start_time, follow=False):
+        """
+        :param start_time: The capture time to start at in seconds since the epoch.
+        :param follow: Keep following the log file for new lines when all lines are read.
+        :return: An iterator of the log lines as bytes.
+        """
+        files = self.files()
+        for i in reversed(range(len(files))):
+            log_index = self._open_index(files[i][1])
+            if log_index is None:
+                continue
+            with log_index:
+                record = log_index.find_time(start_time)
+            if record is not None:  # the last log file starting at or before the time
+                return self._lines_onward(files, i, record[2], follow)
+        return self._lines_onward(files, 0, 0, follow)
+
+    def follow(self):
+        """
+        :return: An iterator of the log lines written to the log file from now on.
+        """
+        offset = os.path.getsize(self._log_file_path) if os.path.exists(self._log_file_path) else 0
+        return self._follow(offset)
+
+    def _open_index(self, index_file_path):
+        if not os.path.exists(index_file_path):
+            self.logger.warning('no index {}'.format(index_file_path))
+            return None
+        log_index = LogIndex(index_file_path)
+        if not len(log_index):
+            log_index.close()
+            return None
+        return log_index
+
+    def _lines_onward(self, files, first, offset, follow):
+        for i in range(first, len(files)):
+            path = files[i][0]
+            start = offset if i == first else 0
+            if follow and path == self._log_file_path:
+                for line in self._follow(start):
+                    yield line
+                return
+            for line in self._read(path, start):
+                yield line
+        if follow and (not files or files[-1][0] != self._log_file_path):
+            for line in self._follow(0):
+                yield line
+
+    def _read(self, path, start, end=None):
+        """
+        :return: An iterator of the lines of a log file from the start offset to the end offset.
+        """
+        log_file = open_log_file(path)
+        try:
+            log_file.seek(start)  # compressed files are decompressed up to the offset
+            position = start
+            for line in log_file:
+                if end is not None and position >= end:
+                    break
+                position += len(line)
+                yield line
+        finally:
+            log_file.close()
+
+    def _follow(self, offset):
+        """
+        :return: An iterator of the lines of the log file from the offset, which never ends.
+                 When the log file is rotated, the new log file is followed from its start, after
+                 the segments rotated meanwhile.
+        """
+        while not os.path.exists(self._log_file_path):
+            time.sleep(self.POLL_INTERVAL)
+        log_file = io.open(self._log_file_path, 'rb')
+        log_file.seek(offset)
+        partial = b''
+        try:
+            while True:
+                data = log_file.read(self.READ_SIZE)
+                if data:
+                    lines = (partial + data).split(b'\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        yield line + b'\n'
+                elif self._is_rotated(log_file):  # read to its end, so the new one is next
+                    missed = self._segments_after(os.fstat(log_file.fileno()).st_ino)
+                    log_file.close()
+                    for path in missed:  # rotated again before noticed
+                        for line in self._read(path, 0):
+                            yield line
+                    log_file = io.open(self._log_file_path, 'rb')
+                else:
+                    time.sleep(self.POLL_INTERVAL)
+        finally:
+            log_file.close()
+
+    def _segments_after(self, inode):
+        """
+        :return: The segments rotated after the segment with the inode, or none if not found.
+        """
+        segments = self._archiver.segments()
+        for i, path in enumerate(segments):
+            try:
+                if os.stat(path).st_ino == inode:
+                    return segments[i + 1:]
+            except OSError:  # compressed meanwhile
+                pass
+        return []
+
+    def _is_rotated(self, log_file):
+        try:
+            return os.stat(self._log_file_path).st_ino != os.fstat(log_file.fileno()).st_ino
+        except OSError:  # renamed, but the new log file is not opened yet
+            return False
+
+
+def open_log_file(path):
+    """
+    :param path: The file path of a log file or a segment, which is decompressed on the fly if
+                 compressed.
+    :return: The file opened for reading bytes.
+    """
+    if path.endswith(SegmentArchiver.COMPRESSIONS['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(SegmentArchiver.COMPRESSIONS['bz2']):
+        return bz2.BZ2File(path, 'rb')
+    if path.endswith(SegmentArchiver.COMPRESSIONS['xz']):
+        if lzma is None:
+            raise IOError('reading {} requires the lzma module'.format(path))
+        return lzma.LZMAFile(path, 'rb')
+    return io.open(path, 'rb')
+
+
+def parse_time(text):
+    """
+    :param text: A time in seconds since the epoch or in ISO format YYYY-MM-DDTHH:MM:SS[.ffffff]
+                 local time.
+    :return: The time in seconds since the epoch.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    time_format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in text else '%Y-%m-%dT%H:%M:%S'
+    try:
+        parsed = datetime.strptime(text, time_format)
+    except ValueError:
+        raise ValueError('time must be seconds since the epoch or YYYY-MM-DDTHH:MM:SS[.ffffff]')
+    return time.mktime(parsed.timetuple()) + parsed.microsecond * 1e-6
+
+
+if __name__ == "__main__":
+    import argparse
+    from os.path import basename
+
+    # CLI
+    program_name = basename(__file__)
+    parser = argparse.ArgumentParser(description=('Serial Log Query CLI\n\n'
+                                                  'You query a log file written with an index, '
+                                                  'including its rotated segments.\n'
+                                                  'Lines are found by a binary search of the index '
+                                                  'instead of reading the log file\n'
+                                                  'from its start. Times are seconds since the epoch '
+                                                  'or YYYY-MM-DDTHH:MM:SS[.ffffff].\n'),
+                                     prog = program_name,
+                                     epilog = ('\n  %(prog)s -l serial.txt --between 2024-05-01T12:00:00 '
+                                               '2024-05-01T12:05:00\n'
+                                               '  %(prog)s -l serial.txt --from-line 5000000\n'
+                                               '  %(prog)s -l serial.txt --from-time 1714564800 --follow\n'
+                                               '  %(prog)s -l serial.txt --follow\n'),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-l', '--logfile', type=str, required = True, help='set log file to query')
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument('--between', type=parse_time, nargs=2, metavar=('T1', 'T2'),
+                       help='print lines captured between two times')
+    query.add_argument('--from-time', type=parse_time, metavar='T', help='print lines captured from a time onward')
+    query.add_argument('--from-line', type=int, metavar='N', help='print lines from a line number onward')
+    parser.add_argument('-f', '--follow', default=False, action='store_true',
+                        help='keep printing lines as the log file grows, like tail -f')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    log_query = LogQuery(args.logfile)
+    if args.between:
+        if args.follow:
+            parser.error('--between can not be followed')
+        lines = log_query.lines_between(*args.between)
+    elif args.from_time is not None:
+        lines = log_query.lines_from_time(args.from_time, args.follow)
+    elif args.from_line is not None:
+        lines = log_query.lines_from_line(args.from_line, args.follow)
+    elif args.follow:
+        lines = log_query.follow()
+    else:
+        parser.error('one of --between, --from-time, --from-line or --follow is required')
+
+    output = getattr(sys.stdout, 'buffer', sys.stdout)  # log lines are written as bytes
+    try:
+        for line in lines:
+            output.write(line)
+            if args.follow:
+                output.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        output.flush()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import bz2
+import glob
+import gzip
+import logging
+import os
+import shutil
+
+from datetime import datetime
+from threading import Thread, Event
+try:
+    from Queue import Queue, Empty as QueueEmpty
+except ImportError:  # python 3
+    from queue import Queue, Empty as QueueEmpty
+
+try:
+    import lzma  # Python 3.3+ only
+except ImportError:
+    lzma = None
+
+from logindex import INDEX_SUFFIX
+
+
+class RotationPolicy(object):
+    """
+    Decides when the log file is closed and renamed to a segment, after which a new log file is
+    opened. The log file is rotated as soon as any of the limits is reached, and a limit set to
+    None is not checked.
+    """
+
+    def __init__(self, max_bytes=None, interval=None):
+        """
+        :param max_bytes: Rotate when the log file has reached this size in bytes.
+        :param interval: Rotate when the log file has been open for this number of seconds.
+        """
+        self.max_bytes = max_bytes
+        self.interval = interval
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.max_bytes, self.interval)
+
+    def is_due(self, file_bytes, opened_at, now):
+        """
+        :param file_bytes: The number of bytes written to the log file.
+        :param opened_at: The time when the log file was opened.
+        :param now: The current time.
+        :return: True if the log file should be rotated.
+        """
+        return ((self.max_bytes is not None and file_bytes >= self.max_bytes) or
+                (self.interval is not None and now - opened_at >= self.interval))
+
+
+class SegmentArchiver(Thread):
+    """
+    This thread compresses closed log file segments in the background, so compressing never blocks
+    writing, and removes the oldest segments to stay within the retention limits.
+    A segment is named after the log file with a suffix telling when it was rotated. It is
+    compressed into a temporary file that is renamed when done, after which the segment is removed.
+    Segments left uncompressed by a previous run are compressed when the thread starts.
+    The sidecar index of a segment is kept uncompressed next to it and removed with it.
+    """
+    COMPRESSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+    SEGMENT_TIME_FORMAT = '%Y%m%dT%H%M%S'
+    TMP_SUFFIX = '.tmp'
+    READ_SEGMENT_TMO = 0.5
+    COPY_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, log_file_path, compression=None, max_total_bytes=None, max_segments=None):
+        """
+        :param log_file_path: The file path of the log file that is rotated.
+        :param compression: One of COMPRESSIONS or None for no compression.
+        :param max_total_bytes: The max total size of all segments or None for no limit.
+        :param max_segments: The max number of segments or None for no limit.
+        """
+        if compression is not None and compression not in self.COMPRESSIONS:
+            raise ValueError('compression must be one of {}'.format(sorted(self.COMPRESSIONS)))
+        if compression == 'xz' and lzma is None:
+            raise ValueError('xz compression requires the lzma module')
+        super(SegmentArchiver, self).__init__(name = self.__class__.__name__)
+        self._log_file_path = log_file_path
+        self._compression = compression
+        self._max_total_bytes = max_total_bytes
+        self._max_segments = max_segments
+
+        self.setDaemon(True)
+        self._segment_queue = Queue()
+        self._stop_event = Event()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                   self._log_file_path,
+                                                   self._compression,
+                                                   self._max_total_bytes,
+                                                   self._max_segments)
+
+    def segment_path(self):
+        """
+        :return: A new unique segment file path for the log file being rotated now.
+        """
+        path = '{}.{}'.format(self._log_file_path, datetime.now().strftime(self.SEGMENT_TIME_FORMAT))
+        segment_path, i = path, 0
+        while any(os.path.exists(segment_path + extension)
+                  for extension in ('',) + tuple(self.COMPRESSIONS.values())):
+            i += 1
+            segment_path = '{}-{}'.format(path, i)
+        return segment_path
+
+    def segments(self):
+        """
+        :return: The file paths of all segments of the log file, oldest first.
+        """
+        paths = [path for path in glob.glob(self._log_file_path + '.*')
+                 if not path.endswith((self.TMP_SUFFIX, INDEX_SUFFIX))]
+        return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+    def index_path(self, segment_path):
+        """
+        :param segment_path: The file path of a segment, compressed or not.
+        :return: The file path of the sidecar index of the segment.
+        """
+        for extension in self.COMPRESSIONS.values():
+            if segment_path.endswith(extension):
+                segment_path = segment_path[:-len(extension)]
+                break
+        return segment_path + INDEX_SUFFIX
+
+    def add(self, segment_path):
+        """
+        Adds a closed segment to be compressed and accounted for retention.
+        :param segment_path: The file path of the segment.
+        """
+        self._segment_queue.put(segment_path)
+
+    def stop(self):
+        """
+        Stop archiving after the segment being compressed is done. Segments not yet compressed are
+        compressed the next time this thread starts.
+        """
+        self._stop_event.set()
+        self.logger.debug('archiver stopped')
+        if self.is_alive():
+            self.join()
+        self.logger.debug('archiver has terminated')
+
+    def _is_compressed(self, path):
+        return any(path.endswith(extension) for extension in self.COMPRESSIONS.values())
+
+    def _open_compressed(self, path):
+        if self._compression == 'gzip':
+            return gzip.open(path, 'wb')
+        if self._compression == 'bz2':
+            return bz2.BZ2File(path, 'wb')
+        return lzma.LZMAFile(path, 'wb')
+
+    def _compress(self, segment_path):
+        """
+        Streams the segment into a compressed file and removes the segment when done.
+        """
+        compressed_path = segment_path + self.COMPRESSIONS[self._compression]
+        tmp_path = compressed_path + self.TMP_SUFFIX
+        with open(segment_path, 'rb') as segment:
+            compressed = self._open_compressed(tmp_path)
+            try:
+                shutil.copyfileobj(segment, compressed, self.COPY_BUFFER_SIZE)
+            finally:
+                compressed.close()
+        shutil.copystat(segment_path, tmp_path)  # keeps the segment order by modification time
+        os.rename(tmp_path, compressed_path)
+        os.remove(segment_path)
+        self.logger.debug('compressed {} to {}'.format(segment_path, compressed_path))
+
+    def _enforce_retention(self):
+        """
+        Removes the oldest segments until within the retention limits.
+        """
+        if self._max_total_bytes is None and self._max_segments is None:
+            return
+        segments = [(path, os.path.getsize(path)) for path in self.segments()]
+        total_bytes = sum(size for _, size in segments)
+        while segments and ((self._max_segments is not None and len(segments) > self._max_segments) or
+                            (self._max_total_bytes is not None and total_bytes > self._max_total_bytes)):
+            path, size = segments.pop(0)
+            os.remove(path)
+            if os.path.exists(self.index_path(path)):
+                os.remove(self.index_path(path))
+            total_bytes -= size
+            self.logger.info('removed segment {}'.format(path))
+
+    def run(self):
+        for path in glob.glob(self._log_file_path + '.*' + self.TMP_SUFFIX):
+            os.remove(path)  # left by an interrupted compression
+        if self._compression is not None:
+            for path in self.segments():
+                if not self._is_compressed(path):
+                    self.add(path)
+        self._enforce_retention()
+
+        while not self._stop_event.is_set():
+            try:  # timeout avoids blocking in order to be responsive to stop calls
+                segment_path = self._segment_queue.get(timeout=self.READ_SEGMENT_TMO)
+            except QueueEmpty:
+                continue
+            try:
+                if self._compression is not None and os.path.exists(segment_path):
+                    self._compress(segment_path)
+                self._enforce_retention()
+            except (IOError, OSError) as e:  # segments are kept as is if failing
+                self.logger.error('Error: {}'.format(e))
@@ -1,13 +1,31 @@
 #!/usr/bin/env python
 
+from functools import partial
+import signal
+from os.path import basename, splitext
 from sys import platform
 from sys import stdout
 import logging
 
 from observer import Observer
-from serialporthelper import SerialPortHelper
+from consolewriter import ConsoleWriter
+from dedup import LineCollapser
+from serialporthelper import PortWatcher, SerialPortHelper
 from serialreader import SerialReader
-from filewriter import FileWriter
+from filewriter import FileWriter, FlushPolicy
+from flightrecorder import FlightRecorder
+from framing import FRAMERS, FrameCapture, FrameSplitter
+from linequeue import LineQueue
+from logindex import IndexPolicy
+from logmerge import LineMerger, MergedLogSink
+from logrotation import RotationPolicy, SegmentArchiver
+from metrics import MetricsDumper
+from multiport import LogFileSink, MultiPortLogger, PortChannel
+from netsink import LogServer
+from portworker import PortWorker
+from rawcapture import RawCaptureWriter
+from timestamp import ClockBase, TimeStamper, wall_time
+from triggers import PatternMatcher, TriggeredCapture, load_rules
 
 
 class SerialFileWriter(Observer):
@@ -15,10 +33,18 @@ class SerialFileWriter(Observer):
     This class intercepts logs and writes these to its own file writer.
     """
 
-    def __init__(self, log_file_path, callback):
+    def __init__(self, log_file_path, callback, flush_policy=None, queue_capacity=None,
+                 overflow_policy=LineQueue.BLOCK, rotation_policy=None, archiver=None, index_policy=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         super(SerialFileWriter, self).__init__(self.__class__.__name__)
-        self._file_writer = FileWriter(log_file_path, callback)
+        self._file_writer = FileWriter(log_file_path,
+                                       callback,
+                                       flush_policy=flush_policy,
+                                       queue_capacity=queue_capacity,
+                                       overflow_policy=overflow_policy,
+                                       rotation_policy=rotation_policy,
+                                       archiver=archiver,
+                                       index_policy=index_policy)
 
     def __repr__(self):
         return '{}({!r})'.format(self.__class__.__name__, self.name)
@@ -28,31 +54,54 @@ class SerialFileWriter(Observer):
 
     def stop(self):
         self._file_writer.stop()
+        if self._file_writer.dropped_lines:
+            self.logger.warning('{} log lines ({} bytes) were dropped'.format(self._file_writer.dropped_lines,
+                                                                               self._file_writer.dropped_bytes))
 
     def is_alive(self):
         return self._file_writer.is_alive()
 
+    def stats(self):
+        return self._file_writer.stats()
+
     def update(self, data):
-        log_line = data[0]  # data is a tuple
+        log_line, arrival_time = data[0], data[1]  # data is a tuple
         if self._file_writer.is_alive():
             self.logger.debug('writing: {}'.format(log_line))
-            self._file_writer.put(log_line)  # log lines are written to file writer's queue
+            self._file_writer.put(log_line, wall_time(arrival_time))  # log lines are written to file writer's queue
 
 
 class SerialPrinter(Observer):
     """
-    Simply intercepts logs and prints these to the console.
+    Simply intercepts logs and prints these to the console through a console writer, which writes
+    them in batches and suppresses lines if the console can not keep up.
     """
-    def __init__(self):
+    def __init__(self, console_writer, tag=None):
+        """
+        :param console_writer: The ConsoleWriter printing the log lines.
+        :param tag: A tag printed before each log line, e.g. the port name, or None for no tag.
+        """
         super(SerialPrinter, self).__init__(self.__class__.__name__)
         self.logger = logging.getLogger(self.name)
+        self._console_writer = console_writer
+        self._prefix = u'[{}] '.format(tag).encode('utf8') if tag else b''
 
     def __repr__(self):
         return '{}({!r})'.format(self.__class__.__name__, self.name)
 
     def update(self, new_data):
         log_line = new_data[0]  # new_data is a tuple
-        print('{}\r'.format(log_line))
+        self._console_writer.put(self._prefix + log_line if self._prefix else log_line)
+
+
+def port_log_file_path(log_file_path, port_name):
+    """
+    Returns a log file path for a port when logging many ports, e.g. serial-ttyUSB0.txt.
+    :param log_file_path: The log file path given for all ports.
+    :param port_name: The port name.
+    """
+    root, extension = splitext(log_file_path)
+    return '{}-{}{}'.format(root, basename(port_name).replace(':', ''), extension)
 
 
 def check_for_any_key_to_quit():
@@ -76,7 +125,6 @@ def check_for_any_key_to_quit():
 
 if __name__ == "__main__":
     import argparse
-    from os.path import basename
 
     # CLI
     program_name = basename(__file__)
@@ -84,26 +132,214 @@ if __name__ == "__main__":
                                                   'You log from a serial port set by name. '
                                                   'The serial stream is logged to console.\n'
                                                   'Writing the stream to a file is an option.\n'
+                                                  'Many ports are logged at once on a single thread '
+                                                  'with one log file per port.\n'
                                                   'A fake serial stream is an option too and '
                                                   'typically useful for development or\n'
                                                   'unit testing with fault-injection.\n'
                                                   'Hit any key to quit the program.\n'),
                                      prog = program_name,
                                      epilog = ('\n  %(prog)s -p COM1\n'
-                                               '  %(prog)s -p COM1 -f -l serial.txt\n'),
+                                               '  %(prog)s -p COM1 -f -l serial.txt\n'
+                                               '  %(prog)s -p COM1 COM2 COM3 -l serial.txt\n'
+                                               '  %(prog)s -p /dev/ttyUSB0 /dev/ttyUSB1 --processes -l serial.txt\n'
+                                               '  %(prog)s -p /dev/ttyUSB0 /dev/ttyUSB1 -t --merge merged.txt\n'
+                                               '  %(prog)s -p COM1 --replay serial.bin --speed 10 -c -l serial.txt\n'
+                                               '  %(prog)s -p /dev/ttyUSB0 -c -l serial.txt --framing slip --frames trace.bin\n'
+                                               '  %(prog)s -p /dev/ttyUSB0 -c -l serial.txt --serve 5000\n'
+                                               '  %(prog)s -p /dev/ttyUSB0 -c --flight-recorder crash.txt --rules rules.txt '
+                                               '--snapshot-on panic --post-trigger 5\n'),
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('-d', '--debug', default=False, help='set debug log level', action='store_true')
     parser.add_argument('-l', '--logfile', type=str, help='set log to file')
     parser.add_argument('-f', '--fake', default=False, help='set fake serial', action='store_true')
-    parser.add_argument('-p', '--port', type=str, required = True, help = 'set serial port')
+    parser.add_argument('-g', '--generate', type=int, metavar='BAUD',
+                        help='set fake serial generating traffic at a baud rate')
+    parser.add_argument('--replay', type=str, metavar='RECORDING',
+                        help='set fake serial replaying a raw capture or a log file')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='set speed of the replay relative to the recording, 0 for as fast as read')
+    parser.add_argument('--seed', type=int, help='set seed of the traffic generated by fake serial')
+    parser.add_argument('-p', '--port', type=str, nargs='+', required = True, help = 'set serial port(s)')
     parser.add_argument('-t', '--timestamp', default=False, help='add timestamp in logging', action='store_true')
+    parser.add_argument('--timestamp-format', choices=TimeStamper.FORMATS, default=TimeStamper.RELATIVE,
+                        help='set timestamp format')
+    parser.add_argument('--processes', default=False, action='store_true',
+                        help='read each port in a worker process of its own, restarted if it crashes')
+    parser.add_argument('--reconnect', default=False, action='store_true',
+                        help='wait for a lost port to come back and keep logging to the same files')
+    parser.add_argument('-c', '--chunked', default=False, help='read in chunks for high baud rates',
+                        action='store_true')
+    parser.add_argument('-a', '--async-dispatch', default=False,
+                        help='update console and log file on threads of their own', action='store_true')
+    parser.add_argument('--collapse', default=False, action='store_true',
+                        help='collapse repeated lines into a line telling how many times they were repeated')
+    parser.add_argument('--mask-numbers', default=False, action='store_true',
+                        help='collapse lines differing only in numbers too')
+    parser.add_argument('--flush-bytes', type=int, default=FlushPolicy.MAX_BYTES,
+                        help='flush log file when this many bytes are buffered')
+    parser.add_argument('--flush-lines', type=int, default=FlushPolicy.MAX_LINES,
+                        help='flush log file when this many lines are buffered')
+    parser.add_argument('--flush-latency', type=float, default=FlushPolicy.MAX_LATENCY,
+                        help='flush log file when the oldest buffered line is this many seconds old')
+    parser.add_argument('--fsync', default=False, help='fsync log file on every flush', action='store_true')
+    parser.add_argument('--fsync-on-rotate', default=False, help='fsync log file before it is rotated',
+                        action='store_true')
+    parser.add_argument('--queue-size', type=int, help='max number of log lines queued for the log file')
+    parser.add_argument('--overflow', choices=LineQueue.OVERFLOW_POLICIES, default=LineQueue.BLOCK,
+                        help='what to do with log lines when the queue is full')
+    parser.add_argument('--rotate-bytes', type=int, help='rotate log file when it reaches this many bytes')
+    parser.add_argument('--rotate-interval', type=float, help='rotate log file every this many seconds')
+    parser.add_argument('--compress', choices=sorted(SegmentArchiver.COMPRESSIONS),
+                        help='compress rotated log files')
+    parser.add_argument('--keep-bytes', type=int, help='max total bytes of rotated log files to keep')
+    parser.add_argument('--keep-files', type=int, help='max number of rotated log files to keep')
+    parser.add_argument('--index-lines', type=int,
+                        help='index log file every this many lines, see logquery.py')
+    parser.add_argument('--index-interval', type=float,
+                        help='index log file every this many seconds, see logquery.py')
+    parser.add_argument('--merge', type=str, metavar='MERGED_FILE',
+                        help='also log all ports to one file in order of arrival, see logmerge.py')
+    parser.add_argument('--merge-window', type=float, default=LineMerger.WINDOW,
+                        help='hold lines back this many seconds for ordering the merged file')
+    parser.add_argument('--raw', type=str, metavar='RAW_FILE',
+                        help='capture the exact bytes read to a file, see rawcapture.py')
+    parser.add_argument('--raw-only', default=False, action='store_true',
+                        help='only capture the exact bytes read of a single port, without decoding lines')
+    parser.add_argument('--framing', choices=sorted(FRAMERS), nargs='+',
+                        help='split binary frames of these protocols from the text, see framing.py')
+    parser.add_argument('--frames', type=str, metavar='FRAMES_FILE',
+                        help='capture the frames to a file per protocol, see rawcapture.py')
+    parser.add_argument('--serve', type=str, metavar='[HOST:]PORT',
+                        help='stream log lines live to clients connecting over TCP, see netsink.py')
+    parser.add_argument('--serve-unix', type=str, metavar='SOCKET_FILE',
+                        help='stream log lines live to clients connecting to a Unix domain socket')
+    parser.add_argument('--history-bytes', type=int, default=LogServer.HISTORY_BYTES,
+                        help='send this many bytes of recent log lines to a client connecting')
+    parser.add_argument('--metrics-interval', type=float, default=MetricsDumper.INTERVAL,
+                        help='dump metrics every this many seconds')
+    parser.add_argument('--metrics-prometheus', type=str, metavar='PROM_FILE',
+                        help='dump metrics to a Prometheus textfile')
+    parser.add_argument('--metrics-json', type=str, metavar='JSON_FILE', help='dump metrics to a JSON file')
+    parser.add_argument('--rules', type=str, metavar='RULES_FILE',
+                        help='watch for the patterns of a rules file with lines like: name = pattern')
+    parser.add_argument('--tag-matches', default=False, help='tag lines matching a rule with its name',
+                        action='store_true')
+    parser.add_argument('--ignore-case', default=False, help='match rules regardless of case',
+                        action='store_true')
+    parser.add_argument('--capture', type=str, nargs=2, metavar=('START_RULE', 'STOP_RULE'),
+                        help='capture lines between rules to numbered files named after the log file')
+    parser.add_argument('--flight-recorder', type=str, metavar='SNAPSHOT_FILE',
+                        help='keep the latest log lines in memory and write a snapshot to numbered files '
+                             'named after this file on SIGUSR1 or a snapshot rule, see flightrecorder.py')
+    parser.add_argument('--recorder-bytes', type=int, default=FlightRecorder.CAPACITY,
+                        help='keep this many bytes of the latest log lines in memory')
+    parser.add_argument('--post-trigger', type=float, default=0.0, metavar='SECONDS',
+                        help='add the log lines of this many seconds after a trigger to the snapshot')
+    parser.add_argument('--snapshot-on', type=str, nargs='+', metavar='RULE',
+                        help='write a snapshot when a line matches one of these rules')
     args = parser.parse_args()
 
     (debug_print,
      log_file,
      fake_serial,
-     port_name,
-     timestamp) = args.debug, args.logfile, args.fake, args.port, args.timestamp
+     port_names,
+     timestamp,
+     chunked) = args.debug, args.logfile, args.fake, args.port, args.timestamp, args.chunked
+    flush_policy = FlushPolicy(max_bytes = args.flush_bytes,
+                               max_lines = args.flush_lines,
+                               max_latency = args.flush_latency,
+                               fsync = args.fsync,
+                               fsync_on_rotate = args.fsync_on_rotate)
+    rotation_policy = None
+    if args.rotate_bytes or args.rotate_interval:
+        rotation_policy = RotationPolicy(max_bytes = args.rotate_bytes, interval = args.rotate_interval)
+
+    index_policy = None
+    if args.index_lines or args.index_interval:
+        index_policy = IndexPolicy(every_lines = args.index_lines, every_seconds = args.index_interval)
+
+    if args.capture and not (args.rules and log_file):
+        parser.error('--capture requires --rules and --logfile')
+    if args.snapshot_on and not (args.rules and args.flight_recorder):
+        parser.error('--snapshot-on requires --rules and --flight-recorder')
+    if args.raw_only and not args.raw:
+        parser.error('--raw-only requires --raw')
+    if args.raw_only and len(port_names) > 1:
+        parser.error('--raw-only logs a single port')
+    if args.mask_numbers and not args.collapse:
+        parser.error('--mask-numbers requires --collapse')
+    if args.frames and not args.framing:
+        parser.error('--frames requires --framing')
+    if args.framing and (args.processes or not (chunked or len(port_names) > 1)):
+        parser.error('--framing requires -c and can not be used with --processes')
+    if args.replay and len(port_names) > 1:
+        parser.error('--replay feeds a single port')
+    if args.reconnect and len(port_names) > 1 and not args.processes:
+        parser.error('--reconnect with many ports requires --processes')
+    if args.merge and len(port_names) < 2:
+        parser.error('--merge requires more than one port')
+    if args.processes and (args.raw or platform.startswith('win32')):
+        parser.error('--processes requires a platform which forks and can not be used with --raw')
+
+    port_watcher = PortWatcher() if args.reconnect else None
+
+    def report_match(rule, line, arrival_time):
+        root_logger.warning('{} matched: {}'.format(rule.name, line))
+
+    matcher = None
+    if args.rules:
+        matcher = PatternMatcher(load_rules(args.rules, tag = args.tag_matches, actions = [report_match]),
+                                 ignore_case = args.ignore_case)
+
+    def create_capture(log_file_path):
+        if not args.capture:
+            return None
+        root, extension = splitext(log_file_path)
+        return TriggeredCapture(log_file_path = '{}-capture{}'.format(root, extension),
+                                callback = error_handler,
+                                start_rules = [args.capture[0]],
+                                stop_rules = [args.capture[1]],
+                                flush_policy = flush_policy)
+
+    def create_recorder(snapshot_file_path):
+        if not args.flight_recorder:
+            return None
+        recorder = FlightRecorder(snapshot_file_path = snapshot_file_path,
+                                  callback = error_handler,
+                                  capacity = args.recorder_bytes,
+                                  post_trigger = args.post_trigger,
+                                  trigger_rules = args.snapshot_on or ())
+        recorders.append(recorder)
+        return recorder
+
+    def create_collapser():
+        return LineCollapser(mask_numbers = args.mask_numbers) if args.collapse else None
+
+    def create_frame_splitter(port_name=None):
+        if not args.framing:
+            return None
+        framers = []
+        for name in args.framing:
+            framer = FRAMERS[name]()
+            if args.frames:
+                root, extension = splitext(args.frames)
+                frames_file = '{}-{}{}'.format(root, name, extension)
+                frame_capture = RawCaptureWriter(port_log_file_path(frames_file, port_name) if port_name else frames_file,
+                                                 error_handler, fsync = args.fsync)
+                frame_capture.start()
+                frame_captures.append(frame_capture)
+                framer.attach(FrameCapture(frame_capture))
+            framers.append(framer)
+        return FrameSplitter(framers)
+
+    def create_archiver(log_file_path):
+        if rotation_policy is None:
+            return None
+        return SegmentArchiver(log_file_path = log_file_path,
+                               compression = args.compress,
+                               max_total_bytes = args.keep_bytes,
+                               max_segments = args.keep_files)
 
     console_handler = logging.StreamHandler(stdout)
     console_handler.setFormatter(logging.Formatter('%(asctime)s %(name)-18s %(levelname)-8s %(message)s\r'))
@@ -113,42 +349,266 @@ if __name__ == "__main__":
     root_logger.setLevel(level = logging.DEBUG if debug_print else logging.INFO)
     file_logger = root_logger.addHandler(console_handler)
 
-    if fake_serial:
+    replay = None
+    if args.replay:
+        from fakeserial import Serial, ReplaySource
+        replay = ReplaySource(args.replay, speed = args.speed or None)
+        Serial.prepare(fake_serial_stream = replay)
+    elif args.generate:
+        from fakeserial import Serial, TrafficGenerator
+        Serial.prepare(fake_serial_stream = TrafficGenerator(baudrate = args.generate, seed = args.seed))
+    elif fake_serial:
         from fakeserial import Serial, FAKE_LOG
         Serial.prepare(fake_serial_stream = FAKE_LOG)
     else:
         from serial import Serial
-        SerialPortHelper.check_port(port_name)
-
-    # Open the serial port specified by port name
-    with Serial(port = port_name, baudrate = 115200, timeout = 1) as serial_port:
-
-        def error_handler(error_string):
-            root_logger.error('error: {}'.format(error_string))
-            root_logger.error('Program has failed operation, so hit any key to quit please!')
-
-        file_writer, reader = None, None
+        for port_name in port_names:
+            SerialPortHelper.check_port(port_name)
+
+    def error_handler(error_string):
+        root_logger.error('error: {}'.format(error_string))
+        root_logger.error('Program has failed operation, so hit any key to quit please!')
+
+    console_writer = ConsoleWriter()
+    console_writer.start()
+    frame_captures = []
+    recorders = []
+    if args.flight_recorder and hasattr(signal, 'SIGUSR1'):
+        def snapshot_handler(signal_number, frame):
+            for recorder in recorders:
+                recorder.trigger('SIGUSR1')
+
+        signal.signal(signal.SIGUSR1, snapshot_handler)
+
+    log_server = None
+    if args.serve or args.serve_unix:
+        server_address = None
+        if args.serve:
+            host, _, server_port = args.serve.rpartition(':')
+            server_address = (host or '0.0.0.0', int(server_port))
+        log_server = LogServer(callback = error_handler,
+                               address = server_address,
+                               unix_path = args.serve_unix,
+                               history_bytes = args.history_bytes)
+        log_server.open()  # clients may connect from now on
+        log_server.start()
+
+    metrics_dumper = None
+    if args.metrics_prometheus or args.metrics_json:
+        metrics_dumper = MetricsDumper(interval = args.metrics_interval,
+                                       prometheus_path = args.metrics_prometheus,
+                                       json_path = args.metrics_json)
+        if log_server:
+            metrics_dumper.add_source(log_server.stats, stage = 'server')
+
+    if len(port_names) > 1 or args.processes:
+        # Open all serial ports without blocking reads, or read each in a worker process, and log
+        # them on a single thread
+        serial_ports = []
+        workers = []
+        captures = []
+        raw_captures = []
+        logger = None
         try:
-            reader = SerialReader(serial = serial_port, callback = error_handler, do_timestamp = timestamp)
-
-            if log_file:
-                def write_error_handler(error_string):
-                    reader.detach(file_writer)
-                    error_handler(error_string)
-
-                file_writer = SerialFileWriter(log_file_path = log_file, callback = write_error_handler)
-                reader.attach(file_writer)
-                file_writer.start()
-
-            reader.attach(SerialPrinter())  # printing to console is always on
-
-            reader.start()
+            logger = MultiPortLogger(callback = error_handler)
+            clock_base = ClockBase()  # timestamps of all ports on the same time line
+            merged_sink = None
+            if args.merge:
+                merged_sink = MergedLogSink(log_file_path = args.merge,
+                                            window = args.merge_window,
+                                            flush_policy = flush_policy,
+                                            rotation_policy = rotation_policy,
+                                            archiver = create_archiver(args.merge),
+                                            index_policy = index_policy)
+                logger.add_sink(merged_sink)
+                if metrics_dumper:
+                    metrics_dumper.add_source(merged_sink.stats, stage = 'merge')
+            for port_name in port_names:
+                raw_capture = None
+                if args.processes:
+                    channel = PortWorker(name = port_name,
+                                         serial_factory = partial(Serial, port = port_name, baudrate = 115200,
+                                                                  timeout = 1),
+                                         do_timestamp = timestamp,
+                                         chunked = chunked,
+                                         time_format = args.timestamp_format,
+                                         clock_base = clock_base,
+                                         matcher = matcher,
+                                         reconnect = port_watcher,
+                                         collapser = create_collapser())
+                    workers.append(channel)
+                else:
+                    serial_port = Serial(port = port_name, baudrate = 115200, timeout = 0)
+                    serial_ports.append(serial_port)
+                    if args.raw:
+                        raw_capture = RawCaptureWriter(port_log_file_path(args.raw, port_name), error_handler,
+                                                       fsync = args.fsync)
+                        raw_capture.start()
+                        raw_captures.append(raw_capture)
+                    channel = PortChannel(serial = serial_port,
+                                          do_timestamp = timestamp,
+                                          time_format = args.timestamp_format,
+                                          clock_base = clock_base,
+                                          matcher = matcher,
+                                          raw_capture = raw_capture,
+                                          frame_splitter = create_frame_splitter(port_name),
+                                          collapser = create_collapser())
+                if log_file:
+                    port_log_file = port_log_file_path(log_file, port_name)
+                    capture = create_capture(port_log_file)
+                    if capture:
+                        channel.attach(capture)
+                        captures.append(capture)
+                    sink = LogFileSink(log_file_path = port_log_file,
+                                       flush_policy = flush_policy,
+                                       rotation_policy = rotation_policy,
+                                       archiver = create_archiver(port_log_file),
+                                       index_policy = index_policy)
+                    channel.attach(sink)
+                    logger.add_sink(sink)
+                    if metrics_dumper:
+                        metrics_dumper.add_source(sink.stats, port = port_name, stage = 'writer')
+                if merged_sink:
+                    channel.attach(merged_sink.tap(port_name))
+                if log_server:
+                    channel.attach(log_server.tap(port_name))
+                recorder = create_recorder(port_log_file_path(args.flight_recorder, port_name)
+                                           if args.flight_recorder else None)
+                if recorder:
+                    channel.attach(recorder)
+                    if metrics_dumper:
+                        metrics_dumper.add_source(recorder.stats, port = port_name, stage = 'recorder')
+                channel.attach(SerialPrinter(console_writer, tag = port_name))  # printing to console is always on
+                logger.add_channel(channel)
+                if metrics_dumper:
+                    metrics_dumper.add_source(channel.stats, port = port_name, stage = 'reader')
+                    if raw_capture:
+                        metrics_dumper.add_source(raw_capture.stats, port = port_name, stage = 'raw_capture')
+
+            for worker in workers:
+                worker.start()
+            logger.start()
+            if metrics_dumper:
+                metrics_dumper.start()
 
             check_for_any_key_to_quit()
         finally:
-            # tear down serial reader and file writer threads before exiting
-            if reader.is_alive():
-                reader.stop()
-
-            if file_writer and file_writer.is_alive():
-                file_writer.stop()
+            # tear down the workers, which publish their last lines, the logger thread and close
+            # the ports before exiting
+            for worker in workers:
+                worker.stop()
+            if logger and logger.is_alive():
+                logger.stop()
+            if metrics_dumper:
+                metrics_dumper.stop()  # a last dump of the final stats
+            for worker in workers:
+                worker.close()
+            for capture in captures:
+                capture.stop()
+            for raw_capture in raw_captures + frame_captures:
+                raw_capture.stop()
+            for recorder in recorders:
+                recorder.stop()
+            for serial_port in serial_ports:
+                serial_port.close()
+            if log_server:
+                log_server.stop()
+            console_writer.stop()
+    else:
+        # Open the serial port specified by port name
+        port_name = port_names[0]
+        with Serial(port = port_name, baudrate = 115200, timeout = 1) as serial_port:
+
+            file_writer, reader, capture, raw_capture = None, None, None, None
+            try:
+                if args.raw:
+                    raw_capture = RawCaptureWriter(args.raw, error_handler, fsync = args.fsync)
+                    raw_capture.start()
+
+                read_mode = SerialReader.CHUNK_MODE if chunked else SerialReader.LINE_MODE
+                if args.raw_only:
+                    read_mode = SerialReader.RAW_MODE
+                reader = SerialReader(serial = serial_port,
+                                      callback = error_handler,
+                                      do_timestamp = timestamp,
+                                      read_mode = read_mode,
+                                      async_dispatch = args.async_dispatch,
+                                      time_format = args.timestamp_format,
+                                      matcher = matcher,
+                                      raw_capture = raw_capture,
+                                      reconnect = port_watcher,
+                                      frame_splitter = create_frame_splitter(),
+                                      collapser = create_collapser())
+
+                if log_file:
+                    def write_error_handler(error_string):
+                        reader.detach(file_writer)
+                        error_handler(error_string)
+
+                    file_writer = SerialFileWriter(log_file_path = log_file,
+                                                   callback = write_error_handler,
+                                                   flush_policy = flush_policy,
+                                                   queue_capacity = args.queue_size,
+                                                   overflow_policy = args.overflow,
+                                                   rotation_policy = rotation_policy,
+                                                   archiver = create_archiver(log_file),
+                                                   index_policy = index_policy)
+                    reader.attach(file_writer)
+                    file_writer.start()
+
+                    capture = create_capture(log_file)
+                    if capture:
+                        reader.attach(capture)
+
+                reader.attach(SerialPrinter(console_writer))  # printing to console is always on
+                if log_server:
+                    reader.attach(log_server.tap())
+                recorder = create_recorder(args.flight_recorder)
+                if recorder:
+                    reader.attach(recorder)
+
+                if metrics_dumper:
+                    metrics_dumper.add_source(reader.stats, port = port_name, stage = 'reader')
+                    if file_writer:
+                        metrics_dumper.add_source(file_writer.stats, port = port_name, stage = 'writer')
+                    if raw_capture:
+                        metrics_dumper.add_source(raw_capture.stats, port = port_name, stage = 'raw_capture')
+                    if recorder:
+                        metrics_dumper.add_source(recorder.stats, port = port_name, stage = 'recorder')
+                    metrics_dumper.start()
+
+                reader.start()
+
+                check_for_any_key_to_quit()
+            finally:
+                # tear down serial reader and file writer threads before exiting
+                if reader and reader.is_alive():
+                    reader.stop()
+
+                if raw_capture:
+                    raw_capture.stop()
+
+                for frame_capture in frame_captures:
+                    frame_capture.stop()
+
+                if file_writer and file_writer.is_alive():
+                    file_writer.stop()
+
+                if capture:
+                    capture.stop()
+
+                for recorder in recorders:
+                    recorder.stop()
+
+                if metrics_dumper:
+                    metrics_dumper.stop()  # a last dump of the final stats
+
+                if log_server:
+                    log_server.stop()
+
+                console_writer.stop()
+
+                if replay:
+                    root_logger.info('replayed {lines_replayed} lines ({bytes_replayed} bytes) in {seconds:.3f} seconds: '
+                                     '{lines_per_second:.0f} lines/s, {bytes_per_second:.0f} bytes/s, '
+                                     'max lag {max_lag_seconds:.3f} seconds'.format(**replay.stats()))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+import bisect
+import io
+import json
+import logging
+import os
+import struct
+import sys
+from threading import Thread, Event
+from time import time
+
+try:
+    import fcntl  # not on windows
+except ImportError:
+    fcntl = None
+
+from timestamp import monotonic
+
+TIOCGICOUNT = 0x545D  # Linux
+# struct serial_icounter_struct: cts, dsr, rng, dcd, rx, tx, frame, overrun, parity, brk, buf_overrun
+# and 9 reserved ints
+_ICOUNTER = struct.Struct('20i')
+
+# The stats only ever increasing, which are counters to Prometheus. Other numbers are gauges.
+COUNTERS = frozenset(('bytes_read', 'lines_read', 'read_timeouts', 'bytes_written', 'lines_written',
+                      'rotations', 'restarts', 'dropped_lines', 'dropped_bytes', 'uart_frame_errors', 'uart_overruns',
+                      'uart_parity_errors', 'uart_breaks', 'uart_buffer_overruns'))
+
+
+def uart_counters(fd):
+    """
+    Reads the error counters of a UART kept by the serial driver, which tell about data lost before
+    it was read, e.g. when the receive FIFO overran.
+    :param fd: The file descriptor of the serial port.
+    :return: A dict of the counters or None if the port or platform does not keep them, e.g. a pty.
+    """
+    if fcntl is None or not sys.platform.startswith('linux') or fd is None:
+        return None
+    try:
+        counters = _ICOUNTER.unpack(fcntl.ioctl(fd, TIOCGICOUNT, b'\0' * _ICOUNTER.size))
+    except (IOError, OSError):
+        return None
+    return {'uart_frame_errors': counters[6],
+            'uart_overruns': counters[7],
+            'uart_parity_errors': counters[8],
+            'uart_breaks': counters[9],
+            'uart_buffer_overruns': counters[10]}
+
+
+class Histogram(object):
+    """
+    Counts observed values, e.g. latencies in seconds, in buckets by their upper bounds, as
+    Prometheus histograms do. Observing a value is a binary search of the bounds and an increment.
+    """
+    LATENCY_BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        """
+        :param bounds: The upper bounds of the buckets in increasing order. A last bucket without
+                       upper bound is added.
+        """
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._bounds)
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def buckets(self):
+        """
+        :return: A list of (upper bound, cumulative count), with the last upper bound being inf.
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self._bounds + (float('inf'),), self._counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return buckets
+
+    def to_dict(self):
+        mean = self.sum / self.count if self.count else 0.0
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': mean,
+                'max': self.max,
+                'buckets': [[bound if bound != float('inf') else '+Inf', count] for bound, count in self.buckets()]}
+
+
+def prometheus_text(samples, prefix='serial_logger_'):
+    """
+    Formats stats in the Prometheus text exposition format.
+    :param samples: A list of (labels, stats) where labels is a dict of label values and stats is a
+                    dict of numbers and histograms by name.
+    :param prefix: A prefix of all metric names.
+    :return: The text.
+    """
+    def label_text(labels, **extra):
+        items = sorted(labels.items()) + sorted(extra.items())
+        if not items:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, value in items) + '}'
+
+    metrics = {}  # name -> lines, so the samples of a metric are grouped as required
+    for labels, stats in samples:
+        for name, value in sorted(stats.items()):
+            metric = prefix + name
+            if isinstance(value, Histogram):
+                lines = metrics.setdefault(metric, ['# TYPE {} histogram'.format(metric)])
+                for bound, count in value.buckets():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(metric, label_text(labels, le=le), count))
+                lines.append('{}_sum{} {!r}'.format(metric, label_text(labels), value.sum))
+                lines.append('{}_count{} {}'.format(metric, label_text(labels), value.count))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric_type = 'counter' if name in COUNTERS else 'gauge'
+                lines = metrics.setdefault(metric, ['# TYPE {} {}'.format(metric, metric_type)])
+                lines.append('{}{} {!r}'.format(metric, label_text(labels), value))
+    return ''.join(line + '\n' for name in sorted(metrics) for line in metrics[name])
+
+
+class MetricsDumper(Thread):
+    """
+    This thread dumps the stats of the reader and writer objects periodically to a Prometheus
+    textfile, e.g. for the textfile collector of the node exporter, and/or a JSON file. The files
+    are replaced atomically by renaming, so a partial file is never read. The JSON file also has
+    the rates per second since the last dump of the counters in RATES.
+    Thread quits if stop() is called, after a last dump.
+    """
+    INTERVAL = 10.0
+    RATES = ('bytes_read', 'lines_read', 'bytes_written', 'lines_written', 'dropped_lines')
+
+    def __init__(self, interval=INTERVAL, prometheus_path=None, json_path=None):
+        """
+        :param interval: The number of seconds between dumps.
+        :param prometheus_path: The file path of the Prometheus textfile or None for none.
+        :param json_path: The file path of the JSON file or None for none.
+        """
+        super(MetricsDumper, self).__init__(name = self.__class__.__name__)
+        self.setDaemon(True)
+        self._interval = interval
+        self._prometheus_path = prometheus_path
+        self._json_path = json_path
+        self._sources = []
+        self._last = {}  # labels -> (monotonic time, stats) of the last dump
+        self._stop_event = Event()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._interval,
+                                             self._prometheus_path,
+                                             self._json_path)
+
+    def add_source(self, stats, **labels):
+        """
+        Adds an object to dump the stats of.
+        :param stats: A callable returning a dict of numbers and histograms by name, e.g. the
+                      stats method of a SerialReader or FileWriter.
+        :param labels: Labels telling the source apart, e.g. port='/dev/ttyUSB0'.
+        """
+        self._sources.append((labels, stats))
+
+    def stop(self):
+        """
+        Stop dumping after a last dump and commit suicide.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _rates(self, labels, stats, now):
+        key = tuple(sorted(labels.items()))
+        last_time, last_stats = self._last.get(key, (None, None))
+        self._last[key] = (now, stats)
+        if last_time is None or now <= last_time:
+            return {}
+        return dict((name + '_per_s', (stats[name] - last_stats.get(name, 0)) / (now - last_time))
+                    for name in self.RATES if name in stats)
+
+    @staticmethod
+    def _replace(path, text):
+        tmp_path = path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf8') as tmp_file:
+            tmp_file.write(text)
+        os.rename(tmp_path, path)  # atomic on POSIX
+
+    def dump(self):
+        """
+        Dumps the stats of all sources now.
+        """
+        now = monotonic()
+        samples = [(labels, stats()) for labels, stats in self._sources]
+        if self._prometheus_path:
+            self._replace(self._prometheus_path, u'' + prometheus_text(samples))
+        if self._json_path:
+            document = {'time': time(),
+                        'sources': [{'labels': labels,
+                                     'stats': dict((name, value.to_dict() if isinstance(value, Histogram) else value)
+                                                   for name, value in stats.items()),
+                                     'rates': self._rates(labels, stats, now)}
+                                    for labels, stats in samples]}
+            self._replace(self._json_path, u'' + json.dumps(document, sort_keys=True, indent=2))
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self._dump_safely()
+        self._dump_safely()
+
+    def _dump_safely(self):
+        try:
+            self.dump()
+        except Exception as e:  # metrics failing must not stop logging
+            self.logger.error('Error: {}'.format(e))
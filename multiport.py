@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+import errno
+import logging
+import os
+import select
+from threading import Thread, Event
+
+from observer import Observable, Observer
+from serial.serialutil import SerialException
+
+from filewriter import LogFile
+from metrics import Histogram, uart_counters
+from serialreader import LineSplitter, SerialReader, escape
+from timestamp import TimeStamper, monotonic, wall_time
+
+
+class PortChannel(Observable):
+    """
+    A serial port read by a MultiPortLogger. Log lines are updated to its registered observers in
+    the same way as by a SerialReader, but reading is driven by the event loop of the logger.
+    Ports having a file descriptor are read when readable without blocking, and other ports, like
+    fake ports, are polled on every turn of the event loop.
+    Lines are matched by a PatternMatcher, if any, the bytes read are put to a raw capture, if any,
+    binary frames are split from the text by a FrameSplitter, if any, and repeated lines are
+    collapsed by a LineCollapser, if any, in the same way as by a SerialReader, which is also what
+    stats() returns.
+    """
+
+    def __init__(self, serial, do_timestamp = True, chunk_size = SerialReader.CHUNK_SIZE,
+                 time_format = TimeStamper.RELATIVE, clock_base = None, matcher = None,
+                 raw_capture = None, frame_splitter = None, collapser = None):
+        """
+        :param serial: An open Serial object for communicating with a serial port.
+        :type Serial
+        :param do_timestamp: Add a timestamp to each line intercepted from the serial port.
+        :param chunk_size: The max number of bytes read at once.
+        :param time_format: The timestamp format, one of TimeStamper.FORMATS.
+        :param clock_base: A ClockBase shared with the other ports, or None to base relative
+                           timestamps on the first line arriving.
+        :param matcher: A PatternMatcher of rules to watch for or None for no matching.
+        :param raw_capture: A RawCaptureWriter to put the bytes read to or None for no raw capture.
+        :param frame_splitter: A FrameSplitter splitting binary frames from the text or None for
+                               text only.
+        :param collapser: A LineCollapser collapsing repeated lines or None to pass on every line.
+        """
+        Observable.__init__(self)
+        self._port = serial
+        self._do_timestamp = do_timestamp
+        self._chunk_size = chunk_size
+        self._splitter = LineSplitter() if frame_splitter is None else frame_splitter
+        self._framed = frame_splitter is not None
+        self._time_stamper = TimeStamper(time_format, clock_base)
+        self._matcher = matcher
+        self._raw_capture = raw_capture
+        self._collapser = collapser
+        self._bytes_read = 0
+        self._lines_read = 0
+        self._dispatch_time = Histogram()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        try:
+            self._fd = serial.fileno()
+        except (AttributeError, IOError, ValueError, SerialException):  # e.g. fake ports
+            self._fd = None
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._port, self._do_timestamp)
+
+    @property
+    def name(self):
+        """The name of the serial port."""
+        return self._port.port
+
+    def fileno(self):
+        """
+        :return: The file descriptor of the serial port or None if it must be polled.
+        """
+        return self._fd
+
+    def stats(self):
+        """
+        :return: A dict with the number of bytes and lines read, the UART error counters if the
+                 driver keeps them and a histogram of the seconds spent updating the observers per
+                 read, see SerialReader.stats().
+        """
+        stats = {'bytes_read': self._bytes_read,
+                 'lines_read': self._lines_read,
+                 'dispatch_seconds': self._dispatch_time}
+        stats.update(uart_counters(self._fd) or {})
+        if self._collapser is not None:
+            stats.update(self._collapser.stats())
+        for framer in self._splitter.framers if self._framed else ():
+            for stat, value in framer.stats().items():
+                stats['frames_{}_{}'.format(framer.name, stat)] = value
+        return stats
+
+    def read(self):
+        """
+        Reads what is available from the serial port without blocking and updates the observers
+        with the completed lines.
+        :raises SerialException if the port fails or is disconnected.
+        """
+        if self._fd is not None:
+            try:
+                data = os.read(self._fd, self._chunk_size)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise SerialException('read failed: {}'.format(e))
+            if not data:  # readable without data means disconnected
+                raise SerialException('device reports readiness to read but returned no data')
+        else:
+            waiting = self._port.inWaiting()
+            data = self._port.read(min(waiting, self._chunk_size) if waiting else 1)
+            if not data:
+                return
+
+        arrival_time = monotonic()
+        self._bytes_read += len(data)
+        if self._raw_capture is not None:
+            self._raw_capture.put(data, arrival_time)
+        raw_lines = self._splitter.feed(data, arrival_time) if self._framed else self._splitter.feed(data)
+        matches = self._matcher.match_lines(raw_lines) if self._matcher is not None else {}
+        for i, raw_line in enumerate(raw_lines):
+            self._handle_line(raw_line, arrival_time, matches.get(i, ()))
+        if raw_lines:
+            self._dispatch_time.observe(monotonic() - arrival_time)
+
+    def _handle_line(self, raw_line, arrival_time, rules):
+        raw_line = raw_line.strip()
+        if raw_line:  # blank lines are dropped
+            line = escape(raw_line)
+            if rules:
+                line = self._matcher.trigger(rules, line, arrival_time)
+            rule_names = tuple(rule.name for rule in rules) if rules else ()
+            if self._collapser is None:
+                self._notify_line(line, arrival_time, rule_names)
+            else:
+                for collapsed in self._collapser.feed(line, arrival_time, rule_names):
+                    self._notify_line(*collapsed)
+            self._lines_read += 1
+
+    def _notify_line(self, line, arrival_time, rule_names):
+        if self._do_timestamp:
+            line = self._time_stamper.stamp(line, arrival_time)
+        self.notify(line, arrival_time, rule_names)  # update listeners
+
+    def flush_partial_line(self):
+        """
+        Updates the observers with the partial line buffered by the splitter, if any, e.g. when
+        stopped or when the port is removed.
+        """
+        for raw_line in self._splitter.flush():
+            self._handle_line(raw_line, monotonic(), self._matcher.match(raw_line) if self._matcher else ())
+
+    def expire_repeats(self, flush=False):
+        """
+        Updates the observers with the summary of the repeated lines collapsed, if due.
+        :param flush: Update the summary whether due or not, e.g. when stopped.
+        """
+        if self._collapser is not None:
+            for collapsed in self._collapser.flush() if flush else self._collapser.expire(monotonic()):
+                self._notify_line(*collapsed)
+
+
+class LogFileSink(Observer):
+    """
+    Intercepts log lines and writes these to a log file on the event loop of a MultiPortLogger.
+    Log lines of one turn of the event loop are written to the log file as one batch.
+    """
+
+    def __init__(self, log_file_path, flush_policy=None, rotation_policy=None, archiver=None,
+                 index_policy=None):
+        """
+        :param log_file_path: The file path to write log lines to.
+        :param flush_policy: A FlushPolicy deciding when to flush. A default policy if None.
+        :param rotation_policy: A RotationPolicy deciding when to rotate or None to never rotate.
+        :param archiver: A SegmentArchiver for rotated segments. Required for rotation.
+        :param index_policy: An IndexPolicy deciding which lines to index or None for no index.
+        """
+        super(LogFileSink, self).__init__(self.__class__.__name__)
+        self._log_file = LogFile(log_file_path,
+                                 flush_policy=flush_policy,
+                                 rotation_policy=rotation_policy,
+                                 archiver=archiver,
+                                 index_policy=index_policy)
+        self._archiver = archiver
+        self._indexed = index_policy is not None
+        self._lines = []
+        self._arrival_times = []
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._log_file)
+
+    def open(self):
+        if self._archiver is not None:
+            self._archiver.start()
+        self._log_file.open()
+
+    def close(self):
+        try:
+            self.write_pending()
+            self._log_file.close()
+        finally:
+            if self._archiver is not None:
+                self._archiver.stop()
+
+    def update(self, data):
+        self._lines.append(data[0])  # data is a tuple
+        self._arrival_times.append(data[1])
+
+    def write_pending(self):
+        """
+        Writes the log lines intercepted since last called and flushes if due.
+        """
+        if self._lines:
+            lines, self._lines = self._lines, []
+            arrival_times, self._arrival_times = self._arrival_times, []
+            capture_times = None
+            if self._indexed:
+                capture_times = [wall_time(arrival_time) for arrival_time in arrival_times]
+            self._log_file.write_lines(lines, capture_times)
+        else:
+            self._log_file.flush_if_due()
+
+    def time_to_flush(self, default):
+        return self._log_file.time_to_flush(default)
+
+    def stats(self):
+        """
+        :return: The stats of the log file, see LogFile.stats().
+        """
+        return self._log_file.stats()
+
+
+class MultiPortLogger(Thread):
+    """
+    This thread logs many serial ports at once on a single event loop, instead of using a reader
+    and a writer thread per port. It waits with select() until any of the ports is readable, reads
+    all readable ports without blocking and then writes the log lines to the log file sinks.
+    Thread quits if stop() is called. If a port fails, it is removed and the thread will callback
+    to its owner, while the other ports are still logged.
+    """
+    POLL_INTERVAL = 0.01  # how often ports without a file descriptor are polled
+    SELECT_TMO = 0.5
+
+    def __init__(self, callback):
+        """
+        :param callback: A callback method for calling back to owner when error occurs.
+        """
+        super(MultiPortLogger, self).__init__(name = self.__class__.__name__)
+        self.setDaemon(True)
+        self._channels = []
+        self._sinks = []
+        self._stop_event = Event()
+        self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()  # wakes up select() when stopped
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._callback = callback
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self.getName(),
+                                             self.is_alive(),
+                                             self._channels)
+
+    def add_channel(self, channel):
+        """
+        Adds a port to be logged. Must be called before the thread is started.
+        :param channel: A PortChannel or a PortWorker.
+        """
+        self._channels.append(channel)
+
+    def add_sink(self, sink):
+        """
+        Adds a log file sink to be written on the event loop. Must be called before the thread is
+        started. The sink needs to be attached to the channels it logs.
+        :param sink: A LogFileSink.
+        """
+        self._sinks.append(sink)
+
+    def stop(self):
+        """
+        Stop logging all ports and commit suicide.
+        """
+        self._stop_event.set()
+        os.write(self._wakeup_write_fd, b'x')
+        self.logger.debug('stop logging serial ports')
+        if self.is_alive():
+            self.join()
+        os.close(self._wakeup_read_fd)
+        os.close(self._wakeup_write_fd)
+        self.logger.info('logger has terminated')
+
+    def _remove_failed(self, channel, error):
+        self.logger.error('Error: {}: {}'.format(channel.name, error))
+        self._channels.remove(channel)
+        channel.flush_partial_line()  # the rest of it is lost with the port
+        channel.expire_repeats(flush=True)
+        self._callback('{} has stopped logging {}. error: {}'.format(self.getName(), channel.name, error))
+
+    def _wait_for_readable(self):
+        """
+        :return: The channels to be read, which are the readable ones and the polled ones.
+        """
+        fd_channels, polled = {}, []
+        for channel in self._channels:
+            fd = channel.fileno()  # may change between calls, e.g. for workers
+            if fd is None:
+                polled.append(channel)
+            else:
+                fd_channels[fd] = channel
+        timeout = self.POLL_INTERVAL if polled else self.SELECT_TMO
+        for sink in self._sinks:
+            timeout = sink.time_to_flush(timeout)
+
+        try:
+            readable, _, _ = select.select(list(fd_channels) + [self._wakeup_read_fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [fd_channels[fd] for fd in readable if fd in fd_channels] + polled
+
+    def _read(self, channels):
+        for channel in channels:
+            try:
+                channel.read()
+            except (SerialException, OSError, IOError) as e:
+                self._remove_failed(channel, e)
+
+    def run(self):
+        try:
+            for sink in self._sinks:
+                sink.open()
+            self.logger.info('Start logging {} serial ports.'.format(len(self._channels)))
+
+            while not self._stop_event.is_set():
+                self._read(self._wait_for_readable())
+                for channel in self._channels:
+                    channel.expire_repeats()
+                for sink in self._sinks:
+                    sink.write_pending()
+            self._read(list(self._channels))  # what is left, e.g. lines of workers stopped before
+            for channel in self._channels:
+                channel.flush_partial_line()
+                channel.expire_repeats(flush=True)
+        except Exception as e:  # this may occur if writing a log file fails
+            self.logger.error('Error: {}'.format(e))
+            self._callback('{} has stopped running. error: {}'.format(self.getName(), e))
+        finally:
+            for sink in self._sinks:
+                try:
+                    sink.close()
+                except Exception as e:
+                    self.logger.error('Error: {}'.format(e))
+
+        self.logger.info('stopped logging serial ports.')
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+import errno
+import logging
+import os
+import select
+import socket
+from collections import deque
+from threading import Thread, Event
+
+from observer import Observer
+
+
+class ServerTap(Observer):
+    """
+    Intercepts log lines and puts these, tagged if a tag is given, to a LogServer.
+    """
+
+    def __init__(self, server, tag=None):
+        """
+        :param server: The LogServer serving the log lines.
+        :param tag: A tag put before each log line, e.g. the port name, or None for no tag.
+        """
+        super(ServerTap, self).__init__(self.__class__.__name__)
+        self._server = server
+        self._prefix = u'[{}] '.format(tag).encode('utf8') if tag else b''
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._server, self._prefix)
+
+    def update(self, data):
+        log_line = data[0]  # data is a tuple
+        self._server.put(self._prefix + log_line if self._prefix else log_line)
+
+
+class LogServer(Thread):
+    """
+    This thread streams log lines live to any number of clients connecting over TCP or a Unix
+    domain socket, e.g. with 'nc host 5000' or 'socat - UNIX-CONNECT:/tmp/serial.sock'. Putting a
+    log line is only an append to a backlog, whatever the number of clients, so clients never add
+    load to the reader or the file writer. The event loop joins the backlog once per interval
+    and appends it to a bounded send buffer per client, which is written without blocking when the
+    client is writable. A client whose send buffer overflows is too slow and is evicted. A new
+    client first gets the recent history, at most history_bytes of the latest log lines.
+    Thread quits if stop() is called. If serving fails, this thread will callback to its owner.
+    """
+    INTERVAL = 0.05
+    HISTORY_BYTES = 1024 * 1024
+    CLIENT_BUFFER_BYTES = 4 * 1024 * 1024
+    MAX_BACKLOG = 100000
+    LISTEN_BACKLOG = 16
+    RECV_SIZE = 4096
+
+    def __init__(self, callback, address=None, unix_path=None, history_bytes=HISTORY_BYTES,
+                 client_buffer_bytes=CLIENT_BUFFER_BYTES, interval=INTERVAL):
+        """
+        :param callback: A callback method for calling back to owner when error occurs.
+        :param address: A (host, port) to listen on with TCP or None.
+        :param unix_path: A file path to listen on with a Unix domain socket or None.
+        :param history_bytes: The max number of bytes of recent log lines sent to a new client.
+        :param client_buffer_bytes: The max number of bytes waiting to be sent to a client.
+        :param interval: The number of seconds between sending batches of log lines.
+        """
+        if address is None and unix_path is None:
+            raise ValueError('address or unix_path required')
+        super(LogServer, self).__init__(name = self.__class__.__name__)
+        self.setDaemon(True)
+        self._callback = callback
+        self._address = address
+        self._unix_path = unix_path
+        self._history_bytes = history_bytes
+        self._client_buffer_bytes = client_buffer_bytes
+        self._interval = interval
+        self._backlog = deque()
+        self._history = deque()
+        self._history_size = 0
+        self._listeners = []
+        self._clients = {}  # socket -> bytearray of data waiting to be sent
+        self._stop_event = Event()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.overflowed = 0  # lines not fitting in the backlog
+        self.clients_served = 0
+        self.clients_evicted = 0
+        self.bytes_sent = 0
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._address,
+                                             self._unix_path,
+                                             len(self._clients))
+
+    def tap(self, tag=None):
+        """
+        :param tag: A tag put before each log line, e.g. the port name, or None for no tag.
+        :return: An observer to attach to a reader or a channel.
+        """
+        return ServerTap(self, tag)
+
+    def put(self, line):
+        """
+        Puts a log line to be sent to the clients.
+        :param line: A log line as bytes without end line characters.
+        """
+        if len(self._backlog) < self.MAX_BACKLOG:
+            self._backlog.append(line)  # deque appends are thread-safe
+        else:
+            self.overflowed += 1
+
+    def stats(self):
+        """
+        :return: A dict with the number of clients connected, served and evicted, the bytes sent,
+                 the bytes of history kept and the lines not fitting in the backlog.
+        """
+        return {'clients': len(self._clients),
+                'clients_served': self.clients_served,
+                'clients_evicted': self.clients_evicted,
+                'bytes_sent': self.bytes_sent,
+                'history_bytes': self._history_size,
+                'overflowed_lines': self.overflowed}
+
+    def open(self):
+        """
+        Starts listening, so clients may connect as soon as this returns.
+        """
+        if self._address is not None:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listen(listener, self._address)
+        if self._unix_path is not None:
+            if os.path.exists(self._unix_path):  # left by a previous run
+                os.remove(self._unix_path)
+            self._listen(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), self._unix_path)
+
+    def _listen(self, listener, address):
+        listener.bind(address)
+        listener.listen(self.LISTEN_BACKLOG)
+        listener.setblocking(False)
+        self._listeners.append(listener)
+        self.logger.info('serving log lines on {}'.format(address))
+
+    def stop(self):
+        """
+        Stop serving after sending the last batch and commit suicide.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _accept(self, listener):
+        try:
+            client, address = listener.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        client.setblocking(False)
+        self._clients[client] = bytearray(b''.join(self._history))
+        self.clients_served += 1
+        self.logger.info('client {} connected'.format(address or self._unix_path))
+
+    def _close(self, client, reason):
+        self.logger.info('client disconnected: {}'.format(reason))
+        del self._clients[client]
+        client.close()
+
+    def _take_batch(self):
+        """
+        Joins the log lines put since last called into one batch and adds it to the history.
+        :return: The batch as bytes.
+        """
+        backlog = self._backlog
+        lines = [backlog.popleft() for _ in range(len(backlog))]
+        if not lines:
+            return b''
+        batch = b'\n'.join(lines) + b'\n'
+        recent = batch
+        if len(recent) > self._history_bytes:  # only the latest lines of the batch, from a line start
+            recent = recent[recent.find(b'\n', len(recent) - self._history_bytes - 1) + 1:]
+        self._history.append(recent)
+        self._history_size += len(recent)
+        while self._history_size > self._history_bytes and len(self._history) > 1:
+            self._history_size -= len(self._history.popleft())
+        return batch
+
+    def _send(self, client):
+        buf = self._clients[client]
+        try:
+            sent = client.send(buf)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._close(client, e)
+            return
+        del buf[:sent]
+        self.bytes_sent += sent
+
+    def _receive(self, client):
+        try:
+            data = client.recv(self.RECV_SIZE)  # anything sent by the client is ignored
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+        if not data:
+            self._close(client, 'closed by client')
+
+    def _serve(self, timeout):
+        batch = self._take_batch()
+        if batch:
+            for client, buf in list(self._clients.items()):
+                if len(buf) + len(batch) > self._client_buffer_bytes:
+                    self.clients_evicted += 1
+                    self._close(client, 'too slow, {} bytes waiting'.format(len(buf)))
+                else:
+                    buf.extend(batch)
+
+        writing = [client for client, buf in self._clients.items() if buf]
+        try:
+            readable, writable, _ = select.select(self._listeners + list(self._clients), writing, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for sock in readable:
+            if sock in self._listeners:
+                self._accept(sock)
+            elif sock in self._clients:
+                self._receive(sock)
+        for client in writable:
+            if client in self._clients:
+                self._send(client)
+
+    def run(self):
+        try:
+            if not self._listeners:
+                self.open()
+            while not self._stop_event.is_set():
+                self._serve(self._interval)
+            self._serve(0)
+        except Exception as e:  # this may occur if listening fails
+            self.logger.error('Error: {}'.format(e))
+            self._callback('{} has stopped running. error: {}'.format(self.getName(), e))
+        finally:
+            for client in list(self._clients):
+                self._close(client, 'server stopped')
+            for listener in self._listeners:
+                listener.close()
+            if self._unix_path is not None and os.path.exists(self._unix_path):
+                os.remove(self._unix_path)
+
+        self.logger.info('stopped serving log lines.')
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+import errno
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+
+try:
+    import fcntl  # not on windows
+except ImportError:
+    fcntl = None
+
+from observer import Observable, Observer
+
+from metrics import Histogram
+from serialreader import SerialReader
+from timestamp import TimeStamper, monotonic
+
+try:
+    _context = multiprocessing.get_context('fork')  # rings are inherited by the workers, not pickled
+except (AttributeError, ValueError):  # Python 2 always forks on POSIX
+    _context = multiprocessing
+
+
+class SharedRing(object):
+    """
+    A ring buffer of log lines in memory shared by a worker process writing it and the parent
+    process reading it, so lines are passed as bytes without being pickled one by one. There must
+    be a single writer and a single reader.
+    The header holds the write position, the read position and the number of lines dropped, where
+    the positions are byte counts that only grow and each is stored by one process only. A record
+    is the RECORD header followed by the line and the rule names as utf8. A record never wraps
+    around the end of the ring; the rest of the ring is skipped instead, marked by WRAP if it has
+    room for a record header. A record is published by storing the write position after it is
+    copied, so the reader never sees a partial record. When the ring is full, lines are dropped
+    and counted, so a slow parent never blocks reading the serial port.
+    """
+    SIZE = 4 * 1024 * 1024
+    HEADER = struct.Struct('<QQQ')  # write position, read position, dropped lines
+    DATA_OFFSET = 64  # the header is padded to a cache line
+    RECORD = struct.Struct('<IdH')  # line length, arrival time, rule names length
+    WRAP = 0xffffffff
+    _WRITE, _READ, _DROPPED = 0, 8, 16
+    _POSITION = struct.Struct('<Q')
+
+    def __init__(self, size=SIZE):
+        """
+        :param size: The number of bytes of the ring. A line longer than that is dropped.
+        """
+        self._size = size
+        self._mmap = mmap.mmap(-1, self.DATA_OFFSET + size)  # anonymous memory shared on fork
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._size)
+
+    def _load(self, offset):
+        return self._POSITION.unpack_from(self._mmap, offset)[0]
+
+    def _store(self, offset, value):
+        self._POSITION.pack_into(self._mmap, offset, value)
+
+    @property
+    def dropped(self):
+        return self._load(self._DROPPED)
+
+    def used(self):
+        """
+        :return: The number of bytes written and not yet read.
+        """
+        return self._load(self._WRITE) - self._load(self._READ)
+
+    def put(self, line, arrival_time, names=b''):
+        """
+        Writes a record. Must only be called by the writer.
+        :param line: The log line as bytes.
+        :param arrival_time: The monotonic time when the line arrived.
+        :param names: The names of the rules matching the line, joined by newlines, as utf8.
+        :return: True if the reader had read all records before this one, checked after publishing
+                 it, so the reader may be waiting for it, else False.
+        """
+        write, read = self._load(self._WRITE), self._load(self._READ)
+        record_size = self.RECORD.size + len(line) + len(names)
+        start = write % self._size
+        skipped = self._size - start if start + record_size > self._size else 0
+        if write + skipped + record_size - read > self._size:
+            self._store(self._DROPPED, self._load(self._DROPPED) + 1)
+            return False
+
+        if skipped >= self.RECORD.size:
+            self.RECORD.pack_into(self._mmap, self.DATA_OFFSET + start, self.WRAP, 0.0, 0)
+        offset = self.DATA_OFFSET + (write + skipped) % self._size
+        self.RECORD.pack_into(self._mmap, offset, len(line), arrival_time, len(names))
+        offset += self.RECORD.size
+        self._mmap[offset:offset + len(line)] = line
+        offset += len(line)
+        self._mmap[offset:offset + len(names)] = names
+        self._store(self._WRITE, write + skipped + record_size)  # publishes the record
+        return self._load(self._READ) == write  # the reader may have caught up while writing
+
+    def get_all(self):
+        """
+        Reads all records published. Must only be called by the reader. Records published while
+        reading are left for the next call, and the writer may not wake up the reader for them,
+        see PortWorker.fileno().
+        :return: A list of (line, arrival time, names) as written.
+        """
+        write, read = self._load(self._WRITE), self._load(self._READ)
+        records = []
+        data = self._mmap
+        while read < write:
+            start = read % self._size
+            rest = self._size - start
+            if rest < self.RECORD.size:
+                read += rest
+                continue
+            offset = self.DATA_OFFSET + start
+            line_length, arrival_time, names_length = self.RECORD.unpack_from(data, offset)
+            if line_length == self.WRAP:
+                read += rest
+                continue
+            offset += self.RECORD.size
+            records.append((data[offset:offset + line_length],
+                            arrival_time,
+                            data[offset + line_length:offset + line_length + names_length]))
+            read += self.RECORD.size + line_length + names_length
+        self._store(self._READ, read)  # frees the records read
+        return records
+
+    def close(self):
+        self._mmap.close()
+
+
+class RingWriter(Observer):
+    """
+    Intercepts log lines in a worker process and writes these to a shared ring. The parent is
+    woken up by a byte written to a pipe only when it had read all of the ring, since it reads all
+    of the ring once awake.
+    """
+
+    def __init__(self, ring, wakeup_fd):
+        """
+        :param ring: The SharedRing to write to.
+        :param wakeup_fd: The write end of the pipe waking up the parent.
+        """
+        super(RingWriter, self).__init__(self.__class__.__name__)
+        self._ring = ring
+        self._wakeup_fd = wakeup_fd
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._ring)
+
+    def update(self, data):
+        line, arrival_time, rule_names = data  # data is a tuple
+        names = u'\n'.join(rule_names).encode('utf8') if rule_names else b''
+        if self._ring.put(line, arrival_time, names):
+            try:
+                os.write(self._wakeup_fd, b'x')
+            except OSError as e:
+                if e.errno != errno.EAGAIN:  # the pipe is full, so the parent is woken up anyway
+                    raise
+
+
+def _run_worker(serial_factory, reader_options, ring, wakeup_fd, stop_event, parent_pid):
+    """
+    The main function of a worker process. Opens the serial port and reads it with a SerialReader
+    writing the log lines to the ring, until stopped, the reader fails or the parent is gone.
+    Exits with status 1 if the reader failed.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops the workers
+    logger = logging.getLogger('PortWorker')
+    errors = []
+    serial = serial_factory()
+    try:
+        reader = SerialReader(serial, errors.append, **reader_options)
+        reader.attach(RingWriter(ring, wakeup_fd))
+        reader.start()
+        while not stop_event.wait(PortWorker.SUPERVISE_INTERVAL):
+            if not reader.is_alive() or os.getppid() != parent_pid:
+                break
+        reader.stop()
+    finally:
+        serial.close()
+    if errors:
+        logger.error(errors[0])
+        os._exit(1)
+
+
+class PortWorker(Observable):
+    """
+    A serial port read by a worker process of its own and logged by a MultiPortLogger in the
+    parent process, so reading, splitting, matching, escaping and timestamping the lines of each
+    port runs in parallel on its own core instead of sharing the interpreter lock of the parent.
+    The worker passes the log lines to the parent through a SharedRing, without pickling them, and
+    the parent updates the observers of this channel with them as (line, arrival_time,
+    rule_names), like a PortChannel does, so the sinks and the console stay in the parent.
+    The worker is supervised by the parent. If it exits before being stopped, e.g. when the port
+    fails, it is restarted after a delay, which doubles on each restart up to MAX_RESTART_DELAY
+    and is reset when the worker has run for STABLE_UPTIME seconds. Lines published before a
+    crash are still logged. Requires a platform which forks, i.e. not windows.
+    """
+    RESTART_DELAY = 1.0
+    MAX_RESTART_DELAY = 30.0
+    STABLE_UPTIME = 60.0
+    SUPERVISE_INTERVAL = 0.2
+    STOP_TMO = 5.0
+    READ_SIZE = 4096
+
+    def __init__(self, name, serial_factory, do_timestamp = True, chunked = True,
+                 time_format = TimeStamper.RELATIVE, clock_base = None, matcher = None,
+                 ring_size = SharedRing.SIZE, reconnect = None, collapser = None):
+        """
+        :param name: The name of the serial port.
+        :param serial_factory: A callable returning an open Serial object with a read timeout set,
+                               called in the worker process, e.g. functools.partial(Serial, ...).
+        :param do_timestamp: Add a timestamp to each line intercepted from the serial port.
+        :param chunked: Read in chunks for high baud rates, see SerialReader.CHUNK_MODE.
+        :param time_format: The timestamp format, one of TimeStamper.FORMATS.
+        :param clock_base: A ClockBase shared with the other ports, or None to base relative
+                           timestamps on the first line arriving.
+        :param matcher: A PatternMatcher of rules to watch for or None for no matching. The actions
+                        of the rules are called in the worker process.
+        :param ring_size: The number of bytes of the shared ring.
+        :param reconnect: A PortWatcher the worker waits for the port to come back with after an
+                          I/O error, instead of exiting to be restarted, or None.
+        :param collapser: A LineCollapser the worker collapses repeated lines with or None.
+        """
+        Observable.__init__(self)
+        self._name = name
+        self._serial_factory = serial_factory
+        self._reader_options = {'do_timestamp': do_timestamp,
+                                'read_mode': SerialReader.CHUNK_MODE if chunked else SerialReader.LINE_MODE,
+                                'time_format': time_format,
+                                'clock_base': clock_base,
+                                'matcher': matcher,
+                                'reconnect': reconnect,
+                                'collapser': collapser}
+        self._ring = SharedRing(ring_size)
+        self._process = None
+        self._stop_event = None
+        self._wakeup_fd = None
+        self._started_at = None
+        self._restart_at = None
+        self._restart_delay = self.RESTART_DELAY
+        self._stopping = False
+        self._restarts = 0
+        self._lines_read = 0
+        self._dropped = 0
+        self._dispatch_time = Histogram()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._name, self._process)
+
+    @property
+    def name(self):
+        """The name of the serial port."""
+        return self._name
+
+    def fileno(self):
+        """
+        :return: The read end of the pipe waking up the parent, or None while lines are left in the
+                 ring or while waiting to restart the worker, so it is polled.
+        """
+        if self._ring.used():  # put while the ring was read, so the wakeup may have been skipped
+            return None
+        return self._wakeup_fd
+
+    def stats(self):
+        """
+        :return: A dict with the number of lines read and dropped because the ring was full, the
+                 number of restarts of the worker, the bytes used of the ring and a histogram of
+                 the seconds spent updating the observers per read.
+        """
+        return {'lines_read': self._lines_read,
+                'dropped_lines': self._ring.dropped,
+                'restarts': self._restarts,
+                'ring_used_bytes': self._ring.used(),
+                'dispatch_seconds': self._dispatch_time}
+
+    def start(self):
+        """
+        Starts the worker process.
+        """
+        read_fd, write_fd = os.pipe()
+        if fcntl is not None:
+            for fd in (read_fd, write_fd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._stop_event = _context.Event()
+        self._process = _context.Process(target=_run_worker,
+                                         name='PortWorker-{}'.format(self._name),
+                                         args=(self._serial_factory, self._reader_options, self._ring,
+                                               write_fd, self._stop_event, os.getpid()))
+        self._process.daemon = True
+        try:
+            self._process.start()
+        finally:
+            os.close(write_fd)  # only the worker writes, so the pipe is at its end when it exits
+        self._wakeup_fd = read_fd
+        self._started_at = monotonic()
+        self.logger.info('started worker {} reading {}'.format(self._process.pid, self._name))
+
+    def stop(self):
+        """
+        Stops the worker process, which publishes the lines read before exiting. The lines left
+        in the ring are read by the logger, so it is stopped after the workers.
+        """
+        self._stopping = True
+        process = self._process  # the logger may find it exited meanwhile
+        if process is not None:
+            self._stop_event.set()
+            process.join(self.STOP_TMO)
+            if process.is_alive():
+                self.logger.warning('terminating worker reading {}'.format(self._name))
+                process.terminate()
+                process.join()
+
+    def close(self):
+        """
+        Releases the pipe and the ring. Must be called after the logger is stopped.
+        """
+        if self._wakeup_fd is not None:
+            os.close(self._wakeup_fd)
+            self._wakeup_fd = None
+        self._ring.close()
+
+    def _exited(self):
+        self._process.join()
+        os.close(self._wakeup_fd)
+        self._wakeup_fd = None
+        exit_code = self._process.exitcode
+        self._process = None
+        if self._stopping:
+            return
+        if monotonic() - self._started_at >= self.STABLE_UPTIME:
+            self._restart_delay = self.RESTART_DELAY
+        self.logger.error('worker reading {} exited with {}, restarting in {} seconds'.format(
+            self._name, exit_code, self._restart_delay))
+        self._restart_at = monotonic() + self._restart_delay
+        self._restart_delay = min(self._restart_delay * 2, self.MAX_RESTART_DELAY)
+
+    def flush_partial_line(self):
+        """
+        Does nothing, since the partial line is flushed by the reader in the worker process.
+        """
+
+    def expire_repeats(self, flush=False):
+        """
+        Does nothing, since repeated lines are collapsed by the reader in the worker process.
+        """
+
+    def read(self):
+        """
+        Updates the observers with the lines published by the worker since last called, and
+        restarts the worker if it has exited and the restart is due.
+        """
+        if self._process is None:
+            if not self._stopping and self._restart_at is not None and monotonic() >= self._restart_at:
+                self._restarts += 1
+                self.start()
+        else:
+            try:
+                if not os.read(self._wakeup_fd, self.READ_SIZE):
+                    self._exited()
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+
+        started_at = monotonic()
+        records = self._ring.get_all()
+        for line, arrival_time, names in records:
+            self.notify(line, arrival_time,
+                        tuple(names.decode('utf8').split(u'\n')) if names else ())  # update listeners
+        self._lines_read += len(records)
+        if records:
+            self._dispatch_time.observe(monotonic() - started_at)
+
+        dropped = self._ring.dropped
+        if dropped != self._dropped:
+            self.logger.warning('{}: {} log lines were dropped, the ring was full'.format(self._name,
+                                                                                          dropped - self._dropped))
+            self._dropped = dropped
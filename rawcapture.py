@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+from __future__ import print_function  # for python 2
+
+import io
+import logging
+import os
+import struct
+from collections import deque
+from datetime import datetime
+from threading import Thread, Event
+
+from metrics import Histogram
+from serialreader import LineSplitter, escape
+from timestamp import monotonic, wall_time
+
+FRAMES_SUFFIX = '.frames'
+# A frame is a chunk as read from the serial port: its offset in the capture file, its length and
+# the wall clock time when it arrived.
+FRAME = struct.Struct('<QId')
+# The max number of buffers of a single writev() call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):  # e.g. Windows, which has no writev() either
+    IOV_MAX = 1024
+if IOV_MAX <= 0:  # no limit reported
+    IOV_MAX = 1024
+
+
+def frames_path(capture_file_path):
+    """
+    :param capture_file_path: The file path of a raw capture.
+    :return: The file path of its frames.
+    """
+    return capture_file_path + FRAMES_SUFFIX
+
+
+class RawCaptureWriter(Thread):
+    """
+    This thread writes the exact bytes read from a serial port to a capture file, without
+    splitting, decoding or stripping them, so the capture is byte exact and costs the same whatever
+    the content is. The chunks are written as read, without being copied, with a single writev call
+    where available, and the framing of the chunks and their arrival times are written to a
+    frames file next to it, see FRAME. The chunks put are written once per write interval.
+    Thread quits if stop() is called, after writing the chunks put. If an exception is raised when
+    writing to file, this thread will callback to its owner to stop operation.
+    """
+    WRITE_INTERVAL = 0.1
+
+    def __init__(self, capture_file_path, callback, write_interval=WRITE_INTERVAL, fsync=False):
+        """
+        :param capture_file_path: The file path to write the raw bytes to.
+        :param callback: A callback method for calling back to application when error occurs.
+        :param write_interval: The number of seconds between writes.
+        :param fsync: Call fsync after each write to commit the data to the disk.
+        """
+        super(RawCaptureWriter, self).__init__(name = self.__class__.__name__)
+        self.setDaemon(True)
+        self._capture_file_path = capture_file_path
+        self._callback = callback
+        self._write_interval = write_interval
+        self._fsync = fsync
+        self._chunks = deque()
+        self._stop_event = Event()
+        self._offset = 0
+        self._write_latency = Histogram()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._capture_file_path,
+                                             self._write_interval,
+                                             self._fsync)
+
+    def put(self, data, arrival_time):
+        """
+        Puts a chunk of bytes to be written as read.
+        :param data: The bytes read from the serial port.
+        :param arrival_time: The monotonic time when the bytes arrived.
+        """
+        self._chunks.append((data, arrival_time))  # deque appends are thread-safe
+
+    def stats(self):
+        """
+        :return: A dict with the number of bytes written, the chunks waiting and a histogram of the
+                 seconds each write took.
+        """
+        return {'bytes_written': self._offset,
+                'queue_depth': len(self._chunks),
+                'write_latency_seconds': self._write_latency}
+
+    def stop(self):
+        """
+        Stop writing after the chunks put are written and commit suicide.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _write_chunks(self, capture_fd, frames_file):
+        chunks = self._chunks
+        taken = [chunks.popleft() for _ in range(len(chunks))]
+        if not taken:
+            return
+        buffers = [data for data, _ in taken]
+        frames = []
+        offset = self._offset
+        for data, arrival_time in taken:
+            frames.append(FRAME.pack(offset, len(data), wall_time(arrival_time)))
+            offset += len(data)
+
+        started_at = monotonic()
+        if hasattr(os, 'writev'):  # Python 3.3+
+            for start in range(0, len(buffers), IOV_MAX):  # writev() takes at most IOV_MAX buffers
+                batch = buffers[start:start + IOV_MAX]
+                written = os.writev(capture_fd, batch)
+                if written < sum(len(data) for data in batch):  # a partial write, so write the rest
+                    self._write_all(capture_fd, b''.join(batch)[written:])
+        else:
+            self._write_all(capture_fd, b''.join(buffers))
+        frames_file.write(b''.join(frames))  # after the data, so frames never point past it
+        frames_file.flush()
+        self._offset = offset
+        if self._fsync:
+            os.fsync(capture_fd)
+            os.fsync(frames_file.fileno())
+        self._write_latency.observe(monotonic() - started_at)
+
+    @staticmethod
+    def _write_all(fd, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def run(self):
+        try:
+            capture_fd = os.open(self._capture_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                with io.open(frames_path(self._capture_file_path), 'wb') as frames_file:
+                    self.logger.info('start writing raw capture.')
+                    while not self._stop_event.wait(self._write_interval):
+                        self._write_chunks(capture_fd, frames_file)
+                    self._write_chunks(capture_fd, frames_file)
+            finally:
+                os.close(capture_fd)
+        except Exception as e:  # this may occur if writing fails somehow
+            self.logger.error('Error: {}'.format(e))
+            self._callback('{} has stopped running. error: {}'.format(self.getName(), e))
+
+        self.logger.info('stopped writing raw capture.')
+
+
+def read_frames(capture_file_path):
+    """
+    :param capture_file_path: The file path of a raw capture.
+    :return: An iterator of (arrival time, chunk of bytes) in the order the chunks were read.
+    """
+    with io.open(capture_file_path, 'rb') as capture_file:
+        with io.open(frames_path(capture_file_path), 'rb') as frames_file:
+            while True:
+                record = frames_file.read(FRAME.size)
+                if len(record) < FRAME.size:  # the end or a frame partially written
+                    break
+                offset, length, arrival_time = FRAME.unpack(record)
+                capture_file.seek(offset)
+                yield arrival_time, capture_file.read(length)
+
+
+if __name__ == "__main__":
+    import argparse
+    from os.path import basename
+
+    # CLI
+    program_name = basename(__file__)
+    parser = argparse.ArgumentParser(description=('Raw Capture Viewer CLI\n\n'
+                                                  'You view a raw capture written by the serial logger. '
+                                                  'The exact bytes are\n'
+                                                  'split into lines and decoded when viewed, where bytes '
+                                                  'not being ascii are\n'
+                                                  'escaped like \\xff. Each line may be timestamped with '
+                                                  'the arrival time of\n'
+                                                  'the chunk completing it.\n'),
+                                     prog = program_name,
+                                     epilog = ('\n  %(prog)s -r serial.bin\n'
+                                               '  %(prog)s -r serial.bin -t\n'
+                                               '  %(prog)s -r serial.bin --frames\n'),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--raw', type=str, required = True, help='set raw capture file to view')
+    parser.add_argument('-t', '--timestamp', default=False, help='add arrival time to each line',
+                        action='store_true')
+    parser.add_argument('--frames', default=False, help='print each chunk as read with its arrival time',
+                        action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    def stamp(arrival_time):
+        return '({}) '.format(datetime.fromtimestamp(arrival_time).isoformat()) if args.timestamp else ''
+
+    if args.frames:
+        for arrival_time, data in read_frames(args.raw):
+            print('({}) {} bytes: {!r}'.format(datetime.fromtimestamp(arrival_time).isoformat(), len(data), data))
+    else:
+        splitter = LineSplitter()
+        arrival_time = None
+        for arrival_time, data in read_frames(args.raw):
+            for raw_line in splitter.feed(data):
+                print(stamp(arrival_time) + escape(raw_line.rstrip(b'\r')).decode('ascii'))
+        for raw_line in splitter.flush():
+            print(stamp(arrival_time) + escape(raw_line.rstrip(b'\r')).decode('ascii'))
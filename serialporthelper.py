@@ -1,13 +1,52 @@
 #!/usr/bin/env python
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import stat
 
 from serial.serialutil import SerialException
 from serial.tools import list_ports
 
+from timestamp import monotonic
+
 
 class SerialPortHelper(object):
     """
     This class provides listing of serial port names and relies on pyserial's tools.
+    Enumerating the ports is slow on hosts with many USB serial adapters, so a port given by its
+    device node is checked by the node itself, and the port names enumerated are cached for
+    CACHE_TTL seconds.
     """
+    CACHE_TTL = 5.0
+    _port_names = None
+    _enumerated_at = None
+
+    @classmethod
+    def port_names(cls, refresh=False):
+        """
+        :param refresh: Enumerate the ports even if the cached port names are still fresh.
+        :return: A set of the names of all available serial ports.
+        """
+        now = monotonic()
+        if refresh or cls._port_names is None or now - cls._enumerated_at > cls.CACHE_TTL:
+            cls._port_names = set(port[0] for port in list_ports.comports())  # port, desc, hwid
+            cls._enumerated_at = now
+        return cls._port_names
+
+    @staticmethod
+    def is_device_node(port_name):
+        """
+        :param port_name: The port name as a string
+        :return: True if the port name is a character device, e.g. /dev/ttyUSB0.
+        """
+        try:
+            return stat.S_ISCHR(os.stat(port_name).st_mode)
+        except (OSError, TypeError, ValueError):
+            return False
+
     @classmethod
     def list_ports(cls):
         """
@@ -24,13 +63,108 @@ class SerialPortHelper(object):
         :param port_name: The port name as a string
         :raises SerialException if port is not detected.
         """
-        # This requires pyserial version > 2.6 that has a bug with showing serial ports.
-        ports = [str(port).split('-')[0].strip() for port in list_ports.comports()]
-        if port_name not in ports:
+        if cls.is_device_node(port_name):
+            return
+        if port_name not in cls.port_names() and port_name not in cls.port_names(refresh=True):
             raise SerialException('Port {} not found. Check spelling of port name.'
                                   .format(port_name))
 
 
+class PortWatcher(object):
+    """
+    Waits for a serial port to come back, e.g. a USB serial adapter dropped when the device under
+    test is power cycled. On linux, the directory of the device node is watched with inotify, so
+    the port is found within milliseconds of udev creating its node or setting its permissions.
+    Otherwise, and for ports without a device node, the port is polled with a delay doubling from
+    POLL_INTERVAL up to MAX_POLL_INTERVAL.
+    """
+    POLL_INTERVAL = 0.01
+    MAX_POLL_INTERVAL = 1.0
+    IN_CREATE = 0x00000100
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    READ_SIZE = 4096
+
+    def __init__(self, poll_interval=POLL_INTERVAL, max_poll_interval=MAX_POLL_INTERVAL):
+        """
+        :param poll_interval: The first number of seconds between polls of the port.
+        :param max_poll_interval: The max number of seconds between polls of the port.
+        """
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._poll_interval, self._max_poll_interval)
+
+    @staticmethod
+    def is_available(port_name):
+        """
+        :param port_name: The port name as a string
+        :return: True if the port may be opened now.
+        """
+        if os.path.isabs(port_name):
+            return os.access(port_name, os.R_OK | os.W_OK)
+        try:
+            SerialPortHelper.check_port(port_name)
+            return True
+        except SerialException:
+            return False
+
+    @classmethod
+    def _inotify(cls, directory):
+        """
+        :return: An inotify file descriptor watching the directory for new nodes, or None if
+                 inotify is not available.
+        """
+        library = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(library, use_errno=True)
+            inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            return None
+        fd = inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = cls.IN_CREATE | cls.IN_ATTRIB | cls.IN_MOVED_TO
+        if inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def wait(self, port_name, stop_event):
+        """
+        Waits until the port is available or stopped.
+        :param port_name: The port name as a string
+        :param stop_event: An Event stopping the wait when set.
+        :return: True if the port is available, False if stopped.
+        """
+        fd = None
+        if os.path.isabs(port_name):
+            fd = self._inotify(os.path.dirname(port_name))  # before checking, so no event is missed
+        try:
+            interval = self._poll_interval
+            while not stop_event.is_set():
+                if self.is_available(port_name):
+                    return True
+                if fd is None:
+                    stop_event.wait(interval)
+                else:  # woken up by any node changing in the directory
+                    try:
+                        if select.select([fd], [], [], interval)[0]:
+                            os.read(fd, self.READ_SIZE)
+                    except (OSError, select.error) as e:
+                        if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                            raise
+                interval = min(interval * 2, self._max_poll_interval)
+            return False
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+
 if __name__ == "__main__":
     import argparse
     from os.path import basename
@@ -1,11 +1,93 @@
 #!/usr/bin/env python
-import codecs
 import logging
-from datetime import datetime
+import re
 from threading import Thread, Event
 from time import sleep
 
 from observer import Observable
+from serial.serialutil import SerialException
+
+from dispatch import MailboxObserver
+from metrics import Histogram, uart_counters
+from timestamp import TimeStamper, monotonic
+
+# The escapes of the bytes not being ascii, e.g. \xff, by their value.
+ESCAPES = dict((byte, u'\\x{:x}'.format(byte)) for byte in range(0x80, 0x100))
+NOT_ASCII = re.compile(b'[\x80-\xff]')
+
+
+def escape(raw_line):
+    """
+    Escapes the bytes of a line which are not ascii like \\xff, so a log line is ascii bytes which
+    sinks forward as they are and only sinks needing text decode. Lines of ascii only are returned
+    as they are, without a copy, and other lines are decoded as latin-1 and translated by a table,
+    so no error handler is called per byte. Escaping costs the same however noisy the line is.
+    :param raw_line: A line as bytes read from the serial port.
+    :return: The log line as ascii bytes.
+    """
+    if NOT_ASCII.search(raw_line) is None:
+        return raw_line
+    return raw_line.decode('latin-1').translate(ESCAPES).encode('ascii')
+
+
+class LineSplitter(object):
+    """
+    Splits a stream of received chunks of bytes into lines. The bytes following the last end line
+    character are kept in a reusable buffer and carried over to the next chunk, so a line may be
+    split over any number of reads. Lines are copied out of the buffer through a memoryview, once
+    per line. A line growing beyond max_line_length without an end line
+    character is flushed as is to keep the buffer bounded, e.g. when reading binary garbage.
+    """
+    MAX_LINE_LENGTH = 64 * 1024
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        """
+        :param max_line_length: The max number of bytes buffered while waiting for an end line.
+        """
+        self._max_line_length = max_line_length
+        self._buffer = bytearray()
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__,
+                                       self._max_line_length,
+                                       len(self._buffer))
+
+    def feed(self, data):
+        """
+        Adds a chunk of bytes and returns the lines completed by it.
+        :param data: A chunk of bytes read from the serial port.
+        :return: A list of lines as bytes without the end line character.
+        """
+        buf = self._buffer
+        buf.extend(data)
+        lines = []
+        start = 0
+        end = buf.find(b'\n')
+        if end >= 0 or len(buf) > self._max_line_length:
+            view = memoryview(buf)  # slicing a bytearray would copy each line twice
+            while end >= 0:
+                lines.append(view[start:end].tobytes())
+                start = end + 1
+                end = buf.find(b'\n', start)
+
+            if len(buf) - start > self._max_line_length:
+                lines.append(view[start:].tobytes())
+                start = len(buf)
+            del view  # the buffer can not be resized while viewed
+        if start:
+            del buf[:start]  # carry over the partial line only
+        return lines
+
+    def flush(self):
+        """
+        Returns any buffered partial line and empties the buffer.
+        :return: A list with the partial line, or an empty list if nothing is buffered.
+        """
+        if not self._buffer:
+            return []
+        line = bytes(self._buffer)
+        del self._buffer[:]
+        return [line]
 
 
 class SerialReader(Thread, Observable):
@@ -14,9 +96,55 @@ class SerialReader(Thread, Observable):
     registered observers. Thread quits if stop() is called. If an exception is raised when
     reading from serial due to I/O issues or escape characters received, this thread will
     callback to its owner to stop operation. Each log line is timestamped as default.
+
+    Two read modes are supported. LINE_MODE reads one line at a time with readline() and sleeps
+    between lines. CHUNK_MODE reads whatever is waiting in the input buffer, at most chunk_size
+    bytes, and splits it into lines. It only blocks on the port read timeout, which keeps up with
+    high baud rates while stop() stays as responsive as the read timeout.
+
+    Lines are updated to the observers with the monotonic time when the data arrived, which is
+    also what the timestamps are made from. Lines read in one chunk share the arrival time. Log
+    lines are ascii bytes, see escape(), so sinks forwarding them, like the file writer, neither
+    decode nor encode them, and only sinks needing text, like the console, decode them.
+
+    With async_dispatch, each attached observer gets a mailbox delivering its updates on a thread
+    of its own, so updating the observers never makes the reader wait for a slow observer.
+
+    With a raw capture, every chunk or line read is put to it as read, before being split, escaped
+    or stripped. RAW_MODE reads chunks like CHUNK_MODE for the raw capture only, without updating
+    the observers, so capturing costs the same whatever the content is.
+
+    With a PatternMatcher, the raw bytes of the lines are matched against its rules before being
+    escaped. Matching lines are tagged and trigger the actions of the rules, and observers are
+    updated with the names of the matching rules as (line, arrival_time, rule_names).
+
+    With a FrameSplitter, binary frames interleaved with the text, like SLIP, COBS or length
+    prefixed frames, are split from the chunks read in CHUNK_MODE and updated to the observers of
+    their framer, see framing.py, instead of being escaped as garbage lines. The text
+    between the frames goes to the observers of the reader as usual.
+
+    With a LineCollapser, runs of repeated lines are collapsed into a summary line before the
+    observers are updated, see dedup.py, so chatty devices cost far less console and disk I/O.
+
+    With a PortWatcher to reconnect with, an I/O error does not end the reader. The port is closed,
+    the watcher waits for it to come back, e.g. after the device under test was power cycled, and
+    it is reopened. The observers, the log file and the timestamp base stay the same, so a boot log
+    following a power cycle lands in the same log file on the same time line.
+
+    The bytes and lines read, read timeouts, reconnects, UART errors and the time spent updating the observers
+    of each read are returned by stats().
     """
+    LINE_MODE = 'line'
+    CHUNK_MODE = 'chunk'
+    RAW_MODE = 'raw'
+    READ_MODES = (LINE_MODE, CHUNK_MODE, RAW_MODE)
+    CHUNK_SIZE = 64 * 1024
 
-    def __init__(self, serial, callback, do_timestamp = True):
+    def __init__(self, serial, callback, do_timestamp = True, read_mode = LINE_MODE,
+                 chunk_size = CHUNK_SIZE, async_dispatch = False,
+                 mailbox_size = MailboxObserver.MAILBOX_SIZE, time_format = TimeStamper.RELATIVE,
+                 clock_base = None, matcher = None, raw_capture = None, reconnect = None,
+                 frame_splitter = None, collapser = None):
         """
         :param serial: A Serial object for communicating with a serial port. It needs to have
                        a read timeout set. Otherwise, this class object might hang forever if
@@ -25,75 +153,301 @@ class SerialReader(Thread, Observable):
         :type Serial
         :param callback: A callback method for calling back to owner when error occurs.
         :param do_timestamp: Add a timestamp to each line intercepted from the serial port.
+        :param read_mode: LINE_MODE, CHUNK_MODE or RAW_MODE.
+        :param chunk_size: The max number of bytes read at once in CHUNK_MODE and RAW_MODE.
+        :param async_dispatch: Deliver updates to each observer on a thread of its own.
+        :param mailbox_size: The max number of updates waiting for an observer with async_dispatch.
+        :param time_format: The timestamp format, one of TimeStamper.FORMATS.
+        :param clock_base: A ClockBase shared with other readers, or None to base relative
+                           timestamps on the first line arriving.
+        :param matcher: A PatternMatcher of rules to watch for or None for no matching.
+        :param raw_capture: A RawCaptureWriter to put the bytes read to or None for no raw capture.
+        :param reconnect: A PortWatcher waiting for the port to come back after an I/O error, or
+                          None to stop reading on the first error.
+        :param frame_splitter: A FrameSplitter splitting binary frames from the text in CHUNK_MODE,
+                               or None for text only.
+        :param collapser: A LineCollapser collapsing repeated lines or None to pass on every line.
         """
+        if read_mode not in self.READ_MODES:
+            raise ValueError('read_mode must be one of {}'.format(self.READ_MODES))
+        if read_mode == self.RAW_MODE and raw_capture is None:
+            raise ValueError('RAW_MODE requires a raw_capture')
+        if frame_splitter is not None and read_mode != self.CHUNK_MODE:
+            raise ValueError('frame_splitter requires CHUNK_MODE')
         Thread.__init__(self, name = self.__class__.__name__)
         Observable.__init__(self)
         self.setDaemon(True)
 
-        self._stop = Event()
+        self._stop_event = Event()
         self._do_timestamp = do_timestamp
+        self._read_mode = read_mode
+        self._chunk_size = chunk_size
         self._port = serial
         self.logger = logging.getLogger(self.__class__.__name__)
-        self._start_time = None  # Is set when first log line arrives from serial port.
+        self._time_stamper = TimeStamper(time_format, clock_base)
+        self._matcher = matcher
+        self._raw_capture = raw_capture
+        self._reconnect = reconnect
+        self._frame_splitter = frame_splitter
+        self._splitter = LineSplitter() if frame_splitter is None else frame_splitter
+        self._collapser = collapser
+        self._reconnects = 0
+        self._line_count = 0
+        self._bytes_read = 0
+        self._read_timeouts = 0
+        self._dispatch_time = Histogram()
         self._callback = callback
-        codecs.register_error('backslashreplace', self.backslash_replace)
+        self._async_dispatch = async_dispatch
+        self._mailbox_size = mailbox_size
+        self._mailboxes = {}  # observer -> MailboxObserver
+
+    def attach(self, observer):
+        """
+        Attaches an observer, wrapped in a mailbox of its own with async_dispatch.
+        """
+        if self._async_dispatch:
+            mailbox = MailboxObserver(observer, self._mailbox_size)
+            self._mailboxes[observer] = mailbox
+            mailbox.start()
+            observer = mailbox
+        Observable.attach(self, observer)
+
+    def detach(self, observer):
+        """
+        Detaches an observer and stops its mailbox with async_dispatch.
+        """
+        mailbox = self._mailboxes.pop(observer, None)
+        if mailbox is None:
+            Observable.detach(self, observer)
+        else:
+            Observable.detach(self, mailbox)
+            mailbox.stop()
+
+    def stats(self):
+        """
+        :return: A dict with the number of bytes and lines read, the number of reads timing out,
+                 the number of reconnects, the UART error counters if the driver keeps them, see uart_counters(), and a
+                 histogram of the seconds spent escaping and updating the observers per read.
+                 With a FrameSplitter, the stats of each framer are added as frames_<name>_<stat>,
+                 and with a LineCollapser, its stats are added.
+                 With async_dispatch, the mailbox stats of each observer are added as
+                 mailbox_<name>_<stat>.
+        """
+        stats = {'bytes_read': self._bytes_read,
+                 'lines_read': self._line_count,
+                 'read_timeouts': self._read_timeouts,
+                 'reconnects': self._reconnects,
+                 'dispatch_seconds': self._dispatch_time}
+        try:
+            stats.update(uart_counters(self._port.fileno()) or {})
+        except Exception:  # e.g. fake ports and closed ports have no file descriptor
+            pass
+        if self._collapser is not None:
+            stats.update(self._collapser.stats())
+        for framer in self._frame_splitter.framers if self._frame_splitter is not None else ():
+            for stat, value in framer.stats().items():
+                stats['frames_{}_{}'.format(framer.name, stat)] = value
+        for name, mailbox_stats in self.dispatch_stats().items():
+            for stat, value in mailbox_stats.items():
+                stats['mailbox_{}_{}'.format(name.lower(), stat)] = value
+        return stats
 
-    @staticmethod
-    def backslash_replace(error):
+    def dispatch_stats(self):
         """
-        An error handler to be called when escape characters are read from the log line queue input.
+        :return: A dict of mailbox stats by observer name with async_dispatch, see MailboxObserver.
         """
-        return u"".join([u"\\x{:x}".format(ord(error.object[i]))
-                         for i in range(error.start, error.end)]), error.end
+        return dict((mailbox.name, mailbox.stats()) for mailbox in list(self._mailboxes.values()))
 
     def __repr__(self):
-        return '{}({!r}, {!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
-                                                         self.getName(),
-                                                         self.is_alive(),
-                                                         self._do_timestamp,
-                                                         self._port,
-                                                         self._start_time)
+        return '{}({!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                               self.getName(),
+                                                               self.is_alive(),
+                                                               self._do_timestamp,
+                                                               self._read_mode,
+                                                               self._port,
+                                                               self._time_stamper)
 
-    def time_stamp(self, line):
+    def time_stamp(self, line, arrival_time=None):
         """
         Returns the line with a timestamp suitable for a log file.
-        :param line: A read line from serial port without timestamp.
+        :param line: A log line as bytes without timestamp.
+        :param arrival_time: The monotonic time when the line arrived or None for now.
         :return: timestamp + line
         """
-        time_delta = datetime.now() - self._start_time
-        return '(' + ':'.join(str(time_delta).split(':')[1:]) + ') ' + line
+        return self._time_stamper.stamp(line, monotonic() if arrival_time is None else arrival_time)
 
     def stop(self):
         """
         Stop reading from the serial port and commit suicide.
         """
-        self._stop.set()
+        self._stop_event.set()
         self.logger.debug('stop reading from serial port')
         if self.is_alive():
             self.join()
+        for mailbox in list(self._mailboxes.values()):
+            mailbox.stop()  # delivers what is left in the mailbox first
         self.logger.info('reader has terminated')
 
+    def _handle_line(self, raw_line, arrival_time, rules=()):
+        """
+        Escapes a line read from the serial port and updates the observers with it.
+        :param raw_line: A line as bytes read from the serial port.
+        :param arrival_time: The monotonic time when the line arrived.
+        :param rules: The rules of the matcher matching the line.
+        """
+        raw_line = raw_line.strip()
+        if raw_line:  # blank lines are dropped
+            line = escape(raw_line)
+            self.logger.debug('%s: %s', self._line_count, line)  # formatted only if debug is on
+            if rules:
+                line = self._matcher.trigger(rules, line, arrival_time)
+            rule_names = tuple(rule.name for rule in rules) if rules else ()
+            if self._collapser is None:
+                self._notify_line(line, arrival_time, rule_names)
+            else:
+                for collapsed in self._collapser.feed(line, arrival_time, rule_names):
+                    self._notify_line(*collapsed)
+            self._line_count += 1
+
+    def _notify_line(self, line, arrival_time, rule_names):
+        """
+        Timestamps a log line and updates the observers with it.
+        """
+        if self._do_timestamp:
+            line = self._time_stamper.stamp(line, arrival_time)
+        self.notify(line, arrival_time, rule_names)  # update listeners
+
+    def _expire_repeats(self, flush=False):
+        """
+        Updates the observers with the summary of the repeated lines collapsed, if due or flushed.
+        """
+        if self._collapser is not None:
+            for collapsed in self._collapser.flush() if flush else self._collapser.expire(monotonic()):
+                self._notify_line(*collapsed)
+
+    def _read_lines(self):
+        """
+        Reads one line at a time until stopped.
+        """
+        while not self._stop_event.is_set():
+            # we loop for every line and if no endline is found, then read timeout will occur.
+            raw_line = self._port.readline()
+            arrival_time = monotonic()  # before sleeping, so timestamps are not skewed by it
+            self._bytes_read += len(raw_line)
+            if not raw_line.endswith(b'\n'):
+                self._read_timeouts += 1
+            if raw_line and self._raw_capture is not None:
+                self._raw_capture.put(raw_line, arrival_time)
+            sleep(0.1)  # let in other threads
+
+            started_at = monotonic()
+            self._handle_line(raw_line, arrival_time, self._matcher.match(raw_line) if self._matcher else ())
+            self._expire_repeats()
+            self._dispatch_time.observe(monotonic() - started_at)
+
+    def _read_chunks(self):
+        """
+        Reads chunks of whatever is waiting in the input buffer until stopped. When nothing is
+        waiting, a single byte read blocks until data arrives or the read timeout occurs.
+        """
+        line_splitter, splitter = self._splitter, self._frame_splitter
+        while not self._stop_event.is_set():
+            waiting = self._port.inWaiting()
+            data = self._port.read(min(waiting, self._chunk_size) if waiting else 1)
+
+            if data:
+                arrival_time = monotonic()
+                self._bytes_read += len(data)
+                if self._raw_capture is not None:
+                    self._raw_capture.put(data, arrival_time)
+                raw_lines = line_splitter.feed(data) if splitter is None else splitter.feed(data, arrival_time)
+                if self._matcher is None:
+                    for raw_line in raw_lines:
+                        self._handle_line(raw_line, arrival_time)
+                else:  # one scan of all the lines read
+                    matches = self._matcher.match_lines(raw_lines)
+                    for i, raw_line in enumerate(raw_lines):
+                        self._handle_line(raw_line, arrival_time, matches.get(i, ()))
+                self._expire_repeats()
+                if raw_lines:
+                    self._dispatch_time.observe(monotonic() - arrival_time)
+            else:
+                self._read_timeouts += 1
+                self._expire_repeats()
+
+        self._flush_partial_line()
+
+    def _flush_partial_line(self):
+        """
+        Updates the observers with the partial line buffered by the splitter, if any, e.g. when
+        stopped or when the port is lost.
+        """
+        for raw_line in self._splitter.flush():
+            self._handle_line(raw_line, monotonic(), self._matcher.match(raw_line) if self._matcher else ())
+
+    def _read_raw(self):
+        """
+        Reads chunks like _read_chunks() and puts them to the raw capture only, until stopped.
+        """
+        while not self._stop_event.is_set():
+            waiting = self._port.inWaiting()
+            data = self._port.read(min(waiting, self._chunk_size) if waiting else 1)
+            if data:
+                self._bytes_read += len(data)
+                self._raw_capture.put(data, monotonic())
+            else:
+                self._read_timeouts += 1
+
+    def _reopen(self, error):
+        """
+        Closes the failed port, waits for it to come back and reopens it.
+        :param error: The I/O error the port failed with.
+        :return: True if reopened, False if stopped meanwhile.
+        """
+        self.logger.warning('lost serial port: {}, waiting for it to come back'.format(error))
+        lost_at = monotonic()
+        try:
+            self._port.close()
+        except Exception:  # the device is gone, so closing may fail too
+            pass
+        while self._reconnect.wait(self._port.port, self._stop_event):
+            try:
+                self._port.open()
+            except (SerialException, OSError, IOError) as e:  # e.g. udev is still setting it up
+                self.logger.debug('reopening failed: {}'.format(e))
+                self._stop_event.wait(self._reconnect.POLL_INTERVAL)
+                continue
+            self._reconnects += 1
+            self.logger.info('serial port is back after {:.3f} seconds'.format(monotonic() - lost_at))
+            return True
+        return False
+
+    def _read(self):
+        """
+        Reads in the read mode until stopped, reopening the port on I/O errors with reconnect.
+        """
+        while True:
+            try:
+                if self._read_mode == self.RAW_MODE:
+                    self._read_raw()
+                elif self._read_mode == self.CHUNK_MODE:
+                    self._read_chunks()
+                else:
+                    self._read_lines()
+                return
+            except (SerialException, OSError, IOError) as e:
+                if self._reconnect is None or self._stop_event.is_set():
+                    raise
+                self._flush_partial_line()  # the rest of it is lost with the port
+                if not self._reopen(e):
+                    return
+
     def run(self):
         try:
-            first_line_received = True
-            i = 0
-
-            self.logger.info('Start reading from serial port.')
-            while not self._stop.is_set():
-                # we loop for every line and if no endline is found, then read timeout will occur.
-                line = self._port.readline().decode('ascii', 'backslashreplace').strip()
-                sleep(0.1)  # let in other threads
-
-                if first_line_received:
-                    self._start_time = datetime.now()
-                    first_line_received = False
-                if line:
-                    self.logger.debug('{}: {}'.format(i, line))
-                    if self._do_timestamp:
-                        line = self.time_stamp(line)
-                    self.notify(line)  # update listeners
-                    i += 1
-        except Exception as e:  # this may occur if readline() fails handling an escape character
+            self.logger.info('Start reading from serial port in {} mode.'.format(self._read_mode))
+            self._read()
+            self._expire_repeats(flush=True)
+        except Exception as e:  # this may occur if reading fails handling an escape character
             self.logger.error('Error: {}'.format(e))
             self._callback('{} has stopped running. error: {}'.format(self.getName(), e))
 
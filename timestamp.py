@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+import ctypes
+import ctypes.util
+import re
+import time
+from datetime import datetime
+
+try:
+    from time import monotonic  # Python 3.3+
+except ImportError:
+    def _clock_gettime_monotonic():
+        """
+        :return: A monotonic clock read by clock_gettime(CLOCK_MONOTONIC) or None if unavailable.
+        """
+        class TimeSpec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1  # Linux
+        library = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            return None
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(TimeSpec)]
+        time_spec = TimeSpec()
+        time_spec_pointer = ctypes.pointer(time_spec)
+
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, time_spec_pointer):
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return time_spec.tv_sec + time_spec.tv_nsec * 1e-9
+        return monotonic
+
+    monotonic = _clock_gettime_monotonic() or time.time  # wall clock as a last resort
+
+
+class ClockBase(object):
+    """
+    Ties the monotonic clock to the wall clock at one point in time, so a monotonic time can be
+    turned into wall clock time without being skewed by later changes of the wall clock.
+    Readers sharing a clock base get timestamps on the same time line.
+    """
+
+    def __init__(self, monotonic_time=None):
+        """
+        :param monotonic_time: The monotonic time to use as base, or None for now.
+        """
+        now = monotonic()
+        self.monotonic = now if monotonic_time is None else monotonic_time
+        self.wall = time.time() - (now - self.monotonic)
+        self.wall_ns = int(self.wall * 1e9)
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.monotonic, self.wall)
+
+    def wall_time(self, monotonic_time):
+        """
+        :param monotonic_time: A time read from the monotonic clock.
+        :return: The wall clock time in seconds since the epoch.
+        """
+        return self.wall + (monotonic_time - self.monotonic)
+
+
+_process_clock_base = ClockBase()
+
+
+def wall_time(monotonic_time):
+    """
+    :param monotonic_time: A time read from the monotonic clock.
+    :return: The wall clock time in seconds since the epoch, on a clock base shared by the process.
+    """
+    return _process_clock_base.wall_time(monotonic_time)
+
+
+class TimeStamper(object):
+    """
+    Formats timestamps for log lines from monotonic times taken when the data arrived.
+    RELATIVE formats the time since the clock base as (MM:SS.ffffff), ISO formats the wall clock
+    time as (YYYY-MM-DDTHH:MM:SS.ffffff) and EPOCH_NS formats the nanoseconds since the epoch.
+    The part of the timestamp down to whole seconds is cached, so formatting a timestamp mostly
+    costs formatting the microseconds. Timestamps are ascii bytes, like the log lines stamped.
+    """
+    RELATIVE = 'relative'
+    ISO = 'iso'
+    EPOCH_NS = 'epoch_ns'
+    FORMATS = (RELATIVE, ISO, EPOCH_NS)
+
+    def __init__(self, time_format=RELATIVE, clock_base=None):
+        """
+        :param time_format: One of FORMATS.
+        :param clock_base: A ClockBase shared with other stampers, or None to create one based on
+                           the arrival time of the first line stamped.
+        """
+        if time_format not in self.FORMATS:
+            raise ValueError('time_format must be one of {}'.format(self.FORMATS))
+        self._time_format = time_format
+        self._clock_base = clock_base
+        self._cached_second = None
+        self._cached_prefix = None
+        self._format = {self.RELATIVE: self._format_relative,
+                        self.ISO: self._format_iso,
+                        self.EPOCH_NS: self._format_epoch_ns}[time_format]
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._time_format, self._clock_base)
+
+    @property
+    def clock_base(self):
+        """The clock base or None if no timestamp has been made yet."""
+        return self._clock_base
+
+    def _format_relative(self, monotonic_time):
+        seconds = max(0.0, monotonic_time - self._clock_base.monotonic)
+        whole_seconds = int(seconds)
+        if whole_seconds != self._cached_second:
+            self._cached_second = whole_seconds
+            self._cached_prefix = b'(%02d:%02d.' % divmod(whole_seconds, 60)
+        return self._cached_prefix + b'%06d) ' % ((seconds - whole_seconds) * 1e6)
+
+    def _format_iso(self, monotonic_time):
+        wall = self._clock_base.wall_time(monotonic_time)
+        whole_seconds = int(wall)
+        if whole_seconds != self._cached_second:
+            self._cached_second = whole_seconds
+            second = datetime.fromtimestamp(whole_seconds).strftime('(%Y-%m-%dT%H:%M:%S.')
+            self._cached_prefix = second.encode('ascii')
+        return self._cached_prefix + b'%06d) ' % ((wall - whole_seconds) * 1e6)
+
+    def _format_epoch_ns(self, monotonic_time):
+        return b'(%d) ' % (self._clock_base.wall_ns + int((monotonic_time - self._clock_base.monotonic) * 1e9))
+
+    def prefix(self, monotonic_time):
+        """
+        :param monotonic_time: The monotonic time when the line arrived.
+        :return: The timestamp to put before a log line as bytes.
+        """
+        if self._clock_base is None:
+            self._clock_base = ClockBase(monotonic_time)
+        return self._format(monotonic_time)
+
+    def stamp(self, line, monotonic_time):
+        """
+        :param line: A log line as bytes.
+        :param monotonic_time: The monotonic time when the line arrived.
+        :return: timestamp + line
+        """
+        return self.prefix(monotonic_time) + line
+
+
+_RELATIVE_STAMP = re.compile(r'\((\d+):(\d\d)\.(\d{6})\) ')
+_ISO_STAMP = re.compile(r'\((\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)\.(\d{6})\) ')
+_EPOCH_NS_STAMP = re.compile(r'\((\d{10,})\) ')
+_iso_second = [None, None]
+
+
+def split_stamp(line):
+    """
+    Splits the timestamp a TimeStamper put before a log line from the line.
+    :param line: A log line.
+    :return: (time, line without the timestamp), where the time is in seconds, which is seconds
+             since the clock base for a RELATIVE timestamp and seconds since the epoch otherwise,
+             or (None, line) if the line has no timestamp.
+    """
+    match = _RELATIVE_STAMP.match(line)
+    if match:
+        return int(match.group(1)) * 60 + int(match.group(2)) + int(match.group(3)) * 1e-6, line[match.end():]
+    match = _ISO_STAMP.match(line)
+    if match:
+        second = match.group(1)
+        if second != _iso_second[0]:  # parsing the date and time is slow, so the last one is cached
+            _iso_second[:] = [second, time.mktime(datetime.strptime(second, '%Y-%m-%dT%H:%M:%S').timetuple())]
+        return _iso_second[1] + int(match.group(2)) * 1e-6, line[match.end():]
+    match = _EPOCH_NS_STAMP.match(line)
+    if match:
+        return int(match.group(1)) * 1e-9, line[match.end():]
+    return None, line
+
+
+def parse_stamp(line):
+    """
+    Reads the timestamp a TimeStamper put before a log line.
+    :param line: A log line.
+    :return: The time in seconds, see split_stamp(), or None if the line has no timestamp.
+    """
+    return split_stamp(line)[0]
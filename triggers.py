@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+import logging
+import re
+from os.path import splitext
+
+from observer import Observer
+
+from filewriter import FileWriter
+from timestamp import wall_time
+
+
+class Rule(object):
+    """
+    A pattern to watch for in the log lines, matched on the raw bytes read from the serial port.
+    A literal pattern matches where the bytes occur in a line and a regex pattern is a regular
+    expression of bytes. Patterns must not match end line characters. Lines are matched as received,
+    so a line may end with a carriage return, which is why '$' is better written '\r?$'.
+    A line matching the rule is tagged with the tag, if any, and the actions are called with the
+    rule, the decoded line and the monotonic time when it arrived.
+    """
+
+    def __init__(self, name, pattern, regex=False, tag=None, actions=()):
+        """
+        :param name: The name of the rule, which is what observers are updated with.
+        :param pattern: The literal or regex pattern as bytes or text, which is encoded as utf8.
+        :param regex: The pattern is a regular expression instead of a literal.
+        :param tag: A tag put before the lines matching or None for no tag.
+        :param actions: Callables called as action(rule, line, arrival_time) on a match.
+        """
+        self.name = name
+        self.pattern = pattern if isinstance(pattern, bytes) else pattern.encode('utf8')
+        self.regex = regex
+        self.tag = tag
+        self.actions = tuple(actions)
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                                   self.name,
+                                                   self.pattern,
+                                                   self.regex,
+                                                   self.tag)
+
+
+class PatternMatcher(object):
+    """
+    Compiles many rules into one regular expression, so a line is scanned once however many rules
+    there are. Literal patterns are merged into a trie, e.g. 'Kernel panic' and 'Kernel oops' into
+    'Kernel (?:oops|panic)', which keeps the regular expression from trying each literal in turn.
+    Only the rare lines found by the combined scan are checked against each rule, to tell all
+    rules matching these.
+    A batch of lines is scanned as one buffer, which costs one scan per read from the serial port
+    instead of one per line.
+    """
+    TAG_FORMAT = u'[{}] '
+
+    def __init__(self, rules, ignore_case=False):
+        """
+        :param rules: The rules to match.
+        :param ignore_case: Match all rules regardless of case.
+        """
+        self._rules = list(rules)
+        self._ignore_case = ignore_case
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)  # lines are scanned in batches
+        self._literal_rules = [rule for rule in self._rules if not rule.regex]
+        self._rule_regexes = [(rule, re.compile(rule.pattern, flags)) for rule in self._rules if rule.regex]
+        if ignore_case:  # literals are found by a regex too, since 'in' is case sensitive
+            self._rule_regexes += [(rule, re.compile(re.escape(rule.pattern), flags))
+                                   for rule in self._literal_rules]
+            self._literal_rules = []
+
+        patterns = [rule.pattern for rule in self._rules if rule.regex]
+        literals = [rule.pattern for rule in self._rules if not rule.regex]
+        if literals:
+            patterns.insert(0, self._trie_pattern(literals))
+        self._regex = re.compile(b'|'.join(patterns), flags) if patterns else None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self._rules, self._ignore_case)
+
+    @property
+    def rules(self):
+        return list(self._rules)
+
+    @staticmethod
+    def _trie_pattern(literals):
+        """
+        :return: A regex pattern matching any of the literals, with common prefixes factored out.
+        """
+        end = None  # marks where a literal ends in the trie
+        trie = {}
+        for literal in literals:
+            node = trie
+            for i in range(len(literal)):
+                node = node.setdefault(literal[i:i + 1], {})
+            node[end] = {}
+
+        def pattern_of(node):
+            prefix = b''
+            while len(node) == 1 and end not in node:  # a chain of single bytes needs no group
+                byte, node = next(iter(node.items()))
+                prefix += re.escape(byte)
+            branches = [re.escape(byte) + pattern_of(child)
+                        for byte, child in sorted(node.items(), key=lambda item: item[0] or b'')
+                        if byte is not end]
+            if not branches:
+                return prefix
+            if end in node:  # a literal may end here, so the rest is optional
+                return prefix + b'(?:' + b'|'.join(branches) + b')?'
+            return prefix + b'(?:' + b'|'.join(branches) + b')'
+
+        return pattern_of(trie)
+
+    def _rules_matching(self, raw_line):
+        rules = [rule for rule in self._literal_rules if rule.pattern in raw_line]
+        rules += [rule for rule, regex in self._rule_regexes if regex.search(raw_line)]
+        return rules
+
+    def match(self, raw_line):
+        """
+        :param raw_line: A line as bytes read from the serial port.
+        :return: A list of the rules matching the line, which is empty if none.
+        """
+        if self._regex is None or not self._regex.search(raw_line):
+            return []
+        return self._rules_matching(raw_line)
+
+    def match_lines(self, raw_lines):
+        """
+        :param raw_lines: A list of lines as bytes read from the serial port.
+        :return: A dict of the lists of rules matching by the position of the line in the list.
+        """
+        matches = {}
+        if self._regex is None or not raw_lines:
+            return matches
+        data = b'\n'.join(raw_lines)
+        search = self._regex.search
+        match = search(data)
+        line_index, line_start = 0, 0
+        while match:
+            start = match.start()
+            line_index += data.count(b'\n', line_start, start)
+            line_end = data.find(b'\n', start)
+            rules = self._rules_matching(raw_lines[line_index])
+            if rules:  # none if the combined scan matched across lines
+                matches[line_index] = rules
+            if line_end < 0:
+                break
+            line_index, line_start = line_index + 1, line_end + 1
+            match = search(data, line_start)
+        return matches
+
+    def trigger(self, rules, line, arrival_time):
+        """
+        Tags a log line with the tags of the rules matching it and calls their actions with the
+        line decoded. An action failing is logged, so it does not stop reading.
+        :param rules: The rules matching the line.
+        :param line: The log line as bytes.
+        :param arrival_time: The monotonic time when the line arrived.
+        :return: The tagged line as bytes.
+        """
+        text = None
+        for rule in rules:
+            for action in rule.actions:
+                if text is None:
+                    text = line.decode('utf8', 'replace')
+                try:
+                    action(rule, text, arrival_time)
+                except Exception as e:
+                    self.logger.error('Error: {}: {}'.format(rule.name, e))
+        tags = u''.join(self.TAG_FORMAT.format(rule.tag) for rule in rules if rule.tag)
+        return tags.encode('utf8') + line if tags else line
+
+
+def load_rules(rules_file_path, tag=False, actions=()):
+    """
+    Loads rules from a file with a rule per line like 'name = pattern', where a pattern between
+    slashes like 'name = /pattern/' is a regular expression. Empty lines and lines starting with
+    '#' are skipped.
+    :param rules_file_path: The file path of the rules.
+    :param tag: Tag the lines matching with the rule name.
+    :param actions: Actions called on a match of any rule, see Rule.
+    :return: A list of rules.
+    """
+    rules = []
+    with open(rules_file_path, 'rb') as rules_file:
+        for number, text in enumerate(rules_file, 1):
+            text = text.strip()
+            if not text or text.startswith(b'#'):
+                continue
+            name, separator, pattern = text.partition(b'=')
+            name, pattern = name.strip().decode('utf8'), pattern.strip()
+            if not separator or not name or not pattern:
+                raise ValueError('{}:{}: expected name = pattern'.format(rules_file_path, number))
+            is_regex = len(pattern) > 1 and pattern.startswith(b'/') and pattern.endswith(b'/')
+            rules.append(Rule(name,
+                              pattern[1:-1] if is_regex else pattern,
+                              regex=is_regex,
+                              tag=name if tag else None,
+                              actions=actions))
+    return rules
+
+
+class TriggeredCapture(Observer):
+    """
+    Intercepts log lines and writes the lines from a line matching a start rule until a line
+    matching a stop rule, both included, to a log file of its own. Each capture gets a new log
+    file numbered after the log file path, e.g. panic-1.txt, panic-2.txt and so on.
+    Observers are updated with the names of the matching rules, so captures start and stop in
+    order with the lines, also when updated on a thread of its own.
+    """
+
+    def __init__(self, log_file_path, callback, start_rules, stop_rules, flush_policy=None):
+        """
+        :param log_file_path: The file path the captures are numbered after.
+        :param callback: A callback method for calling back to application when error occurs.
+        :param start_rules: The names of the rules starting a capture.
+        :param stop_rules: The names of the rules stopping a capture.
+        :param flush_policy: A FlushPolicy of the capture files. A default policy if None.
+        """
+        super(TriggeredCapture, self).__init__(self.__class__.__name__)
+        self._log_file_path = log_file_path
+        self._callback = callback
+        self._start_rules = frozenset(start_rules)
+        self._stop_rules = frozenset(stop_rules)
+        self._flush_policy = flush_policy
+        self._file_writer = None
+        self.capture_count = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+                                             self._log_file_path,
+                                             sorted(self._start_rules),
+                                             sorted(self._stop_rules))
+
+    def capture_file_path(self, capture_number):
+        root, extension = splitext(self._log_file_path)
+        return '{}-{}{}'.format(root, capture_number, extension)
+
+    def is_capturing(self):
+        return self._file_writer is not None
+
+    def stop(self):
+        """
+        Stop a capture in progress.
+        """
+        if self._file_writer is not None:
+            self._file_writer.stop()
+            self._file_writer = None
+
+    def update(self, data):
+        log_line, arrival_time, rule_names = data  # data is a tuple
+        if self._file_writer is None and not self._start_rules.isdisjoint(rule_names):
+            self.capture_count += 1
+            capture_file_path = self.capture_file_path(self.capture_count)
+            self.logger.info('start capture to {}'.format(capture_file_path))
+            self._file_writer = FileWriter(capture_file_path, self._callback, flush_policy=self._flush_policy)
+            self._file_writer.start()
+        if self._file_writer is not None:
+            self._file_writer.put(log_line, wall_time(arrival_time))
+            if not self._stop_rules.isdisjoint(rule_names):
+                self.logger.info('stop capture')
+                self.stop()